@@ -0,0 +1,116 @@
+"""Memory/time trade-off of activation checkpointing in the DiffusionScore networks (`--activation_checkpointing`).
+
+For each task shape, hidden size and number of segments (0 = no checkpointing), trains a few
+steps of DiffusionScore and reports the time per step and the peak memory the training steps add
+on top of the model: peak RSS growth of the process on CPU (each configuration runs in its own
+spawned process), or `torch.cuda.max_memory_allocated` growth with --use_gpu. Needs no design_bench
+data:
+
+    python design_baselines/diff/bench_checkpointing.py --tasks tf-bind-10 nas \
+        --hidden_size 1024 2048 4096 --segments 0 2 4 --batch_size 1024
+"""
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from bench_train import TASK_SHAPES, make_task, peak_rss_mb
+from engine import LeanTrainer, make_adam
+
+
+def peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return peak_rss_mb()
+
+
+def run_config(config, args):
+    from nets import DiffusionScore
+
+    warnings.filterwarnings("ignore")
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if args.use_gpu and torch.cuda.is_available() else "cpu")
+    task = make_task(config["task"], args.batch_size, seed=args.seed)
+    model = DiffusionScore(taskname=config["task"], task=task, hidden_size=config["hidden_size"],
+                           dropout_p=args.dropout_p, score_arch=args.score_arch,
+                           checkpoint_segments=config["segments"]).to(device)
+    batch = tuple(torch.tensor(a, device=device) for a in (task.x.reshape(len(task.x), -1), task.y, task.w))
+    optimizer = make_adam(model.gen_sde.parameters(), lr=1e-4)
+    engine = LeanTrainer(model.gen_sde.parameters(), model.loss, optimizer)
+    # one step on two rows first, so that the optimizer state, but hardly any activation, is in the baseline
+    engine.step(tuple(t[:2].clone() for t in batch))
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    baseline = peak_memory_mb(device)
+
+    latencies = []
+    for _ in range(args.steps):
+        start = time.perf_counter()
+        engine.step(tuple(t.clone() for t in batch)).item()
+        latencies.append(time.perf_counter() - start)
+    return {**config,
+            "dim_x": model.dim_x,
+            "step_ms": 1e3 * float(np.median(latencies)),
+            "baseline_mb": baseline,
+            "training_peak_mb": peak_memory_mb(device) - baseline}
+
+
+def _worker(queue, config, args):
+    try:
+        queue.put(run_config(config, args))
+    except Exception as e:
+        queue.put({**config, "error": repr(e)})
+
+
+def run_isolated(config, args):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_worker, args=(queue, config, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(args):
+    results = []
+    for task, hidden_size in itertools.product(args.tasks, args.hidden_size):
+        reference = None
+        for segments in args.segments:
+            result = run_isolated(dict(task=task, hidden_size=hidden_size, segments=segments), args)
+            results.append(result)
+            if "error" in result:
+                print(f"{task:>12s}  hidden {hidden_size:5d}  segments {segments}  failed: {result['error']}")
+                continue
+            reference = reference or result
+            print(f"{task:>12s}  hidden {hidden_size:5d}  segments {segments}  "
+                  f"{result['step_ms']:8.1f} ms/step (x{result['step_ms'] / reference['step_ms']:.2f})  "
+                  f"training peak {result['training_peak_mb']:8.1f} MB "
+                  f"(x{result['training_peak_mb'] / max(reference['training_peak_mb'], 1e-6):.2f})")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="activation checkpointing memory/time benchmark")
+    parser.add_argument("--tasks", type=str, nargs="+", choices=list(TASK_SHAPES), default=["tf-bind-10", "nas"])
+    parser.add_argument("--hidden_size", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument("--segments", type=int, nargs="+", default=[0, 2, 4],
+                        help="numbers of checkpointed segments, 0 = no checkpointing (the reference)")
+    parser.add_argument("--score_arch", type=str, default="mlp", choices=["mlp", "film"])
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--dropout_p", type=float, default=0.15)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--use_gpu", action="store_true", default=False)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    main(parser.parse_args())
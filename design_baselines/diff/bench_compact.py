@@ -0,0 +1,156 @@
+"""Memory of the training data of a discrete task as float32 logits vs uint8 codes (`--compact_x`).
+
+For each layout, a spawned process (so that its peak RSS is its own) preprocesses the task as
+trainer.py does, builds the TensorRvSDataset the training loop reads from, and times drawing and
+expanding minibatches. Reported per layout:
+
+    x_mb            size of the x array held for training
+    dataset_mb      size of the TensorRvSDataset (x, y and w)
+    peak_rss_mb     peak resident set size of the process
+    batch_ms        median time to slice a minibatch and, for codes, expand it to logits
+
+By default it loads the full TFBind10 (4161482 rows, 10 positions, 4 classes) through design_bench.
+With --synthetic it draws random codes of the same shape instead and needs no design_bench data:
+
+    python design_baselines/diff/bench_compact.py --task tf-bind-10
+    python design_baselines/diff/bench_compact.py --synthetic --rows 4161482
+"""
+import argparse
+import json
+import multiprocessing as mp
+import time
+
+import numpy as np
+import torch
+
+from bench_train import peak_rss_mb
+from data import TensorRvSDataset
+from util import TASKNAME2TASK, LogitExpander, get_weights, load_task_arrays
+
+
+class SyntheticDiscreteTask:
+    """Random codes with the to_logits/normalize_x of a design_bench DiscreteDataset."""
+
+    is_discrete = True
+
+    def __init__(self, rows, length, num_classes, seed=0, soft_interpolation=0.6):
+        rng = np.random.default_rng(seed)
+        self.codes = rng.integers(0, num_classes, (rows, length)).astype(np.int32)
+        self.y = rng.standard_normal((rows, 1)).astype(np.float32)
+        self.input_shape = (length,)
+        self.soft_interpolation = soft_interpolation
+        self.dataset = argparse.Namespace(num_classes=num_classes)
+        self.is_normalized_x = False
+
+    def to_logits(self, x):
+        one_hot = np.eye(self.dataset.num_classes, dtype=np.float32)[x]
+        one_hot = one_hot * self.soft_interpolation + (1. - self.soft_interpolation) / self.dataset.num_classes
+        log_p = np.log(one_hot)
+        return log_p[..., 1:] - log_p[..., :1]
+
+    def normalize_x(self, x):
+        return (x - self.x_mean) / self.x_standard_dev
+
+    def arrays(self, compact, normalise_x):
+        if normalise_x:
+            # statistics over the logits in chunks, as design_bench computes them
+            total, total_sq = 0., 0.
+            for start in range(0, len(self.codes), 2 ** 18):
+                logits = self.to_logits(self.codes[start:start + 2 ** 18]).astype(np.float64)
+                total, total_sq = total + logits.sum(axis=0), total_sq + (logits ** 2).sum(axis=0)
+            self.x_mean = (total / len(self.codes)).astype(np.float32)
+            self.x_standard_dev = np.sqrt(total_sq / len(self.codes) - self.x_mean ** 2).astype(np.float32)
+            self.is_normalized_x = True
+        if compact:
+            x = self.codes.astype(np.uint8)
+        else:
+            x = self.to_logits(self.codes)
+            if normalise_x:
+                x = self.normalize_x(x)
+            x = x.reshape(len(x), -1)
+        return x, self.y, get_weights(self.y, temp="90")
+
+
+def run_layout(layout, args):
+    torch.set_num_threads(args.threads)
+    compact = layout == "codes"
+    if args.synthetic:
+        task = SyntheticDiscreteTask(args.rows, args.length, args.num_classes, seed=args.seed)
+        x, y, w = task.arrays(compact, args.normalise_x)
+    else:
+        import design_bench
+        task = design_bench.make(TASKNAME2TASK[args.task], dataset_kwargs={"max_samples": args.max_samples})
+        x, y, w = load_task_arrays(task, args.task, args.normalise_x, True, temp="90", compact=compact)
+    expander = LogitExpander.from_task(task) if compact else None
+    dataset = TensorRvSDataset(task, x, y, w)
+    dataset_bytes = dataset.data.nbytes + (dataset.codes.nbytes if dataset.codes is not None else 0)
+
+    generator = torch.Generator().manual_seed(args.seed)
+    latencies = []
+    for _ in range(args.batches):
+        idx = torch.randint(len(dataset), (args.batch_size,), generator=generator)
+        start = time.perf_counter()
+        batch_x = dataset[idx][0]
+        if expander is not None:
+            batch_x = expander(batch_x)
+        latencies.append(time.perf_counter() - start)
+    return {"layout": layout,
+            "rows": len(dataset),
+            "dim_x": int(batch_x.shape[1]),
+            "x_mb": x.nbytes / 2 ** 20,
+            "dataset_mb": dataset_bytes / 2 ** 20,
+            "peak_rss_mb": peak_rss_mb(),
+            "batch_ms": 1e3 * float(np.median(latencies))}
+
+
+def _worker(queue, layout, args):
+    try:
+        queue.put(run_layout(layout, args))
+    except Exception as e:
+        queue.put({"layout": layout, "error": repr(e)})
+
+
+def run_isolated(layout, args):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_worker, args=(queue, layout, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(args):
+    results = []
+    for layout in args.layouts:
+        result = run_isolated(layout, args)
+        results.append(result)
+        if "error" in result:
+            print(f"{layout:>7s}  failed: {result['error']}")
+            continue
+        print(f"{layout:>7s}  {result['rows']} rows  x {result['x_mb']:8.1f} MB  dataset {result['dataset_mb']:8.1f} MB  "
+              f"peak rss {result['peak_rss_mb']:8.1f} MB  batch {result['batch_ms']:6.3f} ms")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="memory of logits vs uint8 codes for discrete tasks")
+    parser.add_argument("--task", type=str, default="tf-bind-10",
+                        choices=["tf-bind-8", "tf-bind-10", "nas", "rnabind", "chembl", "gfp"])
+    parser.add_argument("--max_samples", type=int, default=None,
+                        help="rows of the design_bench dataset, all of them by default")
+    parser.add_argument("--layouts", type=str, nargs="+", choices=["logits", "codes"], default=["logits", "codes"])
+    parser.add_argument("--normalise_x", action="store_true", default=False)
+    parser.add_argument("--synthetic", action="store_true", default=False,
+                        help="random codes instead of the design_bench data")
+    parser.add_argument("--rows", type=int, default=4161482, help="rows of the synthetic data")
+    parser.add_argument("--length", type=int, default=10, help="positions of the synthetic designs")
+    parser.add_argument("--num_classes", type=int, default=4, help="classes of the synthetic designs")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--batches", type=int, default=200, help="timed minibatches")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    main(parser.parse_args())
@@ -0,0 +1,100 @@
+"""Benchmark DiffusionScore training steps per second with `pl.Trainer` versus `engine.LeanTrainer`.
+
+Both train the same model on the same synthetic data (superconductor-shaped by default) for the
+same number of epochs. Lightning is fed through a DataLoader of TensorRvSDataset batches, and
+the lean loop slices batches from on-device tensors. Needs no design_bench data and no GPU:
+
+    python design_baselines/diff/bench_engine.py --hidden_size 256 1024 --epochs 5
+"""
+import argparse
+import json
+import time
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from torch.utils.data import DataLoader
+
+from data import TensorRvSDataset, ContiguousBatchSampler
+from engine import LeanTrainer, make_adam
+from nets import DiffusionScore, get_cosine_schedule_with_warmup
+
+
+class StepTimer(pl.Callback):
+
+    def __init__(self):
+        self.steps = 0
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.steps += 1
+
+
+def lightning_steps_per_s(task, hidden_size, args, device):
+    torch.manual_seed(0)
+    model = DiffusionScore(taskname="superconductor", task=task, hidden_size=hidden_size,
+                           dropout_p=args.dropout_p)
+    dataset = TensorRvSDataset(task, task.x, task.y, task.w)
+    loader = DataLoader(dataset, sampler=ContiguousBatchSampler(len(dataset), args.batch_size), batch_size=None)
+    timer = StepTimer()
+    trainer = pl.Trainer(accelerator="gpu" if device.type == "cuda" else "cpu", devices=1,
+                         max_epochs=args.epochs, logger=False, enable_checkpointing=False,
+                         enable_progress_bar=args.progress_bar, enable_model_summary=False,
+                         callbacks=[timer], limit_val_batches=0)
+    start = time.perf_counter()
+    trainer.fit(model, loader)
+    return timer.steps / (time.perf_counter() - start)
+
+
+def lean_steps_per_s(task, hidden_size, args, device):
+    torch.manual_seed(0)
+    model = DiffusionScore(taskname="superconductor", task=task, hidden_size=hidden_size,
+                           dropout_p=args.dropout_p).to(device)
+    tensors = tuple(torch.tensor(a, device=device) for a in (task.x, task.y, task.w))
+    optimizer = make_adam(model.gen_sde.parameters(), lr=model.learning_rate)
+    scheduler = get_cosine_schedule_with_warmup(optimizer, model.warmup_steps, model.num_training_steps)
+    engine = LeanTrainer(model.gen_sde.parameters(), model.loss, optimizer, scheduler, grad_clip=args.grad_clip)
+    start = time.perf_counter()
+    engine.fit(tensors, args.batch_size, args.epochs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return engine.global_step / (time.perf_counter() - start)
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    warnings.filterwarnings("ignore")
+    device = torch.device("cuda" if args.use_gpu and torch.cuda.is_available() else "cpu")
+    rng = np.random.default_rng(0)
+    task = SimpleNamespace(x=rng.standard_normal((args.rows, args.dim_x)).astype(np.float32),
+                           y=rng.standard_normal((args.rows, 1)).astype(np.float32),
+                           w=rng.uniform(0, 5, (args.rows, 1)).astype(np.float32))
+    results = []
+    for hidden_size in args.hidden_size:
+        lightning = lightning_steps_per_s(task, hidden_size, args, device)
+        lean = lean_steps_per_s(task, hidden_size, args, device)
+        results.append({"hidden_size": hidden_size, "lightning_steps_per_s": lightning,
+                        "lean_steps_per_s": lean, "speedup": lean / lightning})
+        print(f"hidden {hidden_size:5d}  lightning {lightning:8.1f} steps/s  lean {lean:8.1f} steps/s  "
+              f"x{lean / lightning:.2f}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lightning vs lean training loop benchmark")
+    parser.add_argument("--rows", type=int, default=17014)
+    parser.add_argument("--dim_x", type=int, default=86)
+    parser.add_argument("--hidden_size", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--dropout_p", type=float, default=0.15)
+    parser.add_argument("--grad_clip", type=float, default=None)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--progress_bar", action="store_true", default=False,
+                        help="keep Lightning's progress bar, as in trainer.py runs")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--use_gpu", action="store_true", default=False)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    main(parser.parse_args())
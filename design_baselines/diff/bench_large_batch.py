@@ -0,0 +1,137 @@
+"""Large-batch training of DiffusionScore and of the grad.py proxy: throughput and final quality per
+batch size and learning rate scaling rule (`--lr_scaling`, `--accumulate_grad_batches`).
+
+Every configuration trains for the same number of epochs (so on the same number of samples)
+with the learning rate and warmup given by `util.scale_for_batch_size` from values tuned at
+--base_batch_size, and reports:
+
+    samples_per_s   training samples per second, DiffusionScore and proxy
+    elbo            final held-out ELBO estimate of DiffusionScore (fixed times and probes)
+    pcc             final held-out Pearson correlation of the proxy
+
+Batches above --micro_batch_size are reached with gradient accumulation. Runs on the synthetic
+low-rank dataset of bench_weighting.py, so it needs no design_bench data and no GPU:
+
+    python design_baselines/diff/bench_large_batch.py --batch_size 256 1024 4096 --rules none sqrt linear
+"""
+import argparse
+import itertools
+import json
+import time
+import warnings
+from types import SimpleNamespace
+
+import torch
+
+from bench_weighting import make_data
+from engine import LeanTrainer, make_adam
+from my_model import SimpleMLP
+from nets import DiffusionScore, get_cosine_schedule_with_warmup
+from util import LR_SCALING_RULES, scale_for_batch_size
+from utils import adjust_learning_rate, compute_pcc
+
+
+@torch.no_grad()
+def heldout_elbo(model, x, y, batch_size=1024):
+    """Mean ELBO estimate of the held-out rows, with the same times and probes at every call."""
+    with torch.random.fork_rng():
+        torch.manual_seed(0)
+        return torch.cat([model.gen_sde.elbo_random_t_slice(xb, yb)
+                          for xb, yb in zip(x.split(batch_size), y.split(batch_size))]).mean().item()
+
+
+def accumulation(batch_size, args):
+    """(micro batch size, number of accumulated micro batches) of an effective batch."""
+    if args.micro_batch_size is None or batch_size <= args.micro_batch_size:
+        return batch_size, 1
+    assert batch_size % args.micro_batch_size == 0, "batch sizes must be multiples of --micro_batch_size"
+    return args.micro_batch_size, batch_size // args.micro_batch_size
+
+
+def train_diffusion(train, val, batch_size, rule, args):
+    torch.manual_seed(args.seed)
+    lr, warmup = scale_for_batch_size(args.learning_rate, args.warmup_epochs, batch_size,
+                                      args.base_batch_size, rule=rule)
+    micro_batch_size, accumulate = accumulation(batch_size, args)
+    task = SimpleNamespace(x=train[0].numpy(), y=train[1].numpy())
+    model = DiffusionScore(taskname="superconductor", task=task, hidden_size=args.hidden_size,
+                           learning_rate=lr, dropout_p=args.dropout_p)
+    optimizer = make_adam(model.gen_sde.parameters(), lr=lr)
+    scheduler = get_cosine_schedule_with_warmup(optimizer, num_warmup_steps=warmup, num_training_steps=args.epochs)
+    engine = LeanTrainer(model.gen_sde.parameters(), model.loss, optimizer, scheduler,
+                         accumulate_grad_batches=accumulate)
+    start = time.perf_counter()
+    engine.fit(train, micro_batch_size, args.epochs)
+    seconds = time.perf_counter() - start
+    return {"lr": lr, "warmup_epochs": warmup, "accumulate": accumulate, "optimizer_steps": engine.global_step,
+            "samples_per_s": args.epochs * len(train[0]) / seconds, "elbo": heldout_elbo(model, *val[:2])}
+
+
+def train_proxy(train, val, batch_size, rule, args):
+    torch.manual_seed(args.seed)
+    lr, warmup = scale_for_batch_size(args.proxy_lr, args.proxy_warmup_epochs, batch_size,
+                                      args.proxy_base_batch_size, rule=rule)
+    micro_batch_size, accumulate = accumulation(batch_size, args)
+    model = SimpleMLP(train[0].shape[1], hid_dim=args.hidden_size)
+    optimizer = make_adam(model.parameters(), lr=lr, weight_decay=args.wd, decoupled=True)
+    engine = LeanTrainer(model.parameters(), lambda batch: torch.mean(torch.pow(model(batch[0]) - batch[1], 2)),
+                         optimizer, accumulate_grad_batches=accumulate)
+    start = time.perf_counter()
+    engine.fit(train[:2], micro_batch_size, args.epochs,
+               on_epoch_start=lambda e: adjust_learning_rate(optimizer, lr, e, args.epochs, warmup))
+    seconds = time.perf_counter() - start
+    with torch.no_grad():
+        pcc = compute_pcc(model(val[0]).squeeze(), val[1].squeeze()).item()
+    return {"lr": lr, "warmup_epochs": warmup, "samples_per_s": args.epochs * len(train[0]) / seconds, "pcc": pcc}
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    warnings.filterwarnings("ignore", message=".*self.log.*")
+    x, y, w = make_data(args.rows + args.val_rows, args.dim_x, args.rank, args.temp, seed=0)
+    train = tuple(torch.tensor(a[:args.rows]) for a in (x, y, w))
+    val = tuple(torch.tensor(a[args.rows:]) for a in (x, y, w))
+
+    results = []
+    for rule, batch_size in itertools.product(args.rules, args.batch_size):
+        diffusion = train_diffusion(train, val, batch_size, rule, args)
+        # the proxy prints its learning rate every epoch
+        proxy = train_proxy(train, val, batch_size, rule, args) if args.proxy else None
+        results.append({"rule": rule, "batch_size": batch_size, "diffusion": diffusion, "proxy": proxy})
+        line = (f"{rule:>6s}  batch {batch_size:6d} (x{diffusion['accumulate']} accumulated)  "
+                f"lr {diffusion['lr']:.2e}  warmup {diffusion['warmup_epochs']:4d}  "
+                f"{diffusion['samples_per_s']:9.0f} samples/s  elbo {diffusion['elbo']:10.4f}")
+        if proxy is not None:
+            line += f"  |  proxy {proxy['samples_per_s']:9.0f} samples/s  pcc {proxy['pcc']:.4f}"
+        print(line)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="large-batch training benchmark")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[256, 1024, 4096])
+    parser.add_argument("--rules", type=str, nargs="+", choices=LR_SCALING_RULES, default=["none", "sqrt", "linear"])
+    parser.add_argument("--micro_batch_size", type=int, default=None,
+                        help="largest batch computed at once, larger ones accumulate gradients")
+    parser.add_argument("--rows", type=int, default=16384)
+    parser.add_argument("--val_rows", type=int, default=2048)
+    parser.add_argument("--dim_x", type=int, default=32)
+    parser.add_argument("--rank", type=int, default=4)
+    parser.add_argument("--temp", type=str, default="90", choices=["90", "75", "50"])
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--learning_rate", type=float, default=1e-3, help="DiffusionScore learning rate at the base batch")
+    parser.add_argument("--warmup_epochs", type=int, default=5, help="DiffusionScore warmup at the base batch")
+    parser.add_argument("--base_batch_size", type=int, default=256, help="batch size of score_diffusion.cfg")
+    parser.add_argument("--dropout_p", type=float, default=0.15)
+    parser.add_argument("--proxy", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--proxy_lr", type=float, default=5e-5, help="grad.py proxy learning rate at the base batch")
+    parser.add_argument("--proxy_warmup_epochs", type=int, default=5)
+    parser.add_argument("--proxy_base_batch_size", type=int, default=128, help="batch size of the grad.py defaults")
+    parser.add_argument("--wd", type=float, default=0.0)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    main(parser.parse_args())
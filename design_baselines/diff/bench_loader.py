@@ -0,0 +1,89 @@
+"""Benchmark one training epoch of data loading: per-item `RvSDataset` + default collate versus
+`TensorRvSDataset` + `ContiguousBatchSampler`.
+
+Runs on synthetic arrays shaped like superconductor (~17k rows, 86 dims) by default, so it
+needs neither design_bench nor a GPU:
+
+    python design_baselines/diff/bench_loader.py --num_workers 0 8 --epochs 3
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from data import RvSDataset, TensorRvSDataset, ContiguousBatchSampler
+
+
+def epoch_time(loader, epochs, step=None):
+    """Mean wall time of iterating `loader` once, optionally running `step` on every batch."""
+    timings = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for batch in loader:
+            if step is not None:
+                step(batch)
+        timings.append(time.perf_counter() - start)
+    return float(np.mean(timings))
+
+
+def make_step(dim_x, hidden_size):
+    model = torch.nn.Sequential(torch.nn.Linear(dim_x + 2, hidden_size), torch.nn.SiLU(),
+                                torch.nn.Linear(hidden_size, hidden_size), torch.nn.SiLU(),
+                                torch.nn.Linear(hidden_size, dim_x))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+    def step(batch):
+        x, y, w = batch
+        t = torch.rand(x.size(0), 1)
+        loss = (w * model(torch.cat([x, t, y], dim=1)) ** 2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    return step
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((args.rows, args.dim_x)).astype(np.float32)
+    y = rng.standard_normal((args.rows, 1)).astype(np.float32)
+    w = rng.uniform(0, 5, (args.rows, 1)).astype(np.float32)
+
+    dataset = RvSDataset(None, x, y, w)
+    tensor_dataset = TensorRvSDataset(None, x, y, w)
+    results = []
+    for with_step in [False, True]:
+        step = make_step(args.dim_x, args.hidden_size) if with_step else None
+        for num_workers in args.num_workers:
+            loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=num_workers)
+            results.append({"loader": "RvSDataset", "num_workers": num_workers, "with_step": with_step,
+                            "epoch_s": epoch_time(loader, args.epochs, step)})
+        loader = DataLoader(tensor_dataset,
+                            sampler=ContiguousBatchSampler(len(tensor_dataset), args.batch_size),
+                            batch_size=None)
+        results.append({"loader": "TensorRvSDataset", "num_workers": 0, "with_step": with_step,
+                        "epoch_s": epoch_time(loader, args.epochs, step)})
+
+    for r in results:
+        print(f"{r['loader']:>17s}  workers={r['num_workers']}  train_step={r['with_step']!s:5s}  "
+              f"epoch {r['epoch_s'] * 1e3:8.1f} ms")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="data loader epoch-time benchmark")
+    parser.add_argument("--rows", type=int, default=17014)
+    parser.add_argument("--dim_x", type=int, default=86)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 8])
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    main(parser.parse_args())
@@ -0,0 +1,137 @@
+"""Benchmark the diffusion-time samplers of the denoising score matching loss (`--t_sampler`).
+
+Trains the same DiffusionScore (same init, same batches) once per sampler and tracks the
+held-out ELBO estimate every few epochs. The target is the final ELBO of the uniform sampler,
+and each sampler is reported with the first epoch at which it reaches that target.
+
+Runs on a synthetic low-rank dataset with a smooth label, so it needs no design_bench data
+and no GPU:
+
+    python design_baselines/diff/bench_t_sampler.py --epochs 1000 --seeds 0 1 2
+"""
+import argparse
+import json
+import time
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from lib.utils import T_SAMPLERS
+from nets import DiffusionScore
+
+
+def make_data(rows, dim_x, rank, seed):
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal((rows, rank))
+    x = np.tanh(z @ rng.standard_normal((rank, dim_x))) + 0.05 * rng.standard_normal((rows, dim_x))
+    y = np.sin(z[:, :1]) + 0.5 * z[:, 1:2] ** 2
+    y = (y - y.mean()) / y.std()
+    return x.astype(np.float32), y.astype(np.float32)
+
+
+@torch.no_grad()
+def heldout_elbo(model, x, y, repeats):
+    """ELBO estimate averaged over `repeats` draws of (t, v), with the same draws at every call."""
+    model.eval()
+    with torch.random.fork_rng():
+        torch.manual_seed(0)
+        elbo = np.mean([model.gen_sde.elbo_random_t_slice(x, y).mean().item() for _ in range(repeats)])
+    model.train()
+    return float(elbo)
+
+
+def train(t_sampler, task, x_val, y_val, seed, args):
+    torch.manual_seed(seed)
+    model = DiffusionScore(taskname="superconductor", task=task, hidden_size=args.hidden_size,
+                           learning_rate=args.learning_rate, dropout_p=args.dropout_p,
+                           t_sampler=t_sampler)
+    [optimizer], [scheduler] = model.configure_optimizers()
+    x = torch.tensor(task.x)
+    y = torch.tensor(task.y)
+    w = torch.ones_like(y)
+    # the batch order only depends on the seed, so samplers differ in their times alone
+    batch_generator = torch.Generator().manual_seed(seed)
+
+    curve = []
+    start = time.perf_counter()
+    for epoch in range(args.epochs):
+        perm = torch.randperm(x.size(0), generator=batch_generator)
+        for i, idx in enumerate(perm.split(args.batch_size)):
+            loss = model.training_step((x[idx], y[idx].clone(), w[idx]), i)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        scheduler["scheduler"].step()
+        if (epoch + 1) % args.eval_every == 0:
+            curve.append((epoch + 1, heldout_elbo(model, x_val, y_val, args.elbo_repeats)))
+    return curve, time.perf_counter() - start
+
+
+def epochs_to_target(curve, target):
+    for epoch, elbo in curve:
+        if elbo >= target:
+            return epoch
+    return None
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    warnings.filterwarnings("ignore", message=".*self.log.*")
+    x, y = make_data(args.rows + args.val_rows, args.dim_x, args.rank, seed=0)
+    task = SimpleNamespace(x=x[:args.rows], y=y[:args.rows])
+    x_val, y_val = torch.tensor(x[args.rows:]), torch.tensor(y[args.rows:])
+
+    runs = []
+    for seed in args.seeds:
+        for t_sampler in args.t_samplers:
+            curve, seconds = train(t_sampler, task, x_val, y_val, seed, args)
+            runs.append({"t_sampler": t_sampler, "seed": seed, "train_s": seconds, "curve": curve})
+            print(f"seed {seed} {t_sampler:>10s}  final elbo {curve[-1][1]:10.3f}  ({seconds:.1f}s)")
+
+    results = []
+    for seed in args.seeds:
+        seed_runs = [r for r in runs if r["seed"] == seed]
+        reference = [r for r in seed_runs if r["t_sampler"] == "uniform"] or seed_runs[:1]
+        # mean of the last three evaluations, so one noisy estimate does not set the bar
+        target = args.target_elbo
+        if target is None:
+            target = float(np.mean([elbo for _, elbo in reference[0]["curve"][-3:]]))
+        for r in seed_runs:
+            results.append({"t_sampler": r["t_sampler"], "seed": seed, "target_elbo": target,
+                            "epochs_to_target": epochs_to_target(r["curve"], target),
+                            "final_elbo": r["curve"][-1][1], "train_s": r["train_s"]})
+
+    for t_sampler in args.t_samplers:
+        rs = [r for r in results if r["t_sampler"] == t_sampler]
+        reached = [r["epochs_to_target"] for r in rs if r["epochs_to_target"] is not None]
+        mean_epochs = f"{np.mean(reached):7.1f}" if reached else "    n/a"
+        print(f"{t_sampler:>10s}  epochs to target {mean_epochs}  "
+              f"({len(reached)}/{len(rs)} seeds reached)  "
+              f"final elbo {np.mean([r['final_elbo'] for r in rs]):10.3f}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results, "runs": runs}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="epochs-to-target-ELBO benchmark of the t-samplers")
+    parser.add_argument("--t_samplers", type=str, nargs="+", choices=T_SAMPLERS, default=T_SAMPLERS)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--rows", type=int, default=2048)
+    parser.add_argument("--val_rows", type=int, default=512)
+    parser.add_argument("--dim_x", type=int, default=32)
+    parser.add_argument("--rank", type=int, default=4)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--learning_rate", type=float, default=1e-3)
+    parser.add_argument("--dropout_p", type=float, default=0.15)
+    parser.add_argument("--epochs", type=int, default=1000)
+    parser.add_argument("--eval_every", type=int, default=20)
+    parser.add_argument("--elbo_repeats", type=int, default=8)
+    parser.add_argument("--target_elbo", type=float, default=None,
+                        help="defaults to the final ELBO of the uniform sampler for the same seed")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    main(parser.parse_args())
@@ -0,0 +1,201 @@
+"""Training throughput benchmark of DiffusionScore, for catching regressions in training speed.
+
+For every task of `TASKNAME2TASK` it builds synthetic data of the shape the task has once
+trainer.py has preprocessed it (discrete tasks as logits), and trains DiffusionScore on it over a
+sweep of hidden sizes, batch sizes and thread counts. Each configuration runs in its own spawned
+process, so its peak RSS is its own, and reports:
+
+    samples_per_s       training samples per second over the timed steps
+    step_ms             p50/p90/p99 latency of one optimizer step (loss, backward, step)
+    peak_rss_mb         peak resident set size of the process
+    time_to_target_s    wall time until the smoothed loss first reaches the target loss
+
+Steps are timed one by one with a host synchronization each, as a real run logs every loss.
+Needs no design_bench data and no GPU:
+
+    python design_baselines/diff/bench_train.py --tasks superconductor tf-bind-8 \
+        --hidden_size 256 1024 --batch_size 128 512 --threads 1 4 --output bench_train.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import sys
+import time
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from engine import LeanTrainer, make_adam
+from util import TASKNAME2TASK
+
+# (rows, shape of one design) of the preprocessed datasets, with discrete designs as
+# (length, number of classes - 1) logits
+TASK_SHAPES = {
+    'dkitty': (10004, (56,)),
+    'ant': (10004, (60,)),
+    'superconductor': (17014, (86,)),
+    'hopper': (3200, (5126,)),
+    'tf-bind-8': (32898, (8, 3)),
+    'tf-bind-10': (30000, (10, 3)),
+    'nas': (1771, (64, 4)),
+    'chembl': (1093, (31, 590)),
+    'gfp': (5000, (237, 19)),
+    'rosenbrock': (15000, (60,)),
+    'ackley': (15000, (60,)),
+    'cosines': (15000, (60,)),
+    'griewank': (15000, (60,)),
+    'levy': (15000, (60,)),
+    'rastrigin': (15000, (60,)),
+    'sphere': (15000, (60,)),
+    'zakharov': (15000, (60,)),
+    'rnabind': (2500, (14, 3)),
+}
+assert set(TASK_SHAPES) == set(TASKNAME2TASK)
+
+
+def make_task(taskname, max_rows, seed=0):
+    rows, shape = TASK_SHAPES[taskname]
+    if max_rows is not None:
+        rows = min(rows, max_rows)
+    rng = np.random.default_rng(seed)
+    return SimpleNamespace(x=rng.standard_normal((rows, *shape)).astype(np.float32),
+                           y=rng.standard_normal((rows, 1)).astype(np.float32),
+                           w=rng.uniform(0, 5, (rows, 1)).astype(np.float32))
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def run_config(config, args):
+    from nets import DiffusionScore
+
+    warnings.filterwarnings("ignore")
+    torch.set_num_threads(config["threads"])
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if args.use_gpu and torch.cuda.is_available() else "cpu")
+    task = make_task(config["task"], args.max_rows, seed=args.seed)
+    model = DiffusionScore(taskname=config["task"], task=task, hidden_size=config["hidden_size"],
+                           learning_rate=args.learning_rate, dropout_p=args.dropout_p,
+                           warmup_steps=0).to(device)
+    x = torch.tensor(task.x.reshape(len(task.x), -1), device=device)
+    y = torch.tensor(task.y, device=device)
+    w = torch.tensor(task.w, device=device)
+    engine = LeanTrainer(model.gen_sde.parameters(), model.loss,
+                         make_adam(model.gen_sde.parameters(), lr=args.learning_rate))
+    generator = torch.Generator(device=device).manual_seed(args.seed)
+
+    latencies = []
+    smoothed = initial = target = time_to_target = None
+    elapsed = 0.
+    for step in range(args.warmup_steps + args.steps):
+        idx = torch.randint(len(x), (config["batch_size"],), device=device, generator=generator)
+        start = time.perf_counter()
+        loss = engine.step((x[idx], y[idx], w[idx])).item()
+        latency = time.perf_counter() - start
+        elapsed += latency
+        if step >= args.warmup_steps:
+            latencies.append(latency)
+
+        smoothed = loss if smoothed is None else args.smoothing * smoothed + (1 - args.smoothing) * loss
+        if step == args.smoothing_steps - 1:
+            initial = smoothed
+            target = args.target_loss if args.target_loss is not None else args.target_loss_frac * initial
+        if target is not None and time_to_target is None and smoothed <= target:
+            time_to_target = elapsed
+
+    latencies = np.array(latencies)
+    return {**config,
+            "rows": len(x),
+            "dim_x": model.dim_x,
+            "samples_per_s": config["batch_size"] * len(latencies) / latencies.sum(),
+            "step_ms": {f"p{q}": 1e3 * float(np.percentile(latencies, q)) for q in (50, 90, 99)},
+            "peak_rss_mb": peak_rss_mb(),
+            "initial_loss": initial,
+            "target_loss": target,
+            "final_loss": smoothed,
+            "time_to_target_s": time_to_target}
+
+
+def _worker(queue, config, args):
+    try:
+        queue.put(run_config(config, args))
+    except Exception as e:
+        queue.put({**config, "error": repr(e)})
+
+
+def run_isolated(config, args):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_worker, args=(queue, config, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(args):
+    assert args.smoothing_steps <= args.warmup_steps + args.steps
+    configs = [dict(task=task, hidden_size=h, batch_size=b, threads=t)
+               for task, h, b, t in itertools.product(args.tasks, args.hidden_size,
+                                                      args.batch_size, args.threads)]
+    results = []
+    for config in configs:
+        result = run_isolated(config, args)
+        results.append(result)
+        if "error" in result:
+            print(f"{config}  failed: {result['error']}")
+            continue
+        ttt = result["time_to_target_s"]
+        print(f"{result['task']:>14s}  hidden {result['hidden_size']:5d}  batch {result['batch_size']:5d}  "
+              f"threads {result['threads']:2d}  {result['samples_per_s']:10.0f} samples/s  "
+              f"p50 {result['step_ms']['p50']:7.2f} ms  p99 {result['step_ms']['p99']:7.2f} ms  "
+              f"rss {result['peak_rss_mb']:7.0f} MB  "
+              f"to target {'n/a' if ttt is None else f'{ttt:.2f} s'}")
+
+    report = {"config": vars(args),
+              "machine": {"platform": platform.platform(),
+                          "processor": platform.processor(),
+                          "cpu_count": os.cpu_count(),
+                          "python": platform.python_version(),
+                          "torch": torch.__version__,
+                          "cuda": torch.cuda.get_device_name() if args.use_gpu and torch.cuda.is_available()
+                          else None},
+              "results": results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DiffusionScore training throughput benchmark")
+    parser.add_argument("--tasks", type=str, nargs="+", choices=list(TASK_SHAPES), default=list(TASK_SHAPES))
+    parser.add_argument("--hidden_size", type=int, nargs="+", default=[1024])
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[128])
+    parser.add_argument("--threads", type=int, nargs="+", default=[torch.get_num_threads()])
+    parser.add_argument("--max_rows", type=int, default=None,
+                        help="cap on the rows of the synthetic datasets, which default to the real sizes")
+    parser.add_argument("--warmup_steps", type=int, default=20, help="untimed steps before the timed ones")
+    parser.add_argument("--steps", type=int, default=500, help="timed steps")
+    parser.add_argument("--learning_rate", type=float, default=1e-3)
+    parser.add_argument("--dropout_p", type=float, default=0.15)
+    parser.add_argument("--smoothing", type=float, default=0.9, help="EMA factor of the smoothed loss")
+    parser.add_argument("--smoothing_steps", type=int, default=10,
+                        help="the smoothed loss after this many steps is the initial loss")
+    parser.add_argument("--target_loss_frac", type=float, default=0.5,
+                        help="target loss as a fraction of the initial loss")
+    parser.add_argument("--target_loss", type=float, default=None, help="absolute target loss, overrides the fraction")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--use_gpu", action="store_true", default=False)
+    parser.add_argument("--output", type=str, default=None, help="JSON file for the report, printed if not given")
+    main(parser.parse_args())
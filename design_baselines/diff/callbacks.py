@@ -0,0 +1,217 @@
+"""Lightning callbacks used by trainer.py."""
+import json
+import os
+import queue
+import threading
+
+import pytorch_lightning as pl
+import torch
+
+from lib.helpers import ExponentialMovingAverage
+
+
+class EMACallback(pl.Callback):
+    """
+    Keeps an exponential moving average of the model weights, updated after every optimizer step.
+    Validation runs with the averaged weights, and checkpoints store them next to the raw
+    weights under "ema_state_dict" (see util.load_ema_weights).
+    """
+
+    def __init__(self, decay=0.999):
+        super().__init__()
+        self.decay = decay
+        self.ema = None
+        self._restored = None
+
+    def on_fit_start(self, trainer, pl_module):
+        self.ema = ExponentialMovingAverage(pl_module, decay=self.decay)
+        if self._restored is not None:
+            self.ema.load_state_dict(self._restored)
+            self._restored = None
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        # with gradient accumulation only the last micro batch of a step updates the weights,
+        # and the last batch of an epoch always steps
+        if (batch_idx + 1) % trainer.accumulate_grad_batches == 0 or trainer.is_last_batch:
+            self.ema.apply()
+
+    def _swap(self):
+        # nothing to swap before the first update, e.g. during the sanity check
+        if self.ema is not None and len(self.ema.shadow_params) > 0:
+            self.ema.swap()
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self._swap()
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        self._swap()
+
+    def on_save_checkpoint(self, trainer, pl_module, checkpoint):
+        if self.ema is not None and len(self.ema.shadow_params) > 0:
+            checkpoint["ema_state_dict"] = self.ema.state_dict()
+            checkpoint["ema_decay"] = self.decay
+
+    def on_load_checkpoint(self, trainer, pl_module, checkpoint):
+        self._restored = checkpoint.get("ema_state_dict")
+
+
+def _detached_cpu_copy(obj):
+    """Recursively copy all tensors of a checkpoint dict to the CPU, so that training can keep
+    updating the live tensors while the copy is written."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _detached_cpu_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_detached_cpu_copy(v) for v in obj)
+    return obj
+
+
+# keys of a Lightning checkpoint needed to load the model for inference
+WEIGHTS_KEYS = ["state_dict", "pytorch-lightning_version", "epoch", "global_step", "ema_state_dict", "ema_decay",
+                "t_max"]
+
+
+class AsyncCheckpointStore(pl.Callback):
+    """
+    Writes checkpoints from a background thread, so training does not wait for the disk.
+
+    dirpath/weights/epoch=XXX.ckpt  weights only (plus EMA weights), every `every_n_epochs` epochs,
+                                    loadable with `load_from_checkpoint`; the last `keep_weights` are kept
+    dirpath/state/epoch=XXX.ckpt    full resumable training state (optimizer, schedulers, loops, callbacks)
+                                    at the same epochs; the last `keep_states` are kept
+    dirpath/last.ckpt               full state after every epoch, as written by `ModelCheckpoint(save_last=True)`
+
+    A negative retention keeps everything. The training thread only takes a CPU copy of the state.
+    """
+
+    def __init__(self, dirpath, every_n_epochs=50, keep_weights=-1, keep_states=1, save_last=True):
+        super().__init__()
+        self.dirpath = dirpath
+        self.every_n_epochs = every_n_epochs
+        self.keep = {"weights": keep_weights, "state": keep_states}
+        self.save_last = save_last
+        self._queue = queue.Queue()
+        self._worker = None
+        self._error = None
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, checkpoint, kind = item
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # write to a temporary file first, so a crash never leaves a truncated checkpoint
+                tmp_path = path + ".tmp"
+                torch.save(checkpoint, tmp_path)
+                os.replace(tmp_path, path)
+                if kind is not None:
+                    self._prune(kind)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _prune(self, kind):
+        keep = self.keep[kind]
+        if keep < 0:
+            return
+        directory = os.path.join(self.dirpath, kind)
+        files = sorted((f for f in os.listdir(directory) if f.startswith("epoch=") and f.endswith(".ckpt")),
+                       key=lambda f: int(f[len("epoch="):-len(".ckpt")]))
+        for f in files[:max(len(files) - keep, 0)]:
+            os.remove(os.path.join(directory, f))
+
+    def _submit(self, path, checkpoint, kind=None):
+        if self._error is not None:
+            raise RuntimeError("writing a checkpoint failed") from self._error
+        self._queue.put((path, checkpoint, kind))
+
+    def flush(self):
+        """Block until all submitted checkpoints are on disk."""
+        self._queue.join()
+        if self._error is not None:
+            raise RuntimeError("writing a checkpoint failed") from self._error
+
+    def setup(self, trainer, pl_module, stage):
+        if trainer.is_global_zero and self._worker is None:
+            self._worker = threading.Thread(target=self._write, daemon=True)
+            self._worker.start()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        if not trainer.is_global_zero or trainer.sanity_checking:
+            return
+        epoch = trainer.current_epoch
+        periodic = self.every_n_epochs and (epoch + 1) % self.every_n_epochs == 0
+        if not (periodic or self.save_last):
+            return
+        checkpoint = _detached_cpu_copy(trainer._checkpoint_connector.dump_checkpoint(weights_only=False))
+        if periodic:
+            filename = f"epoch={epoch:03d}.ckpt"
+            weights = {k: checkpoint[k] for k in WEIGHTS_KEYS if k in checkpoint}
+            self._submit(os.path.join(self.dirpath, "weights", filename), weights, "weights")
+            self._submit(os.path.join(self.dirpath, "state", filename), checkpoint, "state")
+        if self.save_last:
+            self._submit(os.path.join(self.dirpath, "last.ckpt"), checkpoint)
+
+    def teardown(self, trainer, pl_module, stage):
+        if self._worker is not None:
+            self.flush()
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+
+class ELBOTargetCallback(pl.Callback):
+    """
+    Records the first epoch at which the validation ELBO estimate reaches `target_elbo`
+    (e.g. the final ELBO of a model trained from scratch), logs it as "epochs_to_target_elbo"
+    and writes it to `output_file`. With `stop=True` training ends once the target is reached.
+    `mode` follows ModelCheckpoint: with "min" (the default, as for the checkpoints of trainer.py)
+    the target is reached once the monitored value is at or below it, with "max" at or above it.
+    """
+
+    def __init__(self, target_elbo, output_file=None, monitor="elbo_estimator", mode="min", stop=False):
+        super().__init__()
+        if mode not in ("min", "max"):
+            raise ValueError(f"mode must be 'min' or 'max', got {mode!r}")
+        self.target_elbo = target_elbo
+        self.output_file = output_file
+        self.monitor = monitor
+        self.mode = mode
+        self.stop = stop
+        self.reached_epoch = None
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking or self.reached_epoch is not None:
+            return
+        elbo = trainer.callback_metrics.get(self.monitor)
+        if elbo is None or not self._reached(elbo):
+            return
+        self.reached_epoch = trainer.current_epoch + 1
+        print(f"{self.monitor} {elbo:.4e} reached the target {self.target_elbo:.4e} after {self.reached_epoch} epochs")
+        if trainer.logger is not None:
+            trainer.logger.log_metrics({"epochs_to_target_elbo": self.reached_epoch}, step=trainer.global_step)
+        if self.stop:
+            trainer.should_stop = True
+
+    def _reached(self, value):
+        return value <= self.target_elbo if self.mode == "min" else value >= self.target_elbo
+
+    def on_train_end(self, trainer, pl_module):
+        if self.reached_epoch is None:
+            print(f"{self.monitor} did not reach the target {self.target_elbo:.4e} "
+                  f"in {trainer.current_epoch} epochs")
+        if self.output_file is None or not trainer.is_global_zero:
+            return
+        with open(self.output_file, "w") as f:
+            json.dump({"target_elbo": self.target_elbo, "epochs_to_target": self.reached_epoch,
+                       "epochs_trained": trainer.current_epoch}, f, indent=2)
+
+    def state_dict(self):
+        return {"reached_epoch": self.reached_epoch}
+
+    def load_state_dict(self, state_dict):
+        self.reached_epoch = state_dict["reached_epoch"]
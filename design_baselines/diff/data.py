@@ -0,0 +1,160 @@
+"""Datasets and samplers used to feed the diffusion trainers."""
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+
+class RvSDataset(Dataset):
+
+    def __init__(self, task, x, y, w=None, device=None, mode='train', x0=None):
+        self.task = task
+        self.device = device
+        self.mode = mode
+        self.x = x
+        self.y = y
+        self.w = w
+        # coupled noise for reflow training of flow-matching models
+        self.x0 = x0
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __getitem__(self, idx):
+        x = torch.tensor(self.x[idx])
+        y = torch.tensor(self.y[idx])
+        if self.w is not None:
+            w = torch.tensor(self.w[idx])
+        else:
+            w = None
+        '''
+        if self.device is not None:
+            x = x.to(self.device)
+            y = y.to(self.device)
+            if w is not None:
+                w = w.to(self.device)
+        '''
+        if w is None:
+            return x, y
+        elif self.x0 is not None:
+            return x, y, w, torch.tensor(self.x0[idx])
+        else:
+            return x, y, w
+
+
+class TensorRvSDataset(Dataset):
+    """
+    Keeps x, y and w (and the reflow noise x0, if any) as one pre-converted tensor.
+    Indexed with a tensor of row indices it returns the whole batch, so paired with
+    `ContiguousBatchSampler` in a `DataLoader(..., batch_size=None)` there is no per-item
+    tensor construction or collate.
+
+    Integer x (the uint8 codes of `load_task_arrays(..., compact=True)`) is kept as its own
+    tensor in its own dtype rather than converted to float32 with the other columns.
+    """
+
+    def __init__(self, task, x, y, w, device=None, mode='train', x0=None):
+        self.task = task
+        self.device = device
+        self.mode = mode
+        self.codes = None
+        if np.issubdtype(x.dtype, np.integer):
+            self.codes = torch.from_numpy(np.ascontiguousarray(x))
+            columns = [y, w] if x0 is None else [y, w, x0]
+        else:
+            columns = [x, y, w] if x0 is None else [x, y, w, x0]
+        self.splits = [c.shape[1] for c in columns]
+        self.data = torch.from_numpy(np.concatenate(columns, axis=1).astype(np.float32))
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        return cls(dataset.task, dataset.x, dataset.y, dataset.w, dataset.device, dataset.mode,
+                   x0=getattr(dataset, 'x0', None))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, idx):
+        columns = tuple(self.data[idx].split(self.splits, dim=1))
+        if self.codes is not None:
+            return (self.codes[idx],) + columns
+        return columns
+
+
+class ContiguousBatchSampler(Sampler):
+    """
+    Yields whole batches as consecutive slices of a (per-epoch) random permutation of the rows.
+
+    With `num_replicas` > 1, every rank draws the same permutation (seeded with `seed` plus the
+    epoch set by `set_epoch`, unless a generator is given), pads it by wrapping around to a multiple
+    of `num_replicas` and keeps every `num_replicas`-th row from `rank` on, as DistributedSampler does.
+    """
+
+    def __init__(self, length, batch_size, shuffle=True, drop_last=False, generator=None,
+                 num_replicas=1, rank=0, seed=0):
+        self.length = length
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = (length + num_replicas - 1) // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _order(self):
+        if self.shuffle:
+            generator = self.generator
+            if generator is None and self.num_replicas > 1:
+                generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.length, generator=generator)
+        else:
+            order = torch.arange(self.length)
+        if self.num_replicas > 1:
+            total = self.num_samples * self.num_replicas
+            order = order[torch.arange(total) % self.length][self.rank::self.num_replicas]
+        return order
+
+    def __iter__(self):
+        order = self._order()
+        for i in range(0, len(self) * self.batch_size, self.batch_size):
+            yield order[i:i + self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+class WeightedBatchSampler(Sampler):
+    """
+    Yields whole batches of row indices drawn with replacement with probability proportional to
+    `weights`, as many per epoch as ContiguousBatchSampler would yield. With the loss weights
+    replaced by their mean, this has the same expected objective as the reweighted loss.
+
+    With `num_replicas` > 1 every rank draws its share of the batches independently, from its own
+    random state.
+    """
+
+    def __init__(self, weights, batch_size, drop_last=False, generator=None, num_replicas=1):
+        self.weights = torch.as_tensor(np.asarray(weights, dtype=np.float64).reshape(-1))
+        self.length = self.weights.shape[0]
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.generator = generator
+        self.num_samples = (self.length + num_replicas - 1) // num_replicas
+
+    def __iter__(self):
+        order = torch.multinomial(self.weights, len(self) * self.batch_size, replacement=True,
+                                  generator=self.generator)
+        for i in range(0, len(self) * self.batch_size, self.batch_size):
+            yield order[i:i + self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,232 @@
+"""Distill a trained DiffusionScore into a narrower score network.
+
+The student is a regular `DiffusionScore` with a smaller ``hidden_size`` trained to match the
+teacher's score over noised designs, diffusion times and labels, so the resulting checkpoint
+loads with ``DiffusionScore.load_from_checkpoint(..., hidden_size=<student width>)``.
+A JSON report compares per-step sampler latency and, with ``--evaluate``, the normalized
+scores of designs edited by the teacher and by the student.
+"""
+import json
+import os
+import time
+
+import configargparse
+
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+
+
+@contextmanager
+def suppress_output():
+    """
+        A context manager that redirects stdout and stderr to devnull
+        https://stackoverflow.com/a/52442331
+    """
+    with open(os.devnull, 'w') as fnull:
+        with redirect_stderr(fnull) as err, redirect_stdout(fnull) as out:
+            yield (err, out)
+
+
+with suppress_output():
+    import design_bench
+
+import numpy as np
+import torch
+
+from nets import DiffusionScore
+from sampling import heun_sampler
+from util import TASKNAME2TASK, configure_gpu, set_seed, save_weights_checkpoint
+
+
+def build_task(taskname, normalise_x, normalise_y):
+    if taskname != 'tf-bind-10':
+        task = design_bench.make(TASKNAME2TASK[taskname])
+    else:
+        task = design_bench.make(TASKNAME2TASK[taskname],
+                                 dataset_kwargs={"max_samples": 30000})
+    if task.is_discrete:
+        task.map_to_logits()
+    if normalise_x:
+        task.map_normalize_x()
+    if normalise_y:
+        task.map_normalize_y()
+    return task
+
+
+def sample_distillation_batch(model, x, y, batch_size, dropout_p):
+    """Noised designs at random times with labels drawn from and beyond the data range."""
+    idx = torch.randint(0, x.size(0), (batch_size,), device=x.device)
+    x0, y0 = x[idx], y[idx].view(-1)
+    t_ = torch.rand(batch_size, 1, device=x.device) * model.T
+    x_t, _, std, _ = model.inf_sde.sample(t_, x0, return_noise=True)
+    # half of the labels are resampled uniformly up to half a range above the data maximum,
+    # since editing conditions on labels larger than anything in the training set
+    y_lo, y_hi = y.min(), y.max() + 0.5 * (y.max() - y.min())
+    y_uniform = y_lo + torch.rand_like(y0) * (y_hi - y_lo)
+    y0 = torch.where(torch.rand_like(y0) < 0.5, y0, y_uniform)
+    # unconditional branch, as seen with classifier-free guidance
+    y0 = y0.masked_fill(torch.rand_like(y0) <= dropout_p, 0.)
+    return x_t, t_, y0, std
+
+
+def distill(teacher, student, x, y, args):
+    optimizer = torch.optim.Adam(student.score_estimator.parameters(), lr=args.learning_rate)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.distill_steps)
+    teacher.eval()
+    for step in range(args.distill_steps):
+        x_t, t_, y0, std = sample_distillation_batch(teacher, x, y, args.batch_size, args.dropout_p)
+        with torch.no_grad():
+            target = teacher.score_estimator(x_t, t_.squeeze(), y0)
+        pred = student.score_estimator(x_t, t_.squeeze(), y0)
+        # same std scaling as in the denoising score matching loss
+        loss = (((pred - target) * std) ** 2).sum(1).mean() / 2
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        scheduler.step()
+        if step % 500 == 0 or step == args.distill_steps - 1:
+            print(f"step {step} distillation loss {loss.item():.4e}")
+    return loss.item()
+
+
+@torch.no_grad()
+def step_latency(model, x, y, gamma, repeats=50):
+    """Median wall time of one reverse-drift evaluation, as paid by every sampler step."""
+    t = torch.rand(x.size(0), 1, device=x.device) * model.T
+    timings = []
+    for _ in range(repeats + 5):
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        model.gen_sde.mu(t, x, y, gamma=gamma)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings[5:]))
+
+
+def normalized_scores(task, taskname, model, x_edit, args):
+    """Edit `x_edit` with `model` as in edit_new.py and return normalized (max, median)."""
+    num_samples = x_edit.size(0)
+    t_ = torch.full((num_samples, 1), args.t, device=x_edit.device)
+    x_hat = model.inf_sde.sample(t_, x_edit)
+    y_ = torch.ones(num_samples, device=x_edit.device) * args.edit_condition
+    xs = heun_sampler(model, x_hat, y_, args.num_steps,
+                      start_step=int(args.num_steps * (1 - args.t)),
+                      gamma=args.gamma, keep_all_samples=False)
+    designs = xs[-1]
+    designs = designs[torch.isfinite(designs).all(dim=1)].numpy()
+    if task.is_discrete:
+        designs = designs.reshape(designs.shape[0], -1, task.x.shape[-1])
+    ys = task.predict(designs)
+    if args.normalise_y:
+        ys = task.denormalize_y(ys)
+    dic2y = np.load("npy/dic2y.npy", allow_pickle=True).item()
+    y_min, y_max = dic2y[TASKNAME2TASK[taskname]]
+    return (float((np.max(ys) - y_min) / (y_max - y_min)),
+            float((np.median(ys) - y_min) / (y_max - y_min)))
+
+
+def run_distillation(args, device):
+    set_seed(args.seed)
+    task = build_task(args.task, args.normalise_x, args.normalise_y)
+    x = task.x
+    if task.is_discrete:
+        x = x.reshape(x.shape[0], -1)
+    x = torch.tensor(x, dtype=torch.float32, device=device)
+    y = torch.tensor(task.y, dtype=torch.float32, device=device)
+
+    model_kwargs = dict(taskname=args.task,
+                        task=task,
+                        learning_rate=args.learning_rate,
+                        vtype=args.vtype,
+                        beta_min=args.beta_min,
+                        beta_max=args.beta_max,
+                        T0=args.T0,
+                        dropout_p=args.dropout_p,
+                        score_arch=args.score_arch)
+    teacher = DiffusionScore.load_from_checkpoint(checkpoint_path=args.teacher_checkpoint_path,
+                                                  hidden_size=args.hidden_size,
+                                                  **model_kwargs).to(device)
+    student = DiffusionScore(hidden_size=args.student_hidden_size, **model_kwargs).to(device)
+
+    final_loss = distill(teacher, student, x, y, args)
+    save_weights_checkpoint(student, args.student_checkpoint_path,
+                            hidden_size=args.student_hidden_size,
+                            teacher_checkpoint_path=args.teacher_checkpoint_path)
+    print(f"Saved student checkpoint to {args.student_checkpoint_path}")
+
+    teacher.eval()
+    student.eval()
+    x_bench = x[:256]
+    y_bench = torch.ones(x_bench.size(0), device=device) * args.edit_condition
+    report = {
+        "task": args.task,
+        "teacher_hidden_size": args.hidden_size,
+        "student_hidden_size": args.student_hidden_size,
+        "teacher_params": sum(p.numel() for p in teacher.score_estimator.parameters()),
+        "student_params": sum(p.numel() for p in student.score_estimator.parameters()),
+        "final_distillation_loss": final_loss,
+        "teacher_step_latency_s": step_latency(teacher, x_bench, y_bench, args.gamma),
+        "student_step_latency_s": step_latency(student, x_bench, y_bench, args.gamma),
+    }
+    report["speedup"] = report["teacher_step_latency_s"] / report["student_step_latency_s"]
+
+    if args.evaluate:
+        target_xy = np.load(f"experiments/{args.task}/{TASKNAME2TASK[args.task]}_pseudo_target_123.npy",
+                            allow_pickle=True).item()
+        x_edit = torch.tensor(np.array(target_xy["x"])[:256], dtype=torch.float32, device=device)
+        for name, model in [("teacher", teacher), ("student", student)]:
+            set_seed(args.seed)
+            max_v, med_v = normalized_scores(task, args.task, model, x_edit, args)
+            report[f"{name}_max_score"] = max_v
+            report[f"{name}_median_score"] = med_v
+
+    print(json.dumps(report, indent=2))
+    with open(args.report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = configargparse.ArgumentParser()
+    parser.add_argument(
+        "--configs",
+        default=None,
+        required=False,
+        is_config_file=True,
+        help="path(s) to configuration file(s)",
+    )
+    parser.add_argument('--task',
+                        choices=list(TASKNAME2TASK.keys()),
+                        default='superconductor',
+                        )
+    parser.add_argument("--seed", default=123, type=int)
+    parser.add_argument("--teacher_checkpoint_path", type=str, required=True)
+    parser.add_argument("--student_checkpoint_path", type=str, required=True)
+    parser.add_argument("--report_path", type=str, default="distill_report.json")
+    parser.add_argument("--hidden_size", type=int, default=1024, help="hidden size of the teacher")
+    parser.add_argument("--student_hidden_size", type=int, default=256)
+    parser.add_argument("--distill_steps", type=int, default=20000)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--learning_rate", type=float, default=1e-3)
+    parser.add_argument("--dropout_p", type=float, default=0.15,
+                        help="fraction of labels replaced by 0 (the unconditional branch)")
+    parser.add_argument('--score_arch', type=str, choices=["mlp", "film"], default="mlp")
+    parser.add_argument('--vtype', type=str, choices=['rademacher', 'gaussian'], default='rademacher')
+    parser.add_argument("--beta_min", type=float, default=0.1)
+    parser.add_argument("--beta_max", type=float, default=20.0)
+    parser.add_argument('--T0', type=float, default=1.0)
+    parser.add_argument("--normalise_x", action="store_true", default=False)
+    parser.add_argument("--normalise_y", action="store_true", default=False)
+    parser.add_argument("--use_gpu", action="store_true", default=False)
+    parser.add_argument("--which_gpu", default=0, type=int)
+    # editing setup used for the latency and score comparison
+    parser.add_argument("--evaluate", action="store_true", default=False,
+                        help="also compare normalized scores of designs edited by teacher and student")
+    parser.add_argument('--num_steps', type=int, default=1000)
+    parser.add_argument('--gamma', type=float, default=1.)
+    parser.add_argument("--t", type=float, default=0.4)
+    parser.add_argument("--edit_condition", type=float, default=1.5)
+    args, _ = parser.parse_known_args()
+
+    device = configure_gpu(args.use_gpu, args.which_gpu)
+    run_distillation(args, device)
@@ -48,8 +48,9 @@ import pickle as pkl
 import torch
 from torch.utils.data import Dataset, DataLoader
 
-from nets import DiffusionTest, DiffusionScore
-from util import TASKNAME2TASK, configure_gpu, set_seed, get_weights
+from nets import DiffusionTest, DiffusionScore, EnsembleDiffusionScore, FlowMatchingScore
+from sampling import heun_sampler, flow_ode_sampler
+from util import TASKNAME2TASK, configure_gpu, set_seed, get_weights, load_task_arrays, load_ema_weights, LogitExpander
 # from forward import ForwardModel
 
 args_filename = "args.json"
@@ -294,14 +295,27 @@ def run_evaluate(
         task = design_bench.make(TASKNAME2TASK[taskname],
                                  dataset_kwargs={"max_samples": 30000})
 
-    if task.is_discrete:
-        task.map_to_logits()
-    if normalise_x:
-        task.map_normalize_x()
-    if normalise_y:
-        task.map_normalize_y()
-
-    if not args.score_matching:
+    compact_x = args.compact_x and task.is_discrete
+    if compact_x:
+        assert args.score_matching and args.objective != 'flow', "--compact_x is only supported by DiffusionScore"
+    task_x, task_y, _ = load_task_arrays(task, taskname, normalise_x, normalise_y,
+                                         temp=args.temp, cache_dir=args.cache_dir, compact=compact_x)
+    # with --compact_x, task_x holds uint8 codes and the logit dataset task.x is never built
+    x_expander = LogitExpander.from_task(task) if compact_x else None
+    design_shape = (x_expander.length, x_expander.logit_dim) if compact_x else task.x.shape[1:]
+
+    if args.objective == 'flow':
+        print("Flow matching")
+        model = FlowMatchingScore.load_from_checkpoint(
+            checkpoint_path=source_checkpoint_path,
+            taskname=taskname,
+            task=task,
+            learning_rate=args.learning_rate,
+            hidden_size=args.hidden_size,
+            T0=args.T0,
+            dropout_p=args.dropout_p,
+            score_arch=args.score_arch)
+    elif not args.score_matching:
         model = DiffusionTest.load_from_checkpoint(
             checkpoint_path=checkpoint_path,
             taskname=taskname,
@@ -325,70 +339,67 @@ def run_evaluate(
             beta_min=args.beta_min,
             beta_max=args.beta_max,
             T0=args.T0,
-            dropout_p=args.dropout_p)
-
-    target_model = DiffusionScore.load_from_checkpoint(
-        checkpoint_path=checkpoint_path,
-        taskname=taskname,
-        task=task,
-        learning_rate=args.learning_rate,
-        hidden_size=args.hidden_size,
-        vtype=args.vtype,
-        beta_min=args.beta_min,
-        beta_max=args.beta_max,
-        T0=args.T0,
-        dropout_p=args.dropout_p)
+            dropout_p=args.dropout_p,
+            score_arch=args.score_arch,
+            x_expander=x_expander)
+    if args.use_ema:
+        load_ema_weights(model, source_checkpoint_path if args.objective == 'flow' or args.score_matching
+                         else checkpoint_path)
+
+    if args.objective == 'flow':
+        target_model = FlowMatchingScore.load_from_checkpoint(
+            checkpoint_path=target_checkpoint_path,
+            taskname=taskname,
+            task=task,
+            learning_rate=args.learning_rate,
+            hidden_size=args.hidden_size,
+            T0=args.T0,
+            dropout_p=args.dropout_p,
+            score_arch=args.score_arch)
+    elif not args.ensemble_checkpoint_paths:
+        target_model = DiffusionScore.load_from_checkpoint(
+            checkpoint_path=checkpoint_path,
+            taskname=taskname,
+            task=task,
+            learning_rate=args.learning_rate,
+            hidden_size=args.hidden_size,
+            vtype=args.vtype,
+            beta_min=args.beta_min,
+            beta_max=args.beta_max,
+            T0=args.T0,
+            dropout_p=args.dropout_p,
+            score_arch=args.score_arch,
+            x_expander=x_expander)
+    else:
+        # average the scores of several target seeds in one vmapped call per step
+        print(f"Using an ensemble of {len(args.ensemble_checkpoint_paths)} target models")
+        members = []
+        for path in args.ensemble_checkpoint_paths:
+            member = DiffusionScore.load_from_checkpoint(
+                checkpoint_path=path,
+                taskname=taskname,
+                task=task,
+                learning_rate=args.learning_rate,
+                hidden_size=args.hidden_size,
+                vtype=args.vtype,
+                beta_min=args.beta_min,
+                beta_max=args.beta_max,
+                T0=args.T0,
+                dropout_p=args.dropout_p,
+                score_arch=args.score_arch,
+                x_expander=x_expander)
+            if args.use_ema:
+                load_ema_weights(member, path)
+            members.append(member)
+        target_model = EnsembleDiffusionScore(members)
+    if args.use_ema and not args.ensemble_checkpoint_paths:
+        load_ema_weights(target_model, target_checkpoint_path if args.objective == 'flow' else checkpoint_path)
 
     model = model.to(device)
     model.eval()
     target_model = target_model.to(device)
     target_model.eval()
 
-    def heun_sampler(sde, x_0, ya, num_steps, start_step=0, end_step=None, lmbd=0., keep_all_samples=True):
-        device = sde.gen_sde.T.device
-        batch_size = x_0.size(0)
-        ndim = x_0.dim() - 1
-        T_ = sde.gen_sde.T.cpu().item()
-        delta = T_ / num_steps
-        ts = torch.linspace(0, 1, num_steps + 1) * T_
-
-        # sample
-        xs = []
-        x_t = x_0.detach().clone().to(device)
-        t = torch.zeros(batch_size, *([1] * ndim), device=device)
-        t_n = torch.zeros(batch_size, *([1] * ndim), device=device)
-
-        if end_step is None:
-            end_step = num_steps
-
-        with torch.no_grad():
-            for i in range(start_step, end_step):
-                t.fill_(ts[i].item())
-                if i < num_steps - 1:
-                    t_n.fill_(ts[i + 1].item())
-                mu = sde.gen_sde.mu(t, x_t, ya, lmbd=lmbd, gamma=args.gamma)
-                sigma = sde.gen_sde.sigma(t, x_t, lmbd=lmbd)
-                x_t = x_t + delta * mu + delta**0.5 * sigma * torch.randn_like(
-                    x_t
-                )  # one step update of Euler Maruyama method with a step size delta
-                # Additional terms for Heun's method
-                if i < num_steps - 1:
-                    mu2 = sde.gen_sde.mu(t_n,
-                                         x_t,
-                                         ya,
-                                         lmbd=lmbd,
-                                         gamma=args.gamma)
-                    sigma2 = sde.gen_sde.sigma(t_n, x_t, lmbd=lmbd)
-                    x_t = x_t + (sigma2 -
-                                 sigma) / 2 * delta**0.5 * torch.randn_like(x_t)
-
-                if keep_all_samples or i == num_steps - 1:
-                    xs.append(x_t.cpu())
-                else:
-                    pass
-        return xs
-
-
     num_steps = args.num_steps
     num_samples = 256
     # num_samples = 10
@@ -414,11 +425,11 @@ def run_evaluate(
     results = []
     for lmbd in lmbds:
         if not task.is_discrete:
-            x_0 = torch.randn(num_samples, task.x.shape[-1],
+            x_0 = torch.randn(num_samples, design_shape[-1],
                               device=device)  # init from prior
         else:
             x_0 = torch.randn(num_samples,
-                              task.x.shape[-1] * task.x.shape[-2],
+                              design_shape[-1] * design_shape[-2],
                               device=device)  # init from prior
 
         print(x_0.shape)
@@ -426,7 +437,16 @@ def run_evaluate(
         # Generate a sample from the source distribution
         y_ = torch.ones(num_samples).to(device) * args.condition
 
-        if not args.edit:
+        if not args.edit and args.objective == 'flow':
+            print("using source flow...")
+            xs_base = flow_ode_sampler(model,
+                                       x_0,
+                                       y_,
+                                       args.flow_num_steps,
+                                       gamma=args.gamma,
+                                       keep_all_samples=False)
+            xs_base = [xs_base[-1].to(device)]
+        elif not args.edit:
             print("using source ddom...")
             xs_base = heun_sampler(model,
                                    x_0,
@@ -435,19 +455,22 @@ def run_evaluate(
                                    start_step=0,
                                    end_step=1000,
                                    lmbd=lmbd,
-                                   keep_all_samples=True)
+                                   gamma=args.gamma,
+                                   keep_all_samples=True,
+                                   checkpoint_every=args.nan_checkpoint_every,
+                                   max_retries=args.nan_max_retries)
             xs_base = [xs_base[-1].to(device)]
         else:
             print("using offline dataset...")
-            task_x = copy.deepcopy(task.x)
-            task_y = copy.deepcopy(task.y)
-            if task.is_discrete:
-                task_x = task_x.reshape(task_x.shape[0], -1)
-            task_x = torch.Tensor(task_x).to(device)
             task_y = torch.Tensor(task_y).to(device)
             index = torch.argsort(-task_y.squeeze())
             index = index[:num_samples]
-            x_0 = copy.deepcopy(task_x[index])
+            if compact_x:
+                # only the selected rows are expanded to logits
+                x_0 = x_expander(torch.from_numpy(np.asarray(task_x[index.cpu().numpy()])).to(device))
+            else:
+                task_x = torch.Tensor(task_x).to(device)
+                x_0 = copy.deepcopy(task_x[index])
             xs_base = [torch.asarray(x_0, device=device)]
 
         # Editing towards the target distribution
@@ -474,16 +497,30 @@ def run_evaluate(
 
         xs_base = [torch.asarray(target_x[:num_samples], device=device)]
         xs_base = xs_base[-1]
-        x_hat, target, std, g = model.gen_sde.base_sde.sample(t_, xs_base, return_noise=True)  # Add noise
-
-        xs = heun_sampler(target_model,
-                          x_hat,
-                          y_,
-                          num_steps,
-                          start_step=int(1000 * (1 - t_prop)),
-                          end_step=1000,
-                          lmbd=lmbd,
-                          keep_all_samples=True)
+        if args.objective == 'flow':
+            # move back along the straight path to time 1 - t and integrate the ODE to the data end
+            x_hat, _ = target_model.flow.interpolate(1 - t_, xs_base)  # Add noise
+            xs = flow_ode_sampler(target_model,
+                                  x_hat,
+                                  y_,
+                                  args.flow_num_steps,
+                                  t_start=1 - t_prop,
+                                  gamma=args.gamma,
+                                  keep_all_samples=True)
+        else:
+            x_hat, target, std, g = model.gen_sde.base_sde.sample(t_, xs_base, return_noise=True)  # Add noise
+
+            xs = heun_sampler(target_model,
+                              x_hat,
+                              y_,
+                              num_steps,
+                              start_step=int(1000 * (1 - t_prop)),
+                              end_step=1000,
+                              lmbd=lmbd,
+                              gamma=args.gamma,
+                              keep_all_samples=True,
+                              checkpoint_every=args.nan_checkpoint_every,
+                              max_retries=args.nan_max_retries)
         if not args.edit:
             xs = [xs_base]
 
@@ -493,13 +530,18 @@ def run_evaluate(
         for qqq in [xs[-1]]:
             ctr += 1
             print(qqq.shape)
-            if not qqq.isnan().any():
+            # drop only the rows that could not be recovered by the sampler
+            finite = torch.isfinite(qqq.view(qqq.size(0), -1)).all(dim=1)
+            if not finite.all():
+                print(f"Dropping {int((~finite).sum())} diverged rows out of {qqq.size(0)}")
+                qqq = qqq[finite]
+            if qqq.size(0) > 0:
                 designs.append(qqq.cpu().numpy())
 
                 if not task.is_discrete:
                     ys = task.predict(qqq.cpu().numpy())
                 else:
-                    qqq = qqq.view(qqq.size(0), -1, task.x.shape[-1])
+                    qqq = qqq.view(qqq.size(0), -1, design_shape[-1])
                     ys = task.predict(qqq.cpu().numpy())
 
                 # pred_ys = pred_model.mlp(qqq)
@@ -533,7 +575,7 @@ def run_evaluate(
                     }, f)
 
             else:
-                print("fuck")
+                print("All rows diverged")
 
     designs = np.concatenate(designs, axis=0)
     results = np.concatenate(results, axis=0)
@@ -572,6 +614,14 @@ if __name__ == "__main__":
     # experiment tracking
     parser.add_argument("--name", type=str, help="Experiment name")
     parser.add_argument("--score_matching", action='store_true', default=False)
+    parser.add_argument("--objective",
+                        choices=['score', 'flow'],
+                        default='score',
+                        help="'flow' edits with rectified-flow (flow matching) models and the ODE sampler")
+    parser.add_argument("--flow_num_steps",
+                        type=int,
+                        default=20,
+                        help="number of ODE steps over the edited interval for flow matching models")
     # training
     train_time_group = parser.add_mutually_exclusive_group(required=False)
     train_time_group.add_argument(
@@ -642,6 +692,18 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="experiments/cache",
+        help="directory for cached preprocessed task arrays; pass an empty string to disable",
+    )
+    parser.add_argument(
+        "--compact_x",
+        action="store_true",
+        default=False,
+        help="keep the designs of a discrete task as uint8 codes and expand only the edited rows to logits",
+    )
 
     # i/o
     parser.add_argument('--dataset',
@@ -721,6 +783,14 @@ if __name__ == "__main__":
         help="dropout probability",
         default=0,
     )
+    parser.add_argument(
+        "--score_arch",
+        type=str,
+        choices=["mlp", "film"],
+        default="mlp",
+        help="score network: 'mlp' concatenates y to the input, 'film' injects y late so "
+             "guided sampling shares one trunk evaluation",
+    )
     parser.add_argument(
         "--beta_min",
         type=float,
@@ -745,6 +815,14 @@ if __name__ == "__main__":
         required=False,
         help="Path to the target model checkpoint",
     )
+    parser.add_argument(
+        "--ensemble_checkpoint_paths",
+        type=str,
+        nargs="+",
+        default=None,
+        help="paths to several target model checkpoints (e.g. one per seed) whose scores "
+             "are averaged during editing instead of using --target_checkpoint_path",
+    )
     parser.add_argument(
         "--save_prefix",
         type=str,
@@ -763,6 +841,24 @@ if __name__ == "__main__":
         default=0.4,
         required=False,
     )
+    parser.add_argument(
+        "--nan_checkpoint_every",
+        type=int,
+        default=50,
+        help="number of sampler steps between state checkpoints used to recover diverged rows",
+    )
+    parser.add_argument(
+        "--nan_max_retries",
+        type=int,
+        default=3,
+        help="how many times a diverged row is re-run from the last checkpoint before it is dropped",
+    )
+    parser.add_argument(
+        "--use_ema",
+        action="store_true",
+        default=False,
+        help="edit with the EMA weights stored by training with --ema_decay",
+    )
     args = parser.parse_args()
 
     wandb_project = "score-matching " if args.score_matching else "sde-flow"
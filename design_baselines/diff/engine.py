@@ -0,0 +1,96 @@
+"""A minimal training loop for small networks, as an alternative to `pl.Trainer`.
+
+The whole training set stays on the device as tensors. Batches are index slices of one
+on-device permutation, and each step is loss, backward, optional clipping and one fused or
+foreach optimizer step, without any hook, logging or progress-bar machinery in between.
+"""
+import time
+
+import torch
+
+
+def make_adam(params, lr, weight_decay=0., decoupled=False, betas=(0.9, 0.999)):
+    """Adam with the fused kernel on CUDA, and the multi-tensor (foreach) one elsewhere and for
+    AdamW, which has no fused kernel in torch 1.13."""
+    params = list(params)
+    cls = torch.optim.AdamW if decoupled else torch.optim.Adam
+    on_cuda = all(p.is_cuda for p in params)
+    kwargs = dict(fused=True) if on_cuda and not decoupled else dict(foreach=True)
+    return cls(params, lr=lr, betas=betas, weight_decay=weight_decay, **kwargs)
+
+
+class LeanTrainer:
+    """
+    loss_fn(batch) returns the scalar loss of a batch (a tuple of tensors sliced from `tensors`).
+    `scheduler` is stepped once per epoch, like the "epoch" interval schedulers of the Lightning modules.
+    on_epoch_end(epoch, train_loss) is called after every epoch and may return True to stop.
+    With `accumulate_grad_batches` > 1, the gradients of that many batches are averaged into one
+    optimizer step, as with the `pl.Trainer` argument of the same name; an epoch ending mid-way
+    steps on the batches it has.
+    """
+
+    def __init__(self, params, loss_fn, optimizer, scheduler=None, grad_clip=None, accumulate_grad_batches=1):
+        self.params = [p for p in params if p.requires_grad]
+        self.loss_fn = loss_fn
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.grad_clip = grad_clip
+        self.accumulate_grad_batches = accumulate_grad_batches
+        self.pending_batches = 0
+        self.epoch = 0
+        self.global_step = 0
+
+    def step(self, batch):
+        loss = self.loss_fn(batch)
+        if self.pending_batches == 0:
+            self.optimizer.zero_grad(set_to_none=True)
+        if self.accumulate_grad_batches > 1:
+            (loss / self.accumulate_grad_batches).backward()
+        else:
+            loss.backward()
+        self.pending_batches += 1
+        if self.pending_batches == self.accumulate_grad_batches:
+            self.optimizer_step()
+        return loss.detach()
+
+    def optimizer_step(self):
+        if self.grad_clip is not None:
+            torch.nn.utils.clip_grad_norm_(self.params, self.grad_clip)
+        self.optimizer.step()
+        self.global_step += 1
+        self.pending_batches = 0
+
+    def fit(self, tensors, batch_size, epochs, on_epoch_start=None, on_epoch_end=None, max_time=None,
+            drop_last=False, weights=None):
+        """With `weights`, each epoch draws `length` rows with replacement proportionally to them
+        instead of a permutation."""
+        device = tensors[0].device
+        length = tensors[0].size(0)
+        start = time.perf_counter()
+        for epoch in range(self.epoch, epochs):
+            self.epoch = epoch
+            if on_epoch_start is not None:
+                on_epoch_start(epoch)
+            if weights is not None:
+                perm = torch.multinomial(weights.reshape(-1), length, replacement=True)
+            else:
+                perm = torch.randperm(length, device=device)
+            if drop_last:
+                perm = perm[:length - length % batch_size]
+            # summed on the device, so there is no host synchronization inside the epoch
+            total_loss = torch.zeros((), device=device)
+            num_batches = 0
+            for idx in perm.split(batch_size):
+                total_loss += self.step(tuple(t[idx] for t in tensors))
+                num_batches += 1
+            if self.pending_batches > 0:
+                self.optimizer_step()
+            if self.scheduler is not None:
+                self.scheduler.step()
+            self.epoch = epoch + 1
+            stop = False
+            if on_epoch_end is not None:
+                stop = on_epoch_end(epoch, (total_loss / max(num_batches, 1)).item())
+            if stop or (max_time is not None and time.perf_counter() - start > max_time):
+                break
+        return self
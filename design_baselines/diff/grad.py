@@ -1,6 +1,9 @@
 import torch.optim as optim
 from my_model import *
 from utils import *
+from util import load_task_arrays, LR_SCALING_RULES, scale_for_batch_size
+from streaming import design_shape
+from engine import LeanTrainer, make_adam
 import design_bench
 import argparse
 import os
@@ -70,14 +73,13 @@ set_seed(123)
 
 
 def train_proxy(args):
-    if args.task != 'TFBind10-Exact-v011':
-        task = design_bench.make(args.task)
-    else:
-        task = design_bench.make(args.task,
-                                 dataset_kwargs={"max_samples": 30000})
+    # the proxy trains on the full dataset, which only --subsample_size shrinks (in load_task_arrays)
+    task = design_bench.make(args.task)
     # task_y0 = task.y
     # task_x, task_y, length = process_data(task, args.task, task_y0)
-    task_x, task_y, length = process_data_new(task, args.task)
+    task_x, task_y, _ = load_task_arrays(task, args.task, normalise_x=True, normalise_y=True,
+                                         cache_dir=args.cache_dir,
+                                         subsample_size=args.subsample_size, subsample_seed=args.subsample_seed)
 
     task_x = torch.Tensor(task_x).to(device)
     task_y = torch.Tensor(task_y).to(device)
@@ -105,19 +107,54 @@ def train_proxy(args):
     valid_logits = task_x
     T = int(train_L / args.bs) + 1
 
+    # learning rate and warmup for the samples of one optimizer step
+    lr, warmup = scale_for_batch_size(args.lr, args.warmup_epochs, args.bs * args.accumulate_grad_batches,
+                                      args.lr_base_batch_size, rule=args.lr_scaling)
+
     # define model
     model = SimpleMLP(task_x.shape[1]).to(device)
     # opt = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
-    opt = optim.AdamW(model.parameters(),
-                      lr=args.lr,
-                      betas=(0.9, 0.999),
-                      weight_decay=args.wd,
-                      )
+    if args.engine == 'lean':
+        opt = make_adam(model.parameters(), lr=lr, weight_decay=args.wd, decoupled=True)
+    else:
+        opt = optim.AdamW(model.parameters(),
+                          lr=lr,
+                          betas=(0.9, 0.999),
+                          weight_decay=args.wd,
+                          )
     # begin training
     best_pcc = -1
+
+    def evaluate(e, train_loss):
+        nonlocal best_pcc
+        with torch.no_grad():
+            valid_preds = model(valid_logits)
+        pcc = compute_pcc(valid_preds.squeeze(), valid_labels.squeeze())
+        # valid_loss = torch.mean(torch.pow(valid_preds.squeeze() - valid_labels.squeeze(),2))
+        # print("epoch {} training loss {} loss {} best loss {}".format(e, tmp_loss/T, valid_loss, best_val))
+        print("\nepoch {} training loss {} pcc {} best pcc {}".format(e, train_loss, pcc, best_pcc))
+        if pcc > best_pcc:
+            best_pcc = pcc
+            # print("epoch {} has the best loss {}".format(e, best_pcc))
+            torch.save(model.state_dict(),
+                       os.path.join(args.store_path, args.task + "_proxy_" + str(args.seed) + ".pt"))
+            # print('pred', valid_preds[0:20])
+
+    if args.engine == 'lean':
+        # same schedule and loss, with on-device batches and a fused/foreach optimizer step
+        engine = LeanTrainer(model.parameters(),
+                             lambda batch: torch.mean(torch.pow(model(batch[0]) - batch[1], 2)),
+                             opt,
+                             accumulate_grad_batches=args.accumulate_grad_batches)
+        engine.fit((train_logits0, train_labels0), args.bs, args.epochs,
+                   on_epoch_start=lambda e: adjust_learning_rate(opt, lr, e, args.epochs, warmup),
+                   on_epoch_end=evaluate)
+        print('SEED', str(args.seed), 'has best pcc', str(best_pcc))
+        return
+
     for e in range(args.epochs):
         # adjust lr
-        adjust_learning_rate(opt, args.lr, e, args.epochs)
+        adjust_learning_rate(opt, lr, e, args.epochs, warmup)
         # random shuffle
         indexs = torch.randperm(train_L)
         train_logits = train_logits0[indexs]
@@ -129,26 +166,19 @@ def train_proxy(args):
             pred = model(x_batch)
             loss = torch.mean(torch.pow(pred - y_batch, 2))
             tmp_loss = tmp_loss + loss.data
-            opt.zero_grad()
-            loss.backward()
-            opt.step()
-        with torch.no_grad():
-            valid_preds = model(valid_logits)
-        pcc = compute_pcc(valid_preds.squeeze(), valid_labels.squeeze())
-        # valid_loss = torch.mean(torch.pow(valid_preds.squeeze() - valid_labels.squeeze(),2))
-        # print("epoch {} training loss {} loss {} best loss {}".format(e, tmp_loss/T, valid_loss, best_val))
-        print("\nepoch {} training loss {} pcc {} best pcc {}".format(e, tmp_loss / T, pcc, best_pcc))
-        if pcc > best_pcc:
-            best_pcc = pcc
-            # print("epoch {} has the best loss {}".format(e, best_pcc))
-            torch.save(model.state_dict(),
-                       os.path.join(args.store_path, args.task + "_proxy_" + str(args.seed) + ".pt"))
-            # print('pred', valid_preds[0:20])
+            # with --accumulate_grad_batches k, one step per k batches on their mean gradient
+            if t % args.accumulate_grad_batches == 0:
+                opt.zero_grad()
+            (loss / args.accumulate_grad_batches).backward()
+            if (t + 1) % args.accumulate_grad_batches == 0 or t == T - 1:
+                opt.step()
+        evaluate(e, tmp_loss / T)
     print('SEED', str(args.seed), 'has best pcc', str(best_pcc))
 
 
 def design_opt(args):
-    if args.task != 'TFBind10-Exact-v0':
+    if args.task != 'TFBind10-Exact-v0' or args.subsample_size is not None:
+        # with --subsample_size, the full dataset is subsampled by load_task_arrays
         task = design_bench.make(args.task)
     else:
         task = design_bench.make(args.task,
@@ -160,7 +190,10 @@ def design_opt(args):
     # load_y(args.task)
     # task_y0 = task.y
     # task_x, task_y, length = process_data(task, args.task, task_y0)
-    task_x, task_y, length = process_data_new(task, args.task)
+    task_x, task_y, _ = load_task_arrays(task, args.task, normalise_x=True, normalise_y=True,
+                                         cache_dir=args.cache_dir,
+                                         subsample_size=args.subsample_size, subsample_seed=args.subsample_seed)
+    length = task_x.shape[0]
     task_x = torch.Tensor(task_x).to(device)
     task_y = torch.Tensor(task_y).to(device)
 
@@ -192,9 +225,11 @@ def design_opt(args):
             torch.load(os.path.join(args.store_path, args.task + "_proxy_" + str(args.seed) + ".pt"),
                        map_location='cuda:0'))
 
+    # task.x would build the whole (mapped) dataset for every candidate
+    shape = design_shape(task)
     for x_i in range(x_init.shape[0]):
         candidate = copy.deepcopy(x_init[x_i:x_i + 1])
-        gt_score_before = task.predict(candidate.cpu().numpy().reshape(1, *task.x.shape[1:]))
+        gt_score_before = task.predict(candidate.cpu().numpy().reshape(1, *shape))
         estimate_score_before = proxy(candidate)
         candidate.requires_grad = True
         candidate_opt = optim.Adam([candidate], lr=args.ft_lr)
@@ -206,7 +241,7 @@ def design_opt(args):
             candidate_opt.zero_grad()
             loss.backward()
             candidate_opt.step()
-        gt_score_after = task.predict(candidate.cpu().detach().numpy().reshape(1, *task.x.shape[1:]))
+        gt_score_after = task.predict(candidate.cpu().detach().numpy().reshape(1, *shape))
         estimate_score_after = proxy(candidate)
         print(f"\nindex: {x_i}")
         # print(f"original design: {x_init[x_i]}")
@@ -274,6 +309,24 @@ if __name__ == "__main__":
     parser.add_argument('--seed2', default=10, type=int)
     parser.add_argument('--seed3', default=100, type=int)
     parser.add_argument('--store_path', default="generated_target_dist/", type=str)
+    parser.add_argument('--engine', choices=['loop', 'lean'], type=str, default='loop',
+                        help="'lean' trains the proxy with engine.LeanTrainer (on-device batches, fused/foreach AdamW)")
+    parser.add_argument('--cache_dir', default="experiments/cache", type=str,
+                        help="directory for cached preprocessed task arrays; pass an empty string to disable")
+    parser.add_argument('--accumulate_grad_batches', default=1, type=int,
+                        help="average the gradients of this many batches of --bs into one optimizer step")
+    parser.add_argument('--lr_scaling', choices=LR_SCALING_RULES, type=str, default='none',
+                        help="scale --lr (and lengthen --warmup_epochs by the same factor) from --lr_base_batch_size "
+                             "to the effective batch size bs * accumulate_grad_batches")
+    parser.add_argument('--lr_base_batch_size', default=128, type=int,
+                        help="batch size that --lr was tuned for")
+    parser.add_argument('--warmup_epochs', default=0, type=int,
+                        help="linear learning rate warmup of the proxy, in epochs")
+    parser.add_argument('--subsample_size', default=None, type=int,
+                        help="train on a score-stratified sample of this many rows of the full dataset "
+                             "(streamed, cached with the arrays) instead of the 30000-row cap of TFBind10")
+    parser.add_argument('--subsample_seed', default=0, type=int,
+                        help="seed of the --subsample_size sample, independent of --seed")
     args = parser.parse_args()
     if args.mode == 'train':
         train_proxy(args)
@@ -0,0 +1,102 @@
+"""Train the source and the target DiffusionScore side by side in one process.
+
+Both models are updated in every step, each on a batch of its own data (offline designs for the
+source, pseudo-target designs for the target), and each writes its checkpoints into its own
+run directory, e.g. wandb/source/files/checkpoints and wandb/target_grad_pred/files/checkpoints,
+where edit_new.py looks for them. The learning rate schedule, t_max and EMA weights follow the
+same options as two separate runs of trainer.run_training.
+"""
+import os
+
+import pytorch_lightning as pl
+import torch
+
+from callbacks import EMACallback
+from nets import DiffusionScore, get_cosine_schedule_with_warmup
+from util import save_weights_checkpoint
+
+ROLES = ("source", "target")
+
+
+class JointDiffusionScore(pl.LightningModule):
+
+    def __init__(self, checkpoint_dirs, filename_prefix, checkpoint_every_n_epochs=None, **model_kwargs):
+        super().__init__()
+        self.source = DiffusionScore(**model_kwargs)
+        self.target = DiffusionScore(**model_kwargs)
+        self.learning_rate = self.source.learning_rate
+        self.warmup_steps = self.source.warmup_steps
+        self.num_training_steps = self.source.num_training_steps
+        self.checkpoint_dirs = checkpoint_dirs
+        self.filename_prefix = filename_prefix
+        self.checkpoint_every_n_epochs = checkpoint_every_n_epochs
+        self.best = {role: (None, None) for role in ROLES}
+
+    def configure_optimizers(self):
+        # Adam is elementwise, so one optimizer over both models equals one per model
+        optimizer = torch.optim.Adam(params=self.parameters(),
+                                     lr=self.learning_rate)
+        lr_scheduler = get_cosine_schedule_with_warmup(
+            optimizer=optimizer,
+            num_warmup_steps=self.warmup_steps,
+            num_training_steps=self.num_training_steps,
+        )
+        scheduler = {"scheduler": lr_scheduler, "interval": "epoch"}
+        return [optimizer], [scheduler]
+
+    def training_step(self, batch, batch_idx):
+        # batch: {"source": (x, y, w), "target": (x, y, w)}
+        losses = {role: getattr(self, role).loss(batch[role]) for role in ROLES}
+        for role, loss in losses.items():
+            self.log(f"{role}/train_loss", loss, prog_bar=True)
+        return sum(losses.values())
+
+    def validation_step(self, batch, batch_idx, dataloader_idx=0):
+        role = ROLES[dataloader_idx]
+        model = getattr(self, role)
+        x, y, w = batch
+        probes = model.validation_probes(x, batch_idx) if model.val_fixed_probes else {}
+        loss = model.gen_sde.elbo_random_t_slice(x, y, div=model.val_div, **probes)
+        self.log(f"{role}/elbo_estimator", loss.mean(), prog_bar=True, add_dataloader_idx=False)
+        return loss
+
+    def ema_checkpoint_entries(self, role):
+        """The EMA weights of one model, as EMACallback stores them in the checkpoint of a single run."""
+        for callback in self.trainer.callbacks:
+            if isinstance(callback, EMACallback) and callback.ema is not None and callback.ema.shadow_params:
+                prefix = f"{role}."
+                state = {name[len(prefix):]: shadow for name, shadow in callback.ema.state_dict().items()
+                         if name.startswith(prefix)}
+                return {"ema_state_dict": state, "ema_decay": callback.decay}
+        return {}
+
+    def save_role_checkpoint(self, role, filename):
+        save_weights_checkpoint(getattr(self, role), os.path.join(self.checkpoint_dirs[role], filename),
+                                epoch=self.current_epoch, global_step=self.global_step,
+                                **self.ema_checkpoint_entries(role))
+
+    def on_validation_end(self):
+        # the epoch-level ELBO reaches callback_metrics only after on_validation_epoch_end
+        if self.trainer.sanity_checking or not self.trainer.is_global_zero:
+            return
+        # keep the checkpoint with the best ELBO estimate per model, as ModelCheckpoint(save_top_k=1) does
+        for role in ROLES:
+            metric = self.trainer.callback_metrics.get(f"{role}/elbo_estimator")
+            if metric is None:
+                continue
+            best_value, best_file = self.best[role]
+            if best_value is None or metric < best_value:
+                filename = f"{self.filename_prefix}-epoch={self.current_epoch:03d}-elbo_estimator={metric:.4e}.ckpt"
+                self.save_role_checkpoint(role, filename)
+                if best_file is not None:
+                    os.remove(os.path.join(self.checkpoint_dirs[role], best_file))
+                self.best[role] = (metric.item(), filename)
+
+    def on_train_epoch_end(self):
+        if not self.trainer.is_global_zero:
+            return
+        every = self.checkpoint_every_n_epochs
+        for role in ROLES:
+            if every and (self.current_epoch + 1) % every == 0:
+                self.save_role_checkpoint(role, f"{self.filename_prefix}-epoch={self.current_epoch:03d}.ckpt")
+            self.save_role_checkpoint(role, "last.ckpt")
@@ -0,0 +1,41 @@
+import torch
+
+
+class RectifiedFlow(torch.nn.Module):
+    """
+    Conditional flow matching with straight (rectified) paths between noise and data
+    x_t = t * x_1 + (1 - t) * x_0,  x_0 ~ N(0, I),  dx_t/dt = x_1 - x_0
+    See Liu et al. 2023 (https://openreview.net/forum?id=XVjTT1nw5z) and
+    Lipman et al. 2023 (https://openreview.net/forum?id=PqvMRDCJT9t)
+    (time runs from noise at t=0 to data at t=1)
+    """
+
+    def __init__(self, velocity, T=1.0):
+        super().__init__()
+        self.v = velocity
+        self.T = T
+
+    def interpolate(self, t, x1, x0=None):
+        """
+        sample x_t on the straight path between x0 and x1, drawing x0 ~ N(0, I) if not given
+        """
+        if x0 is None:
+            x0 = torch.randn_like(x1)
+        return t * x1 + (1. - t) * x0, x0
+
+    # Velocity with classifier-free guidance
+    def drift(self, t, x, ya, gamma=0.):
+        if hasattr(self.v, 'forward_guided'):
+            return self.v.forward_guided(x, t.squeeze(), ya, gamma)
+        return self.v(x, t.squeeze(), ya) * (1 + gamma) - gamma * self.v(x, t.squeeze(), torch.zeros_like(ya))
+
+    @torch.enable_grad()
+    def fm_weighted(self, x, y, w, x0=None):
+        """
+        weighted flow matching loss; x0 can be given to train on coupled (noise, data) pairs for reflow
+        """
+        t_ = torch.rand([x.size(0), ] + [1 for _ in range(x.ndim - 1)]).to(x)
+        x_t, x0 = self.interpolate(t_, x, x0)
+        v = self.v(x_t, t_.squeeze(), y)
+
+        return (w * ((v - (x - x0)) ** 2)).view(x.size(0), -1).sum(1, keepdim=False) / 2
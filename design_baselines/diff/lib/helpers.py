@@ -65,24 +65,31 @@ class ExponentialMovingAverage(object):
 
     def __init__(self, module, decay=0.999):
         """Initializes the model when .apply() is called the first time.
-        This is to take into account data-dependent initialization that occurs in the first iteration."""
+        This is to take into account data-dependent initialization that occurs in the first iteration.
+        Updates and swaps act on all parameters at once with multi-tensor (foreach) kernels."""
         self.module = module
         self.decay = decay
         self.shadow_params = {}
         self.nparams = sum(p.numel() for p in module.parameters())
+        self._names, self._params = zip(*module.named_parameters())
 
     def init(self):
-        for name, param in self.module.named_parameters():
+        for name, param in zip(self._names, self._params):
             self.shadow_params[name] = param.data.clone()
 
+    def _shadow_list(self):
+        return [self.shadow_params[name] for name in self._names]
+
     def apply(self, decay=None):
         decay = self.decay if decay is None else decay
         if len(self.shadow_params) == 0:
             self.init()
         else:
             with torch.no_grad():
-                for name, param in self.module.named_parameters():
-                    self.shadow_params[name] -= (1 - decay) * (self.shadow_params[name] - param.data)
+                # shadow <- decay * shadow + (1 - decay) * param, one kernel launch per op for all tensors
+                shadow = self._shadow_list()
+                torch._foreach_mul_(shadow, decay)
+                torch._foreach_add_(shadow, [p.data for p in self._params], alpha=1 - decay)
 
     def set(self, other_ema):
         self.init()
@@ -91,14 +98,20 @@ class ExponentialMovingAverage(object):
                 self.shadow_params[name].copy_(param)
 
     def replace_with_ema(self):
-        for name, param in self.module.named_parameters():
-            param.data.copy_(self.shadow_params[name])
+        with torch.no_grad():
+            for param, shadow in zip(self._params, self._shadow_list()):
+                param.data.copy_(shadow)
 
     def swap(self):
-        for name, param in self.module.named_parameters():
-            tmp = self.shadow_params[name].clone()
-            self.shadow_params[name].copy_(param.data)
-            param.data.copy_(tmp)
+        # exchanges the storages instead of copying, so swapping twice is free and exact
+        for name, param in zip(self._names, self._params):
+            param.data, self.shadow_params[name] = self.shadow_params[name], param.data
+
+    def state_dict(self):
+        return {name: shadow.detach().cpu() for name, shadow in self.shadow_params.items()}
+
+    def load_state_dict(self, state_dict):
+        self.shadow_params = {name: state_dict[name].to(param) for name, param in zip(self._names, self._params)}
 
     def __repr__(self):
         return (
@@ -6,6 +6,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 # noinspection PyProtectedMember
 from torch.nn.init import _calculate_fan_in_and_fan_out
 
@@ -288,6 +289,7 @@ class UNet(nn.Module):
                  resamp_with_conv=True,
                  act=Swish(),
                  normalize=group_norm,
+                 checkpoint_blocks=False,
                  ):
         super().__init__()
         self.input_channels = input_channels
@@ -301,6 +303,8 @@ class UNet(nn.Module):
         self.resamp_with_conv = resamp_with_conv
         self.act = act
         self.normalize = normalize
+        # in training, recompute the activations inside each residual/attention block in the backward pass
+        self.checkpoint_blocks = checkpoint_blocks
 
         # init
         self.num_resolutions = num_resolutions = len(ch_mult)
@@ -395,10 +399,14 @@ class UNet(nn.Module):
             conv2d(in_ch, output_channels, init_scale=0.),
         )
 
-    # noinspection PyMethodMayBeStatic
+    def _block(self, module, x, temb):
+        if self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+            return checkpoint(module, x, temb, preserve_rng_state=True)
+        return module(x, temb)
+
     def _compute_cond_module(self, module, x, temp):
         for m in module:
-            x = m(x, temp)
+            x = self._block(m, x, temp)
         return x
 
     # noinspection PyArgumentList,PyShadowingNames
@@ -417,10 +425,10 @@ class UNet(nn.Module):
             block_modules = self.down_modules[i_level]
             for i_block in range(self.num_res_blocks):
                 resnet_block = block_modules['{}a_{}a_block'.format(i_level, i_block)]
-                h = resnet_block(hs[-1], temb)
+                h = self._block(resnet_block, hs[-1], temb)
                 if h.size(2) in self.attn_resolutions:
                     attn_block = block_modules['{}a_{}b_attn'.format(i_level, i_block)]
-                    h = attn_block(h, temb)
+                    h = self._block(attn_block, h, temb)
                 hs.append(h)
             # Downsample
             if i_level != self.num_resolutions - 1:
@@ -437,10 +445,10 @@ class UNet(nn.Module):
             block_modules = self.up_modules[i_idx]
             for i_block in range(self.num_res_blocks + 1):
                 resnet_block = block_modules['{}a_{}a_block'.format(i_level, i_block)]
-                h = resnet_block(torch.cat([h, hs.pop()], axis=1), temb)
+                h = self._block(resnet_block, torch.cat([h, hs.pop()], axis=1), temb)
                 if h.size(2) in self.attn_resolutions:
                     attn_block = block_modules['{}a_{}b_attn'.format(i_level, i_block)]
-                    h = attn_block(h, temb)
+                    h = self._block(attn_block, h, temb)
             # Upsample
             if i_level != 0:
                 upsample = block_modules['{}b_upsample'.format(i_level)]
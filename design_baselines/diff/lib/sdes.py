@@ -1,6 +1,8 @@
+import functorch
 import torch
-from lib.utils import sample_v, log_normal, sample_vp_truncated_q
+from lib.utils import sample_v, log_normal, sample_vp_truncated_q, sample_u
 import numpy as np
+from torch.quasirandom import SobolEngine
 
 
 class VariancePreservingSDE(torch.nn.Module):
@@ -31,27 +33,30 @@ class VariancePreservingSDE(torch.nn.Module):
         beta_t = self.beta(t)
         return torch.ones_like(y) * beta_t**0.5
 
-    def sample(self, t, y0, return_noise=False):
+    def sample(self, t, y0, return_noise=False, epsilon=None):
         """
         sample yt | y0
         if return_noise=True, also return std and g for reweighting the denoising score matching loss
+        epsilon optionally fixes the standard normal noise
         """
         mu = self.mean_weight(t) * y0
         std = self.var(t) ** 0.5
-        epsilon = torch.randn_like(y0)
+        if epsilon is None:
+            epsilon = torch.randn_like(y0)
         yt = epsilon * std + mu
         if not return_noise:
             return yt
         else:
             return yt, epsilon, std, self.g(t, yt)
 
-    def sample_debiasing_t(self, shape):
+    def sample_debiasing_t(self, shape, u=None):
         """
         non-uniform sampling of t to debias the weight std^2/g^2
         the sampling distribution is proportional to g^2/std^2 for t >= t_epsilon
         for t < t_epsilon, it's truncated
+        u optionally gives the uniform points pushed through the inverse CDF
         """
-        return sample_vp_truncated_q(shape, self.beta_min, self.beta_max, t_epsilon=self.t_epsilon, T=self.T)
+        return sample_vp_truncated_q(shape, self.beta_min, self.beta_max, t_epsilon=self.t_epsilon, T=self.T, u=u)
 
 
 class ScorePluginReverseSDE(torch.nn.Module):
@@ -62,17 +67,31 @@ class ScorePluginReverseSDE(torch.nn.Module):
     (time is inverted)
     """
 
-    def __init__(self, base_sde, drift_a, T, vtype='rademacher', debias=False):
+    def __init__(self, base_sde, drift_a, T, vtype='rademacher', debias=False, t_sampler='uniform',
+                 t_max=None, t_max_mix=0.):
         super().__init__()
         self.base_sde = base_sde
         self.a = drift_a
         self.T = T
         self.vtype = vtype
         self.debias = debias
+        self.t_sampler = t_sampler
+        self.sobol_engine = None
+        if t_sampler == 'sobol':
+            # the scrambling is seeded from the torch RNG, so it is reproducible under set_seed
+            self.sobol_engine = SobolEngine(1, scramble=True, seed=int(torch.randint(2 ** 31, (1,))))
+        # train on diffusion times in [0, t_max] only, e.g. the range an edit from t_max down to 0 uses;
+        # a t_max_mix fraction of the times is still drawn from the whole [0, T]
+        self.t_max = t_max
+        self.t_max_mix = t_max_mix
 
     # Drift
     def mu(self, t, y, ya, lmbd=0., gamma=0.):
-        a = self.a(y, self.T - t.squeeze(), ya) * (1 + gamma) - gamma * self.a(y, self.T - t.squeeze(), torch.zeros_like(ya))
+        if hasattr(self.a, 'forward_guided'):
+            # networks that inject ya late share one trunk evaluation between both branches
+            a = self.a.forward_guided(y, self.T - t.squeeze(), ya, gamma)
+        else:
+            a = self.a(y, self.T - t.squeeze(), ya) * (1 + gamma) - gamma * self.a(y, self.T - t.squeeze(), torch.zeros_like(ya))
         return (1. - 0.5 * lmbd) * (self.base_sde.g(self.T-t, y) ** 2) *  a - \
                self.base_sde.f(self.T - t, y)
 
@@ -80,65 +99,92 @@ class ScorePluginReverseSDE(torch.nn.Module):
     def sigma(self, t, y, lmbd=0.):
         return (1. - lmbd) ** 0.5 * self.base_sde.g(self.T-t, y)
 
+    def sample_t(self, x):
+        """
+        diffusion times for the rows of x, drawn with `t_sampler` (see lib.utils.sample_u)
+        """
+        shape = [x.size(0), ] + [1 for _ in range(x.ndim - 1)]
+        u = sample_u(x.size(0), self.t_sampler, self.sobol_engine).view(shape)
+        if self.debias:
+            return self.base_sde.sample_debiasing_t(shape, u=u)
+        if self.t_max is not None:
+            scale = torch.full(shape, self.t_max).to(x)
+            if self.t_max_mix > 0:
+                full = torch.rand(shape).to(x) < self.t_max_mix
+                scale = torch.where(full, self.T.to(x).expand_as(scale), scale)
+            return u.to(x) * scale
+        return u.to(x) * self.T
+
     @torch.enable_grad()
     def dsm(self, x, y):
         """
         denoising score matching loss
         """
-        if self.debias:
-            t_ = self.base_sde.sample_debiasing_t([x.size(0), ] + [1 for _ in range(x.ndim - 1)])
-        else:
-            t_ = torch.rand([x.size(0), ] + [1 for _ in range(x.ndim - 1)]).to(x) * self.T
+        t_ = self.sample_t(x)
         x_hat, target, std, g = self.base_sde.sample(t_, x, return_noise=True)
         a = self.a(x_hat, t_.squeeze(), y)
 
         return ((a * std + target) ** 2).view(x.size(0), -1).sum(1, keepdim=False) / 2
 
-    @torch.enable_grad()
-    def dsm_weighted(self, x, y, w, clip=False, c_min=None, c_max=None):
+    def sample_dsm(self, x, clip=False, c_min=None, c_max=None):
         """
-        denoising score matching loss
+        diffusion times, perturbed inputs, noise targets and stds of the denoising score matching loss
         """
-        if self.debias:
-            t_ = self.base_sde.sample_debiasing_t([x.size(0), ] + [1 for _ in range(x.ndim - 1)])
-        else:
-            t_ = torch.rand([x.size(0), ] + [1 for _ in range(x.ndim - 1)]).to(x) * self.T
+        t_ = self.sample_t(x)
         x_hat, target, std, g = self.base_sde.sample(t_, x, return_noise=True)
 
         if clip:
-            c_min = c_min.repeat((x.size(0),1))
-            c_max = c_max.repeat((x.size(0),1))
-            c_min = c_min.cuda()
-            c_max = c_max.cuda()
-            x_hat = x_hat.cuda()
+            c_min = c_min.repeat((x.size(0),1)).to(x_hat)
+            c_max = c_max.repeat((x.size(0),1)).to(x_hat)
 
             x_hat = torch.clip(x_hat, min=c_min, max=c_max)
+        return t_, x_hat, target, std
 
+    @torch.enable_grad()
+    def dsm_weighted(self, x, y, w, clip=False, c_min=None, c_max=None):
+        """
+        denoising score matching loss
+        """
+        t_, x_hat, target, std = self.sample_dsm(x, clip=clip, c_min=c_min, c_max=c_max)
         a = self.a(x_hat, t_.squeeze(), y)
 
         return (w * ((a * std + target) ** 2)).view(x.size(0), -1).sum(1, keepdim=False) / 2
 
     @torch.enable_grad()
-    def elbo_random_t_slice(self, x, y_n):
+    def elbo_random_t_slice(self, x, y_n, t_=None, v=None, epsilon=None, epsilon_T=None, div='hutchinson'):
         """
         estimating the ELBO of the plug-in reverse SDE by sampling t uniformly between [0, T], and by estimating
         div(mu) using the Hutchinson trace estimator
+        t_, v, epsilon and epsilon_T optionally fix the time, the probe vector and the noises, e.g. to compare
+        the estimate across epochs with the same draws
+        div='jvp' computes the probe product with forward-mode AD instead of a backward pass
+        with t_max, t is sampled in [0, t_max] and the estimate only covers that part of the time range
         """
-        t_ = torch.rand([x.size(0), ] + [1 for _ in range(x.ndim - 1)]).to(x) * self.T
-        qt = 1 / self.T
-        y = self.base_sde.sample(t_, x).requires_grad_()
+        t_range = self.T if self.t_max is None else self.t_max
+        if t_ is None:
+            t_ = torch.rand([x.size(0), ] + [1 for _ in range(x.ndim - 1)]).to(x) * t_range
+        qt = 1 / t_range
+        y = self.base_sde.sample(t_, x, epsilon=epsilon)
+        if v is None:
+            v = sample_v(x.shape, vtype=self.vtype).to(y)
+
+        def drift(y):
+            a = self.base_sde.g(t_, y) * self.a(y, t_.squeeze(), y_n)
+            return self.base_sde.g(t_, y) * a - self.base_sde.f(t_, y), a
+
+        if div == 'jvp':
+            _, Jv, a = functorch.jvp(drift, (y,), (v,), has_aux=True)
+        elif div == 'hutchinson':
+            y = y.requires_grad_()
+            mu, a = drift(y)
+            Jv = torch.autograd.grad(mu, y, v, create_graph=self.training)[0]
+        else:
+            raise Exception(f'div {div} not supported')
 
-        a = self.base_sde.g(t_, y) * self.a(y, t_.squeeze(), y_n)
-        mu = self.base_sde.g(t_, y) * a - self.base_sde.f(t_, y)
-
-        v = sample_v(x.shape, vtype=self.vtype).to(y)
-
-        Mu = - (
-              torch.autograd.grad(mu, y, v, create_graph=self.training)[0] * v
-        ).view(x.size(0), -1).sum(1, keepdim=False) / qt
+        Mu = - (Jv * v).view(x.size(0), -1).sum(1, keepdim=False) / qt
 
         Nu = - (a ** 2).view(x.size(0), -1).sum(1, keepdim=False) / 2 / qt
-        yT = self.base_sde.sample(torch.ones_like(t_) * self.base_sde.T, x)
+        yT = self.base_sde.sample(torch.ones_like(t_) * self.base_sde.T, x, epsilon=epsilon_T)
         lp = log_normal(yT, torch.zeros_like(yT), torch.zeros_like(yT)).view(x.size(0), -1).sum(1)
 
         return lp + Mu + Nu
@@ -195,11 +241,8 @@ class PluginReverseSDE(torch.nn.Module):
         x_hat, target, std, g = self.base_sde.sample(t_, x, return_noise=True)
 
         if clip:
-            c_min = c_min.repeat((x.size(0),1))
-            c_max = c_max.repeat((x.size(0),1))
-            c_min = c_min.cuda()
-            c_max = c_max.cuda()
-            x_hat = x_hat.cuda()
+            c_min = c_min.repeat((x.size(0),1)).to(x_hat)
+            c_max = c_max.repeat((x.size(0),1)).to(x_hat)
 
             x_hat = torch.clip(x_hat, min=c_min, max=c_max)
 
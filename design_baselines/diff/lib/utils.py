@@ -23,6 +23,31 @@ def sample_v(shape, vtype='rademacher'):
         Exception(f'vtype {vtype} not supported')
 
 
+T_SAMPLERS = ['uniform', 'stratified', 'antithetic', 'sobol']
+
+
+def sample_u(n, t_sampler='uniform', sobol_engine=None):
+    """
+    n points in [0, 1) used to draw the diffusion times of one minibatch
+    uniform:    i.i.d. U(0, 1)
+    stratified: one point in each of the n strata [i/n, (i+1)/n), in random order
+    antithetic: pairs (u, 1 - u)
+    sobol:      the next n points of a scrambled Sobol sequence (`sobol_engine`)
+    all of them are marginally U(0, 1), so the loss stays unbiased, but cover [0, 1) more evenly
+    """
+    if t_sampler == 'uniform':
+        return torch.rand(n)
+    elif t_sampler == 'stratified':
+        return ((torch.arange(n) + torch.rand(n)) / n)[torch.randperm(n)]
+    elif t_sampler == 'antithetic':
+        u = torch.rand((n + 1) // 2)
+        return torch.cat([u, 1. - u])[:n][torch.randperm(n)]
+    elif t_sampler == 'sobol':
+        return sobol_engine.draw(n).view(-1)
+    else:
+        raise Exception(f't_sampler {t_sampler} not supported')
+
+
 Log2PI = float(np.log(2 * np.pi))
 
 
@@ -204,9 +229,11 @@ class VariancePreservingTruncatedSampling:
 
 
 # noinspection PyUnusedLocal
-def sample_vp_truncated_q(shape, beta_min, beta_max, t_epsilon, T):
+def sample_vp_truncated_q(shape, beta_min, beta_max, t_epsilon, T, u=None):
     if isinstance(T, float) or isinstance(T, int):
         T = torch.Tensor([T]).float()
-    u = torch.rand(*shape).to(T)
+    if u is None:
+        u = torch.rand(*shape)
+    u = u.to(T)
     vpsde = VariancePreservingTruncatedSampling(beta_min=0.1, beta_max=20., t_epsilon=t_epsilon)
     return vpsde.inv_Phi(u.view(-1), T).view(*shape)
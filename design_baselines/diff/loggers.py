@@ -0,0 +1,120 @@
+"""An offline drop-in for WandbLogger that writes metrics to a local CSV file."""
+import datetime
+import json
+import os
+import threading
+import uuid
+
+from argparse import Namespace
+
+from pytorch_lightning.loggers import Logger
+from pytorch_lightning.loggers.logger import rank_zero_experiment
+from pytorch_lightning.utilities import rank_zero_only
+
+
+class LocalRun:
+    """The attributes of `WandbLogger.experiment` that trainer.py uses."""
+
+    def __init__(self, project, name, save_dir):
+        self.project = project
+        self.name = name
+        self.entity = None
+        self.id = uuid.uuid4().hex[:8]
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        # same layout as wandb: <save_dir>/wandb/run-<time>-<id>/files, plus a latest-run link
+        self.run_dir = os.path.join(save_dir, "wandb", f"run-{stamp}-{self.id}")
+        self.dir = os.path.join(self.run_dir, "files")
+        self.path = f"local/{project}/{self.id}"
+
+
+class LocalLogger(Logger):
+    """
+    Buffers metrics in memory and appends them to <run>/files/metrics.csv (one `step,name,value,time`
+    row per value) from a background thread every `flush_secs` seconds, so training never waits on I/O.
+    Hyperparameters go to <run>/files/hparams.json.
+    """
+
+    def __init__(self, project, name, save_dir, flush_secs=30):
+        super().__init__()
+        self._project = project
+        self._name = name
+        self._save_dir = save_dir
+        self.flush_secs = flush_secs
+        self._experiment = None
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def version(self):
+        return self.experiment.id
+
+    @property
+    def save_dir(self):
+        return self._save_dir
+
+    @property
+    def log_dir(self):
+        return self.experiment.dir
+
+    @property
+    @rank_zero_experiment
+    def experiment(self):
+        if self._experiment is None:
+            self._experiment = LocalRun(self._project, self._name, self._save_dir)
+            os.makedirs(self._experiment.dir, exist_ok=True)
+            latest = os.path.join(self._save_dir, "wandb", "latest-run")
+            if os.path.lexists(latest):
+                os.remove(latest)
+            os.symlink(os.path.basename(self._experiment.run_dir), latest)
+            self.metrics_file = os.path.join(self._experiment.dir, "metrics.csv")
+            with open(self.metrics_file, "w") as f:
+                f.write("step,name,value,time\n")
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+        return self._experiment
+
+    @rank_zero_only
+    def log_hyperparams(self, params):
+        if isinstance(params, Namespace):
+            params = vars(params)
+        with open(os.path.join(self.experiment.dir, "hparams.json"), "w") as f:
+            json.dump(dict(params), f, indent=2, default=str)
+
+    @rank_zero_only
+    def log_metrics(self, metrics, step=None):
+        _ = self.experiment  # creates the run directory and starts the flusher on first use
+        now = datetime.datetime.now().timestamp()
+        rows = [(step, k, float(v), now) for k, v in metrics.items()]
+        with self._lock:
+            self._buffer.extend(rows)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_secs):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if rows:
+            with open(self.metrics_file, "a") as f:
+                f.writelines(f"{'' if s is None else s},{k},{v:.8g},{t:.3f}\n" for s, k, v, t in rows)
+
+    @rank_zero_only
+    def save(self):
+        super().save()
+
+    @rank_zero_only
+    def finalize(self, status):
+        if self._experiment is None:
+            return
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
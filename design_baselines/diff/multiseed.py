@@ -0,0 +1,173 @@
+"""Train several independently seeded DiffusionScore models in one process.
+
+The K score networks are stacked into one set of parameters and trained with a single vmapped
+forward and backward per step. Every seed keeps the initialization and data split of its own
+run, and draws its diffusion times and noise as `DiffusionScore.loss` does, with the same
+hyperparameters. The batch order comes from a per-seed sampler and the noise from the global
+generator, so the runs are statistically equivalent to K separate ones but not identical to
+them.
+
+Each seed is validated on its own held-out split with the ELBO estimate of a single run, and
+writes the best, the periodic and the last checkpoint into its own run directory, as
+`trainer.run_training` does for that seed.
+"""
+import functools
+import os
+
+import pytorch_lightning as pl
+import torch
+
+from data import TensorRvSDataset, ContiguousBatchSampler
+from lib.sdes import ScorePluginReverseSDE
+from nets import DiffusionScore, StackedScoreEstimator, get_cosine_schedule_with_warmup
+from util import set_seed, save_weights_checkpoint
+
+
+class StackedBatchLoader:
+    """Iterates one (dataset, sampler) pair per seed in lockstep and stacks their batches
+    along a new leading seed dimension. Each sampler shuffles with its own generator."""
+
+    def __init__(self, datasets, batch_size, seeds):
+        lengths = {len(d) for d in datasets}
+        assert len(lengths) == 1, f"all seeds need training sets of equal size, got {lengths}"
+        self.datasets = [TensorRvSDataset.from_dataset(d) for d in datasets]
+        self.samplers = [ContiguousBatchSampler(len(d), batch_size,
+                                                generator=torch.Generator().manual_seed(seed))
+                         for d, seed in zip(self.datasets, seeds)]
+
+    def __len__(self):
+        return len(self.samplers[0])
+
+    def __iter__(self):
+        for idx in zip(*self.samplers):
+            batches = [d[i] for d, i in zip(self.datasets, idx)]
+            yield tuple(torch.stack(parts) for parts in zip(*batches))
+
+
+class MultiSeedDiffusionScore(pl.LightningModule):
+
+    def __init__(self, seeds, checkpoint_dirs, filename_prefixes, checkpoint_every_n_epochs=None, seed_loggers=None,
+                 **model_kwargs):
+        super().__init__()
+        self.seeds = list(seeds)
+        self.checkpoint_dirs = checkpoint_dirs
+        self.filename_prefixes = filename_prefixes
+        self.checkpoint_every_n_epochs = checkpoint_every_n_epochs
+        # per-seed loggers of the seeds' own run directories, for their validation metrics
+        self.seed_loggers = seed_loggers
+        self.best = [(None, None) for _ in self.seeds]
+        # one DiffusionScore per seed, initialized exactly as a single-seed run would be;
+        # kept outside the module tree and only used as templates for per-seed checkpoints
+        models = []
+        for seed in self.seeds:
+            set_seed(seed)
+            models.append(DiffusionScore(**model_kwargs))
+        self.models = models
+        ref = models[0]
+        self.learning_rate = ref.learning_rate
+        self.warmup_steps = ref.warmup_steps
+        self.num_training_steps = ref.num_training_steps
+        self.dropout_p = ref.dropout_p
+        self.simple_clip = ref.simple_clip
+        self.clip_min = ref.clip_min
+        self.clip_max = ref.clip_max
+        self.inf_sde = ref.inf_sde
+        self.T = ref.T
+        self.score_estimator = StackedScoreEstimator([m.score_estimator for m in models], trainable=True)
+        # samples the times and perturbations of the loss exactly as the single-seed model does
+        self.gen_sde = ScorePluginReverseSDE(self.inf_sde,
+                                             self.score_estimator,
+                                             self.T,
+                                             vtype=ref.vtype,
+                                             debias=ref.debias,
+                                             t_sampler=ref.t_sampler,
+                                             t_max=ref.t_max,
+                                             t_max_mix=ref.t_max_mix)
+        # the reverse SDE of each seed alone, for its validation ELBO; a plain list, as they share
+        # all of their state with the modules above
+        self.seed_sdes = [ScorePluginReverseSDE(self.inf_sde,
+                                                functools.partial(self.score_estimator.forward_member, k),
+                                                self.T,
+                                                vtype=ref.vtype,
+                                                t_max=ref.t_max)
+                          for k in range(len(self.seeds))]
+
+    def configure_optimizers(self):
+        # Adam is elementwise, so one optimizer over the stacked weights equals K separate ones
+        optimizer = torch.optim.Adam(params=self.score_estimator.parameters(),
+                                     lr=self.learning_rate)
+        lr_scheduler = get_cosine_schedule_with_warmup(
+            optimizer=optimizer,
+            num_warmup_steps=self.warmup_steps,
+            num_training_steps=self.num_training_steps,
+        )
+        scheduler = {"scheduler": lr_scheduler, "interval": "epoch"}
+        return [optimizer], [scheduler]
+
+    def training_step(self, batch, batch_idx):
+        # x: (K, B, D), y and w: (K, B, 1)
+        x, y, w = batch[:3]
+        if self.dropout_p > 0:
+            # mask randomly chosen y values
+            y = y.masked_fill(torch.rand(y.size(), device=y.device) <= self.dropout_p, 0.)
+
+        # the weighted DSM loss of gen_sde.dsm_weighted, with one vmapped forward for all seeds
+        t_, x_hat, target, std = (torch.stack(parts) for parts in zip(*[
+            self.gen_sde.sample_dsm(x_k, clip=self.simple_clip, c_min=self.clip_min, c_max=self.clip_max)
+            for x_k in x]))
+        a = self.score_estimator.forward_all(x_hat, t_.squeeze(-1), y, per_model_inputs=True)
+        losses = (w * ((a * std + target) ** 2)).sum(-1).mean(-1) / 2
+
+        for seed, loss in zip(self.seeds, losses):
+            self.log(f"train_loss_seed={seed}", loss)
+        self.log("train_loss", losses.mean(), prog_bar=True)
+        return losses.sum()
+
+    def validation_step(self, batch, batch_idx, dataloader_idx=0):
+        # one validation dataloader per seed, holding that seed's held-out split
+        model = self.models[dataloader_idx]
+        x, y, w = batch[:3]
+        probes = model.validation_probes(x, batch_idx) if model.val_fixed_probes else {}
+        loss = self.seed_sdes[dataloader_idx].elbo_random_t_slice(x, y, div=model.val_div, **probes)
+        self.log(f"elbo_estimator_seed={self.seeds[dataloader_idx]}", loss.mean(), add_dataloader_idx=False)
+        return loss
+
+    def save_seed_checkpoint(self, k, filename):
+        model = self.models[k]
+        model.score_estimator.load_state_dict(self.score_estimator.unstacked_state_dict(k))
+        save_weights_checkpoint(model, os.path.join(self.checkpoint_dirs[k], filename),
+                                epoch=self.current_epoch, global_step=self.global_step)
+
+    def on_validation_end(self):
+        # the epoch-level ELBO reaches callback_metrics only after on_validation_epoch_end
+        if self.trainer.sanity_checking or not self.trainer.is_global_zero:
+            return
+        # keep the checkpoint with the best ELBO estimate per seed, as ModelCheckpoint(save_top_k=1) does
+        for k, seed in enumerate(self.seeds):
+            metric = self.trainer.callback_metrics.get(f"elbo_estimator_seed={seed}")
+            if metric is None:
+                continue
+            if self.seed_loggers is not None:
+                self.seed_loggers[k].log_metrics({"elbo_estimator": metric.item(), "epoch": self.current_epoch},
+                                                 step=self.global_step)
+            best_value, best_file = self.best[k]
+            if best_value is None or metric < best_value:
+                filename = f"{self.filename_prefixes[k]}-epoch={self.current_epoch:03d}-elbo_estimator={metric:.4e}.ckpt"
+                self.save_seed_checkpoint(k, filename)
+                if best_file is not None:
+                    os.remove(os.path.join(self.checkpoint_dirs[k], best_file))
+                self.best[k] = (metric.item(), filename)
+
+    def on_train_epoch_end(self):
+        if not self.trainer.is_global_zero:
+            return
+        every = self.checkpoint_every_n_epochs
+        for k in range(len(self.seeds)):
+            if every and (self.current_epoch + 1) % every == 0:
+                self.save_seed_checkpoint(k, f"{self.filename_prefixes[k]}-epoch={self.current_epoch:03d}.ckpt")
+            self.save_seed_checkpoint(k, "last.ckpt")
+
+    def on_fit_end(self):
+        if self.seed_loggers is not None:
+            for logger in self.seed_loggers:
+                logger.finalize("success")
@@ -34,14 +34,17 @@ with suppress_output():
 import numpy as np
 import pytorch_lightning as pl
 
+import functorch
 import torch
 from torch import optim, nn, utils, Tensor
 from torch.optim.lr_scheduler import LambdaLR
 from torch.optim import Optimizer
+from torch.utils.checkpoint import checkpoint_sequential
 
 from util import TASKNAME2TASK
 
 from lib.sdes import VariancePreservingSDE, PluginReverseSDE, ScorePluginReverseSDE
+from lib.flow_matching import RectifiedFlow
 
 
 def get_cosine_schedule_with_warmup(optimizer: Optimizer,
@@ -92,6 +95,18 @@ class Swish(nn.Module):
         return torch.sigmoid(x) * x
 
 
+def _run_sequential(module, h, segments):
+    """module(h), with activation checkpointing over `segments` segments when gradients are recorded."""
+    if segments > 0 and torch.is_grad_enabled():
+        if not h.requires_grad:
+            # the reentrant checkpoint only backpropagates into the weights if its input requires grad
+            h = h.detach().requires_grad_()
+        # a list, since Sequential.children() would skip the repeats of the shared activation module;
+        # the RNG state is restored for the recomputation, so dropout draws the same masks
+        return checkpoint_sequential(list(module), segments, h, preserve_rng_state=True)
+    return module(h)
+
+
 class MLP(nn.Module):
 
     def __init__(
@@ -100,6 +115,7 @@ class MLP(nn.Module):
             index_dim=1,
             hidden_dim=128,
             act=Swish(),
+            checkpoint_segments=0,
     ):
         super().__init__()
         self.input_dim = input_dim
@@ -107,6 +123,9 @@ class MLP(nn.Module):
         self.hidden_dim = hidden_dim
         self.act = act
         self.y_dim = 1
+        # > 0: in training, keep only the activations at the boundaries of this many segments
+        # and recompute the rest in the backward pass
+        self.checkpoint_segments = checkpoint_segments
         self.main = nn.Sequential(
             nn.Linear(input_dim + index_dim + self.y_dim, hidden_dim),
             act,
@@ -142,10 +161,74 @@ class MLP(nn.Module):
         # forward
         # print(input.size(), t.size(), y.size())
         h = torch.cat([input, t, y], dim=1)  # concat
-        output = self.main(h)  # forward
+        output = _run_sequential(self.main, h, self.checkpoint_segments if self.training else 0)  # forward
         return output.view(*sz)
 
 
+class FiLMMLP(nn.Module):
+    """Score network that injects y late, through a FiLM modulation of the last hidden layer.
+
+    The (x, t) trunk does not see y, so for classifier-free guidance it is computed once and
+    shared by the conditional and unconditional branches (see `forward_guided`).
+    """
+
+    def __init__(
+            self,
+            input_dim=2,
+            index_dim=1,
+            hidden_dim=128,
+            act=Swish(),
+            checkpoint_segments=0,
+    ):
+        super().__init__()
+        self.input_dim = input_dim
+        self.index_dim = index_dim
+        self.hidden_dim = hidden_dim
+        self.act = act
+        self.y_dim = 1
+        self.checkpoint_segments = checkpoint_segments
+        self.trunk = nn.Sequential(
+            nn.Linear(input_dim + index_dim, hidden_dim),
+            act,
+            nn.Linear(hidden_dim, hidden_dim),
+            act,
+            nn.Linear(hidden_dim, hidden_dim),
+            act,
+        )
+        self.film = nn.Linear(self.y_dim, 2 * hidden_dim)
+        self.head = nn.Linear(hidden_dim, input_dim)
+
+    def _trunk(self, input, t):
+        input = input.view(-1, self.input_dim)
+        t = t.view(-1, self.index_dim).float()
+        return _run_sequential(self.trunk, torch.cat([input, t], dim=1),
+                               self.checkpoint_segments if self.training else 0)
+
+    def _head(self, h, y):
+        scale, shift = self.film(y.view(-1, self.y_dim).float()).chunk(2, dim=1)
+        return self.head(h * (1 + scale) + shift)
+
+    def forward(self, input, t, y):
+        sz = input.size()
+        h = self._trunk(input, t)
+        return self._head(h, y).view(*sz)
+
+    def forward_guided(self, input, t, y, gamma):
+        """(1 + gamma) * s(x, t, y) - gamma * s(x, t, 0) with a single trunk evaluation."""
+        sz = input.size()
+        h = self._trunk(input, t)
+        y = y.view(-1, self.y_dim).float().expand(h.size(0), -1)
+        out = self._head(h.repeat(2, 1), torch.cat([y, torch.zeros_like(y)], dim=0))
+        cond, uncond = out.chunk(2, dim=0)
+        return ((1 + gamma) * cond - gamma * uncond).view(*sz)
+
+
+SCORE_ARCHS = {
+    'mlp': MLP,
+    'film': FiLMMLP,
+}
+
+
 class DiffusionTest(pl.LightningModule):
 
     def __init__(
@@ -226,8 +309,6 @@ class DiffusionTest(pl.LightningModule):
     def training_step(self, batch, batch_idx, log_prefix="train"):
         # x, y = batch
         x, y, w = batch
-        self.clip_min.cuda()
-        self.clip_max.cuda()
         if self.dropout_p == 0:
             """
             loss = self.gen_sde.dsm(x, y).mean() # forward and compute loss
@@ -279,16 +360,30 @@ class DiffusionScore(pl.LightningModule):
             activation_fn=Swish(),
             T0=1,
             debias=False,
-            vtype='rademacher'):
+            vtype='rademacher',
+            score_arch='mlp',
+            t_sampler='uniform',
+            val_div='hutchinson',
+            val_fixed_probes=False,
+            warmup_steps=500,
+            num_training_steps=10004 * 1000,
+            t_max=None,
+            t_max_mix=0.,
+            checkpoint_segments=0,
+            x_expander=None):
         super().__init__()
         self.taskname = taskname
         self.task = task
         self.learning_rate = learning_rate
         self.dim_y = self.task.y.shape[-1]
-        if taskname in ['dkitty', 'ant', 'superconductor', 'hopper',
+        # util.LogitExpander for batches of integer codes (--compact_x); task.x is then never built
+        self.x_expander = x_expander
+        if x_expander is not None:
+            self.dim_x = x_expander.dim_x
+        elif taskname in ['dkitty', 'ant', 'superconductor', 'hopper',
                         'rosenbrock', 'ackley', 'cosines', 'griewank', 'levy', 'rastrigin', 'sphere', 'zakharov',]:
             self.dim_x = self.task.x.shape[-1]
-        elif taskname in ['tf-bind-8', 'tf-bind-10', 'nas', 'rnabind']:
+        elif taskname in ['tf-bind-8', 'tf-bind-10', 'nas', 'rnabind', 'chembl', 'gfp']:
             self.dim_x = self.task.x.shape[-1] * self.task.x.shape[-2]
         self.dropout_p = dropout_p
         self.beta_min = beta_min
@@ -296,18 +391,32 @@ class DiffusionScore(pl.LightningModule):
         self.simple_clip = simple_clip
         self.debias = debias
 
-        self.clip_min = torch.tensor(task.x).min(axis=0)[0]
-        self.clip_max = torch.tensor(task.x).max(axis=0)[0]
+        if x_expander is not None:
+            self.clip_min, self.clip_max = x_expander.bounds()
+        else:
+            self.clip_min = torch.tensor(task.x).min(axis=0)[0]
+            self.clip_max = torch.tensor(task.x).max(axis=0)[0]
 
         self.T0 = T0
         self.vtype = vtype
+        self.t_sampler = t_sampler
+        self.val_div = val_div
+        self.val_fixed_probes = val_fixed_probes
+        self._val_probes = {}
 
         self.learning_rate = learning_rate
-
-        self.score_estimator = MLP(input_dim=self.dim_x,
-                                   index_dim=1,
-                                   hidden_dim=hidden_size,
-                                   act=activation_fn)
+        self.warmup_steps = warmup_steps
+        self.num_training_steps = num_training_steps
+        assert t_max is None or not debias, "t_max is not supported with the debiased time sampling"
+        self.t_max = t_max
+        self.t_max_mix = t_max_mix
+
+        self.score_arch = score_arch
+        self.score_estimator = SCORE_ARCHS[score_arch](input_dim=self.dim_x,
+                                                       index_dim=1,
+                                                       hidden_dim=hidden_size,
+                                                       act=activation_fn,
+                                                       checkpoint_segments=checkpoint_segments)
         self.T = torch.nn.Parameter(torch.FloatTensor([self.T0]),
                                     requires_grad=False)
 
@@ -318,7 +427,10 @@ class DiffusionScore(pl.LightningModule):
                                              self.score_estimator,
                                              self.T,
                                              vtype=self.vtype,
-                                             debias=self.debias)
+                                             debias=self.debias,
+                                             t_sampler=self.t_sampler,
+                                             t_max=self.t_max,
+                                             t_max_mix=self.t_max_mix)
 
     # def configure_optimizers(self) -> optim.Optimizer:
     #     """Configures the optimizer used by PyTorch Lightning."""
@@ -330,26 +442,25 @@ class DiffusionScore(pl.LightningModule):
                                      lr=self.learning_rate)
         lr_scheduler = get_cosine_schedule_with_warmup(
             optimizer=optimizer,
-            # TODO: add to config
-            num_warmup_steps=500,
+            num_warmup_steps=self.warmup_steps,
             # num_training_steps=(len(train_dataloader) * config.num_epochs),
-            num_training_steps=(10004 * 1000),
+            num_training_steps=self.num_training_steps,
         )
         scheduler = {"scheduler": lr_scheduler, "interval": "epoch"}
         return [optimizer], [scheduler]
 
-    def training_step(self, batch, batch_idx, log_prefix="train"):
+    def loss(self, batch):
+        """Weighted denoising score matching loss of a batch (x, y, w), with label dropout."""
         # x, y = batch
         x, y, w = batch
-        self.clip_min.cuda()
-        self.clip_max.cuda()
+        x = self.expand_x(x)
         if self.dropout_p == 0:
             # loss = self.gen_sde.dsm(x, y).mean() # forward and compute loss
             loss = self.gen_sde.dsm_weighted(
                 x, y, w,
                 clip=self.simple_clip).mean()  # forward and compute loss
         else:
-            rand_mask = torch.rand(y.size())
+            rand_mask = torch.rand(y.size(), device=y.device)
             mask = (rand_mask <= self.dropout_p)
 
             # mask randomly chosen y values
@@ -362,13 +473,201 @@ class DiffusionScore(pl.LightningModule):
                 clip=self.simple_clip,
                 c_min=self.clip_min,
                 c_max=self.clip_max).mean()  # forward and compute loss
+        return loss
+
+    def expand_x(self, x):
+        """Logits of a batch of integer codes, x unchanged if it already holds logits."""
+        return x if self.x_expander is None else self.x_expander(x)
 
+    def training_step(self, batch, batch_idx, log_prefix="train"):
+        loss = self.loss(batch)
         self.log(f"{log_prefix}_loss", loss, prog_bar=True)
         return loss
 
+    def validation_probes(self, x, batch_idx):
+        """(t, v, noise) draws for validation batch `batch_idx`, drawn once and reused every epoch
+        so that the ELBO estimates of different epochs are compared on the same draws."""
+        if batch_idx not in self._val_probes or self._val_probes[batch_idx]['v'].shape != x.shape:
+            generator = torch.Generator().manual_seed(batch_idx)
+            shape = [x.size(0), ] + [1 for _ in range(x.ndim - 1)]
+            t_ = torch.rand(shape, generator=generator) * (self.T0 if self.t_max is None else self.t_max)
+            if self.vtype == 'rademacher':
+                v = torch.rand(x.shape, generator=generator).ge(0.5).float() * 2 - 1
+            else:
+                v = torch.randn(x.shape, generator=generator)
+            epsilon = torch.randn(x.shape, generator=generator)
+            epsilon_T = torch.randn(x.shape, generator=generator)
+            self._val_probes[batch_idx] = dict(t_=t_, v=v, epsilon=epsilon, epsilon_T=epsilon_T)
+        return {k: p.to(x) for k, p in self._val_probes[batch_idx].items()}
+
     def validation_step(self, batch, batch_idx):
         # loss = self.training_step(batch, batch_idx, log_prefix="val")
         x, y, w = batch
-        loss = self.gen_sde.elbo_random_t_slice(x, y)
-        self.log(f"elbo_estimator", loss.mean(), prog_bar=True)
+        x = self.expand_x(x)
+        probes = self.validation_probes(x, batch_idx) if self.val_fixed_probes else {}
+        loss = self.gen_sde.elbo_random_t_slice(x, y, div=self.val_div, **probes)
+        # averaged over the ranks of a data-parallel run, so every rank monitors the same value
+        self.log(f"elbo_estimator", loss.mean(), prog_bar=True, sync_dist=True)
+        return loss
+
+    def on_save_checkpoint(self, checkpoint):
+        # the samplers refuse to start above the largest diffusion time the model was trained on
+        checkpoint["t_max"] = self.t_max
+
+    def on_load_checkpoint(self, checkpoint):
+        self.t_max = checkpoint.get("t_max", self.t_max)
+        self.gen_sde.t_max = self.t_max
+
+
+class FlowMatchingScore(pl.LightningModule):
+    """Conditional rectified-flow counterpart of `DiffusionScore`. Trains a velocity field
+    with the same network, y-dropout and per-sample weights, whose straight paths can be
+    integrated with far fewer ODE steps (see `sampling.flow_ode_sampler`)."""
+
+    def __init__(
+            self,
+            taskname,
+            task,
+            hidden_size=1024,
+            learning_rate=1e-3,
+            dropout_p=0,
+            activation_fn=Swish(),
+            T0=1,
+            score_arch='mlp',
+            warmup_steps=500,
+            num_training_steps=10004 * 1000):
+        super().__init__()
+        self.taskname = taskname
+        self.task = task
+        self.learning_rate = learning_rate
+        self.warmup_steps = warmup_steps
+        self.num_training_steps = num_training_steps
+        self.dim_y = self.task.y.shape[-1]
+        if self.task.is_discrete:
+            self.dim_x = self.task.x.shape[-1] * self.task.x.shape[-2]
+        else:
+            self.dim_x = self.task.x.shape[-1]
+        self.dropout_p = dropout_p
+        self.score_arch = score_arch
+
+        self.velocity = SCORE_ARCHS[score_arch](input_dim=self.dim_x,
+                                                index_dim=1,
+                                                hidden_dim=hidden_size,
+                                                act=activation_fn)
+        self.T = torch.nn.Parameter(torch.FloatTensor([T0]),
+                                    requires_grad=False)
+        self.flow = RectifiedFlow(self.velocity, self.T)
+
+    def configure_optimizers(self):
+        optimizer = torch.optim.Adam(params=self.flow.parameters(),
+                                     lr=self.learning_rate)
+        lr_scheduler = get_cosine_schedule_with_warmup(
+            optimizer=optimizer,
+            num_warmup_steps=self.warmup_steps,
+            num_training_steps=self.num_training_steps,
+        )
+        scheduler = {"scheduler": lr_scheduler, "interval": "epoch"}
+        return [optimizer], [scheduler]
+
+    def training_step(self, batch, batch_idx, log_prefix="train"):
+        # reflow batches carry the coupled noise x0 as a fourth element
+        x, y, w = batch[:3]
+        x0 = batch[3] if len(batch) > 3 else None
+        if self.dropout_p > 0:
+            rand_mask = torch.rand(y.size(), device=y.device)
+            # mask randomly chosen y values
+            y = y.masked_fill(rand_mask <= self.dropout_p, 0.)
+        loss = self.flow.fm_weighted(x, y, w, x0=x0).mean()
+
+        self.log(f"{log_prefix}_loss", loss, prog_bar=True)
+        return loss
+
+    def validation_step(self, batch, batch_idx):
+        x, y, w = batch[:3]
+        loss = self.flow.fm_weighted(x, y, torch.ones_like(w)).mean()
+        self.log("val_loss", loss, prog_bar=True, sync_dist=True)
         return loss
+
+
+class StackedScoreEstimator(nn.Module):
+    """Evaluates K score networks of identical architecture in a single vmapped call
+    and returns their average, so an ensemble costs one batched forward per step.
+
+    With ``trainable=True`` the stacked weights are parameters, so K independent networks
+    can be trained together (see `multiseed.MultiSeedDiffusionScore`).
+    """
+
+    def __init__(self, estimators, trainable=False):
+        super().__init__()
+        fmodel, params, buffers = functorch.combine_state_for_ensemble(list(estimators))
+        self.num_models = len(estimators)
+        self.param_names = list(fmodel.param_names)
+        self.buffer_names = list(fmodel.buffer_names)
+        for i, param in enumerate(params):
+            if trainable:
+                self.register_parameter(f"param_{i}", nn.Parameter(param.detach().clone()))
+            else:
+                self.register_buffer(f"param_{i}", param.detach())
+        for i, buffer in enumerate(buffers):
+            self.register_buffer(f"buffer_{i}", buffer)
+        # stateless copy of the architecture on the meta device, kept out of the module tree so
+        # that .to() and state_dict() skip it; forward_all gives it the ensemble's train/eval mode
+        self.base = [fmodel]
+        if getattr(fmodel.stateless_model, "checkpoint_segments", 0):
+            # the reentrant activation checkpoint cannot run inside vmap
+            fmodel.stateless_model.checkpoint_segments = 0
+
+    def stacked_state(self):
+        params = {name: getattr(self, f"param_{i}") for i, name in enumerate(self.param_names)}
+        buffers = {name: getattr(self, f"buffer_{i}") for i, name in enumerate(self.buffer_names)}
+        return params, buffers
+
+    def forward_all(self, input, t, y, per_model_inputs=False):
+        """Scores of every member, stacked along a new leading dimension of size K.
+
+        With ``per_model_inputs`` the inputs carry that leading dimension too, and member k
+        only sees its own slice of them. In training mode each member draws its own dropout masks.
+        """
+        in_dims = (0, 0) + ((0, 0, 0) if per_model_inputs else (None, None, None))
+        params = tuple(getattr(self, f"param_{i}") for i in range(len(self.param_names)))
+        buffers = tuple(getattr(self, f"buffer_{i}") for i in range(len(self.buffer_names)))
+        base = self.base[0].train(self.training)
+        return functorch.vmap(base, in_dims=in_dims, randomness="different")(params, buffers, input, t, y)
+
+    def forward_member(self, k, input, t, y):
+        """Score of member k alone, e.g. as the drift of its own reverse SDE."""
+        params = tuple(getattr(self, f"param_{i}")[k] for i in range(len(self.param_names)))
+        buffers = tuple(getattr(self, f"buffer_{i}")[k] for i in range(len(self.buffer_names)))
+        return self.base[0].train(self.training)(params, buffers, input, t, y)
+
+    def unstacked_state_dict(self, k):
+        """State dict of member k, in the layout of the original score network."""
+        params, buffers = self.stacked_state()
+        state = {name: p[k].detach() for name, p in params.items()}
+        state.update({name: b[k] for name, b in buffers.items()})
+        return state
+
+    def forward(self, input, t, y):
+        return self.forward_all(input, t, y).mean(dim=0)
+
+
+class EnsembleDiffusionScore(nn.Module):
+    """Averages the scores of several trained `DiffusionScore` models inside the drift of
+    the reverse SDE. Exposes `gen_sde` like `DiffusionScore`, so it can be passed to the
+    samplers in place of a single model."""
+
+    def __init__(self, models):
+        super().__init__()
+        ref = models[0]
+        self.num_models = len(models)
+        self.T = ref.T
+        # the ensemble is only valid where all of its members are
+        t_maxes = [m.t_max for m in models if getattr(m, 't_max', None) is not None]
+        self.t_max = min(t_maxes) if t_maxes else None
+        self.inf_sde = ref.inf_sde
+        self.score_estimator = StackedScoreEstimator([m.score_estimator for m in models])
+        self.gen_sde = ScorePluginReverseSDE(self.inf_sde,
+                                             self.score_estimator,
+                                             self.T,
+                                             vtype=ref.vtype,
+                                             debias=ref.debias)
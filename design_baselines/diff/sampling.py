@@ -0,0 +1,123 @@
+"""Reverse-SDE samplers shared by the editing and evaluation scripts."""
+
+import math
+
+import torch
+
+
+def _diverged(x):
+    """Boolean mask of rows of ``x`` containing NaN or inf."""
+    return ~torch.isfinite(x.view(x.size(0), -1)).all(dim=1)
+
+
+def heun_sampler(sde, x_0, ya, num_steps, start_step=0, end_step=None, lmbd=0., gamma=0.,
+                 keep_all_samples=True, checkpoint_every=50, max_retries=3):
+    """Integrate the reverse SDE of ``sde`` from ``start_step`` to ``end_step``.
+
+    Every ``checkpoint_every`` steps the current state is kept as a checkpoint. Rows that
+    diverge (NaN/inf) are rolled back to the last checkpoint and re-integrated with fresh
+    noise, up to ``max_retries`` times per row; rows that still diverge are left as NaN so
+    the caller can drop them individually instead of discarding the whole batch.
+    """
+    if checkpoint_every < 1:
+        raise ValueError(f"checkpoint_every must be a positive number of steps, got {checkpoint_every}")
+    if max_retries < 0:
+        raise ValueError(f"max_retries must be non-negative, got {max_retries}")
+    device = sde.gen_sde.T.device
+    batch_size = x_0.size(0)
+    ndim = x_0.dim() - 1
+    T_ = sde.gen_sde.T.cpu().item()
+    delta = T_ / num_steps
+    ts = torch.linspace(0, 1, num_steps + 1) * T_
+
+    if end_step is None:
+        end_step = num_steps
+
+    # models trained with --t_max have never seen diffusion times above it
+    t_max = getattr(sde, 't_max', None)
+    if t_max is not None and T_ - ts[start_step].item() > t_max + 1e-6:
+        raise ValueError(f"sampling starts at diffusion time {T_ - ts[start_step].item():.4f}, but the model was "
+                         f"trained on times up to t_max={t_max}; start at step >= "
+                         f"{math.ceil((T_ - t_max) / delta - 1e-6)} or train with a larger --t_max")
+
+    def step(x_t, y, i):
+        t = torch.full((x_t.size(0), *([1] * ndim)), ts[i].item(), device=device)
+        mu = sde.gen_sde.mu(t, x_t, y, lmbd=lmbd, gamma=gamma)
+        sigma = sde.gen_sde.sigma(t, x_t, lmbd=lmbd)
+        x_t = x_t + delta * mu + delta**0.5 * sigma * torch.randn_like(
+            x_t
+        )  # one step update of Euler Maruyama method with a step size delta
+        # Additional terms for Heun's method
+        if i < num_steps - 1:
+            t_n = torch.full_like(t, ts[i + 1].item())
+            sigma2 = sde.gen_sde.sigma(t_n, x_t, lmbd=lmbd)
+            x_t = x_t + (sigma2 - sigma) / 2 * delta**0.5 * torch.randn_like(x_t)
+        return x_t
+
+    # sample
+    xs = []
+    x_t = x_0.detach().clone().to(device)
+    ya = ya.to(device)
+    x_ckpt, ckpt_step = x_t.clone(), start_step
+    retries = torch.zeros(batch_size, dtype=torch.long, device=device)
+    recovered = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    given_up = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    with torch.no_grad():
+        for i in range(start_step, end_step):
+            x_t = step(x_t, ya, i)
+
+            bad = _diverged(x_t) & ~given_up
+            while bad.any():
+                retries[bad] += 1
+                given_up |= bad & (retries > max_retries)
+                redo = bad & ~given_up
+                if not redo.any():
+                    break
+                # replay the diverged rows from the last checkpoint with fresh noise
+                x_redo = x_ckpt[redo]
+                for j in range(ckpt_step, i + 1):
+                    x_redo = step(x_redo, ya[redo], j)
+                x_t[redo] = x_redo
+                recovered |= redo
+                bad = _diverged(x_t) & ~given_up
+
+            if (i + 1 - start_step) % checkpoint_every == 0:
+                x_ckpt, ckpt_step = x_t.clone(), i + 1
+
+            if keep_all_samples or i == num_steps - 1:
+                xs.append(x_t.cpu())
+
+    recovered &= ~given_up
+    if recovered.any() or given_up.any():
+        print(f"heun_sampler: recovered {int(recovered.sum())} diverged rows, "
+              f"{int(given_up.sum())} rows still diverged after {max_retries} retries")
+    return xs
+
+
+def flow_ode_sampler(model, x_t, ya, num_steps, t_start=0., gamma=0., keep_all_samples=True):
+    """Integrate the flow-matching ODE of ``model`` from ``t_start`` to 1 with Heun's method.
+
+    ``t_start=0`` generates from pure noise; for SDEdit-style editing pass designs moved
+    back to ``t_start = 1 - t`` along the straight path (``model.flow.interpolate``).
+    """
+    device = model.T.device
+    ndim = x_t.dim() - 1
+    ts = torch.linspace(t_start, 1, num_steps + 1)
+
+    xs = []
+    x_t = x_t.detach().clone().to(device)
+    ya = ya.to(device)
+    t = torch.zeros(x_t.size(0), *([1] * ndim), device=device)
+    t_n = torch.zeros_like(t)
+    with torch.no_grad():
+        for i in range(num_steps):
+            t.fill_(ts[i].item())
+            t_n.fill_(ts[i + 1].item())
+            delta = (ts[i + 1] - ts[i]).item()
+            v = model.flow.drift(t, x_t, ya, gamma=gamma)
+            x_e = x_t + delta * v
+            x_t = x_t + delta / 2 * (v + model.flow.drift(t_n, x_e, ya, gamma=gamma))
+            if keep_all_samples or i == num_steps - 1:
+                xs.append(x_t.cpu())
+    return xs
@@ -0,0 +1,168 @@
+"""Streaming, score-stratified subsampling of large design-bench datasets.
+
+The full TFBind10 dataset has 4161482 rows. Instead of capping it with ``max_samples`` or
+taking a strided slice of a fully sorted copy, `stratified_subsample` reads it in chunks, in
+three passes:
+
+    1. the range and number of the scores
+    2. a fine histogram of the scores; its cumulative counts give the boundaries of
+       ``num_strata`` score quantiles and the number of rows in each of them
+    3. a bottom-k sample on random row keys within every stratum, where stratum s keeps
+       ``size * count_s / n`` rows (largest remainder rounding)
+
+The first two passes read only the scores and the third holds only the kept rows, so memory
+is bounded by the chunk size plus the sample size. The key of a row is a hash of the seed and
+the row index, so the sample depends only on (size, num_strata, seed), not on the chunk size.
+"""
+import numpy as np
+
+CHUNK_SIZE = 2 ** 16
+
+
+def task_chunks(task, chunk_size=CHUNK_SIZE):
+    """A function that returns a new iterator over the (x, y) chunks of a design-bench task, read
+    shard by shard from its dataset in the task's current (mapped or raw) state. With
+    ``return_x=False`` the designs are not read and the chunks are (None, y)."""
+
+    def chunks(return_x=True):
+        if return_x:
+            return task.dataset.iterate_batches(chunk_size)
+        return ((None, y) for y in task.dataset.iterate_batches(chunk_size, return_x=False))
+
+    return chunks
+
+
+def array_chunks(y, x=None, chunk_size=CHUNK_SIZE):
+    """`task_chunks` over arrays that are already in memory."""
+
+    def chunks(return_x=True):
+        for start in range(0, len(y), chunk_size):
+            y_chunk = y[start:start + chunk_size]
+            x_chunk = None
+            if return_x:
+                # without designs, the sample is returned as row indices only
+                x_chunk = x[start:start + chunk_size] if x is not None else np.empty((len(y_chunk), 0))
+            yield x_chunk, y_chunk
+
+    return chunks
+
+
+def design_shape(task):
+    """Shape of one design of a task in its current state, read from a single row instead of task.x."""
+    x, _ = next(iter(task_chunks(task, chunk_size=1)()))
+    return x.shape[1:]
+
+
+def stream_range(chunks):
+    """(min, max, count) of the scores."""
+    lo, hi, n = np.inf, -np.inf, 0
+    for _, y in chunks(return_x=False):
+        lo, hi, n = min(lo, float(np.min(y))), max(hi, float(np.max(y))), n + len(y)
+    return lo, hi, n
+
+
+def stream_counts(chunks, *edges):
+    """Histogram counts of the scores over each of the given bin edges, in one pass."""
+    counts = [np.zeros(len(e) - 1, dtype=np.int64) for e in edges]
+    for _, y in chunks(return_x=False):
+        y = np.reshape(y, -1)
+        for c, e in zip(counts, edges):
+            c += np.histogram(y, bins=e)[0]
+    return counts
+
+
+def stream_histogram(chunks, lo, hi, bins):
+    """Counts of the scores in ``bins`` equal bins over [lo, hi], and the bin edges."""
+    edges = np.linspace(lo, hi, bins + 1)
+    return stream_counts(chunks, edges)[0], edges
+
+
+def _bin_index(values, edges):
+    # the bins of np.histogram: half-open, the last one closed
+    return np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+
+
+def stream_order_statistics(chunks, ranks, edges, counts):
+    """Scores at the given 0-based ranks of their sorted order, given their histogram ``counts``
+    over ``edges``. One pass keeps the distinct scores, with multiplicities, of only the bins
+    that hold the ranks."""
+    cumulative = np.cumsum(counts)
+    bins = np.searchsorted(cumulative, ranks, side="right")
+    kept = {b: (np.array([]), np.array([], dtype=np.int64)) for b in np.unique(bins)}
+    for _, y in chunks(return_x=False):
+        y = np.reshape(y, -1)
+        index = _bin_index(y, edges)
+        for b in kept:
+            values, multiplicity = np.unique(y[index == b], return_counts=True)
+            values, inverse = np.unique(np.concatenate([kept[b][0], values]), return_inverse=True)
+            kept[b] = values, np.bincount(inverse, weights=np.concatenate([kept[b][1], multiplicity])).astype(np.int64)
+    result = []
+    for rank, b in zip(ranks, bins):
+        values, multiplicity = kept[b]
+        within = rank - (cumulative[b - 1] if b > 0 else 0)
+        result.append(values[np.searchsorted(np.cumsum(multiplicity), within, side="right")])
+    return result
+
+
+def histogram_strata(counts, edges, num_strata):
+    """Inner boundaries of ``num_strata`` score quantiles, rounded up to the histogram bin edges, and
+    the number of rows of each stratum. Quantiles falling into the same bin (ties) merge strata."""
+    cumulative = np.cumsum(counts)
+    targets = cumulative[-1] * np.arange(1, num_strata) / num_strata
+    bins = np.unique(np.searchsorted(cumulative, targets))
+    bins = bins[bins < len(counts) - 1]
+    boundaries = edges[bins + 1]
+    stratum_counts = np.diff(np.concatenate([[0], cumulative[bins], [cumulative[-1]]]))
+    return boundaries, stratum_counts
+
+
+def allocate(size, stratum_counts):
+    """Rows to keep per stratum, proportional to its count, summing to ``size``."""
+    quota = size * stratum_counts / stratum_counts.sum()
+    sizes = np.floor(quota).astype(np.int64)
+    remainder = size - sizes.sum()
+    sizes[np.argsort(sizes - quota, kind="stable")[:remainder]] += 1
+    return np.minimum(sizes, stratum_counts)
+
+
+def row_keys(rows, seed):
+    """Uniform uint64 keys of row indices (splitmix64 of the row index offset by the seed)."""
+    z = np.asarray(rows, dtype=np.uint64) + np.full(len(rows), seed, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def stratified_subsample(chunks, size, num_strata=20, seed=0, bins=2 ** 16):
+    """Draws ``size`` rows stratified on the score quantiles from the chunks of `task_chunks` or
+    `array_chunks`. Returns the row indices (sorted), the designs and the scores of the sample; if
+    ``size`` is at least the number of rows, all of them are returned."""
+    lo, hi, n = stream_range(chunks)
+    if lo == hi:
+        boundaries, stratum_counts = np.array([]), np.array([n])
+    else:
+        boundaries, stratum_counts = histogram_strata(*stream_histogram(chunks, lo, hi, bins), num_strata)
+    sizes = allocate(min(size, n), stratum_counts)
+
+    kept = [None] * len(sizes)
+    start = 0
+    for x, y in chunks():
+        rows = np.arange(start, start + len(y))
+        start += len(y)
+        strata = np.searchsorted(boundaries, np.reshape(y, (len(y), -1))[:, 0], side="right")
+        keys = row_keys(rows, seed)
+        for s in np.unique(strata):
+            mask = strata == s
+            part = [keys[mask], rows[mask], x[mask], y[mask]]
+            if kept[s] is not None:
+                part = [np.concatenate([a, b]) for a, b in zip(kept[s], part)]
+            if len(part[0]) > sizes[s]:
+                keep = np.argpartition(part[0], sizes[s] - 1)[:sizes[s]] if sizes[s] > 0 else []
+                part = [a[keep] for a in part]
+            kept[s] = part
+    assert start == n, "the dataset changed between the passes"
+
+    kept = [part for part in kept if part is not None]
+    rows, x, y = (np.concatenate([part[i] for part in kept]) for i in (1, 2, 3))
+    order = np.argsort(rows)
+    return rows[order], x[order], y[order]
@@ -33,51 +33,28 @@ with suppress_output():
 import numpy as np
 import pandas as pd
 import pytorch_lightning as pl
+from pytorch_lightning.strategies import DDPStrategy
 
 import torch
-from torch.utils.data import Dataset, DataLoader
-
-from nets import DiffusionTest, DiffusionScore
-from util import TASKNAME2TASK, configure_gpu, set_seed, get_weights
+from torch.utils.data import DataLoader, WeightedRandomSampler
+
+from callbacks import EMACallback, AsyncCheckpointStore, ELBOTargetCallback
+from data import RvSDataset, TensorRvSDataset, ContiguousBatchSampler, WeightedBatchSampler
+from engine import LeanTrainer, make_adam
+from joint import JointDiffusionScore, ROLES
+from lib.utils import T_SAMPLERS
+from loggers import LocalLogger
+from multiseed import MultiSeedDiffusionScore, StackedBatchLoader
+from nets import DiffusionTest, DiffusionScore, FlowMatchingScore, get_cosine_schedule_with_warmup
+from sampling import flow_ode_sampler
+from util import TASKNAME2TASK, configure_gpu, set_seed, get_weights, load_task_arrays, save_weights_checkpoint, \
+    LogitExpander, LR_SCALING_RULES, scale_for_batch_size
 
 args_filename = "args.json"
 checkpoint_dir = "checkpoints"
 wandb_project = "sde-flow"
 
 
-class RvSDataset(Dataset):
-
-    def __init__(self, task, x, y, w=None, device=None, mode='train'):
-        self.task = task
-        self.device = device
-        self.mode = mode
-        self.x = x
-        self.y = y
-        self.w = w
-
-    def __len__(self):
-        return self.x.shape[0]
-
-    def __getitem__(self, idx):
-        x = torch.tensor(self.x[idx])
-        y = torch.tensor(self.y[idx])
-        if self.w is not None:
-            w = torch.tensor(self.w[idx])
-        else:
-            w = None
-        '''
-        if self.device is not None:
-            x = x.to(self.device)
-            y = y.to(self.device)
-            if w is not None:
-                w = w.to(self.device)
-        '''
-        if w is None:
-            return x, y
-        else:
-            return x, y, w
-
-
 def temp_get_super_y(task):
     y = task.y.reshape(-1)
     sorted_y_idx = np.argsort(y)
@@ -147,26 +124,35 @@ def split_dataset(task, val_frac=None, device=None, temp=None):
     return train_dataset, val_dataset
 
 
-def split_dataset_based_on_top_candidates(task, size, val_frac=None, device=None, temp=None, is_target=False):
-    length = task.y.shape[0]
-    shuffle_idx = np.arange(length)
-    np.random.shuffle(shuffle_idx)
-
-    if task.is_discrete:
-        task.map_to_logits()
-        x = task.x[shuffle_idx]
-        # x = x.reshape(x.shape[1:])
-        x = x.reshape(x.shape[0], -1)
+def split_dataset_based_on_top_candidates(task, size, val_frac=None, device=None, temp=None, is_target=False,
+                                          arrays=None):
+    if arrays is not None:
+        # preprocessed (x, y, w) from util.load_task_arrays
+        x, y, w = arrays
+        length = x.shape[0]
+        shuffle_idx = np.arange(length)
+        np.random.shuffle(shuffle_idx)
+        x, y, w = x[shuffle_idx], y[shuffle_idx], w[shuffle_idx]
     else:
-        x = task.x[shuffle_idx]
+        length = task.y.shape[0]
+        shuffle_idx = np.arange(length)
+        np.random.shuffle(shuffle_idx)
 
-    # y = temp_get_super_y(task)
-    y = task.y
-    y = y[shuffle_idx]
-    if not task.is_discrete:
-        x = x.reshape(-1, task.x.shape[-1])
-    y = y.reshape(-1, 1)
-    w = get_weights(y, temp=temp)
+        if task.is_discrete:
+            task.map_to_logits()
+            x = task.x[shuffle_idx]
+            # x = x.reshape(x.shape[1:])
+            x = x.reshape(x.shape[0], -1)
+        else:
+            x = task.x[shuffle_idx]
+
+        # y = temp_get_super_y(task)
+        y = task.y
+        y = y[shuffle_idx]
+        if not task.is_discrete:
+            x = x.reshape(-1, task.x.shape[-1])
+        y = y.reshape(-1, 1)
+        w = get_weights(y, temp=temp)
 
     # Sort y in descending order and select the top 'size' instances
     if size is None:
@@ -229,7 +215,8 @@ def split_dataset_based_on_top_candidates(task, size, val_frac=None, device=None
 
 class RvSDataModule(pl.LightningDataModule):
 
-    def __init__(self, task, batch_size, num_workers, val_frac, device, temp, top_candidates_size=None, is_target=False):
+    def __init__(self, task, batch_size, num_workers, val_frac, device, temp, top_candidates_size=None, is_target=False,
+                 tensor_dataset=False, arrays=None, weighting='loss', seed=None):
         super().__init__()
 
         self.task = task
@@ -242,37 +229,142 @@ class RvSDataModule(pl.LightningDataModule):
         self.temp = temp
         self.top_candidates_size = top_candidates_size
         self.is_target = is_target
+        self.tensor_dataset = tensor_dataset
+        self.arrays = arrays
+        self.weighting = weighting
+        self.sample_weights = None
+        self.seed = seed
 
     def setup(self, stage=None):
         self.train_dataset, self.val_dataset = split_dataset_based_on_top_candidates(
-            self.task, size=self.top_candidates_size, val_frac=self.val_frac, device=self.device, temp=self.temp, is_target=self.is_target)
+            self.task, size=self.top_candidates_size, val_frac=self.val_frac, device=self.device, temp=self.temp, is_target=self.is_target,
+            arrays=self.arrays)
+        if self.weighting == 'sample':
+            # draw training rows proportionally to w and weight every row of the loss by mean(w),
+            # which keeps the expected objective of the reweighted loss
+            w = self.train_dataset.w
+            self.sample_weights = w.reshape(-1).copy()
+            self.train_dataset.w = np.full_like(w, w.mean())
+        num_replicas, rank = self._replicas()
+        if num_replicas > 1 and self.seed is not None:
+            # every rank has made the same split above; from here on, each draws its own noise
+            set_seed(self.seed + rank)
+
+    def _replicas(self):
+        if self.trainer is None:
+            return 1, 0
+        return self.trainer.world_size, self.trainer.global_rank
+
+    def _loader(self, dataset, shuffle, weights=None):
+        num_replicas, rank = self._replicas()
+        if self.tensor_dataset:
+            if not isinstance(dataset, TensorRvSDataset):
+                dataset = TensorRvSDataset.from_dataset(dataset)
+            if weights is not None:
+                sampler = WeightedBatchSampler(weights, self.batch_size, num_replicas=num_replicas)
+            else:
+                sampler = ContiguousBatchSampler(len(dataset), self.batch_size, shuffle=shuffle,
+                                                 num_replicas=num_replicas, rank=rank, seed=self.seed or 0)
+            # whole batches are sliced out of one tensor: no per-item collate, no workers
+            return DataLoader(dataset,
+                              sampler=sampler,
+                              batch_size=None)
+        if num_replicas > 1:
+            # each rank loads its own shard of the (unshuffled) rows, in batches of batch_size
+            if weights is not None:
+                batch_sampler = WeightedBatchSampler(weights, self.batch_size, num_replicas=num_replicas)
+            else:
+                batch_sampler = ContiguousBatchSampler(len(dataset), self.batch_size, shuffle=False,
+                                                       num_replicas=num_replicas, rank=rank)
+            return DataLoader(dataset,
+                              num_workers=self.num_workers,
+                              batch_sampler=batch_sampler)
+        return DataLoader(dataset,
+                          num_workers=self.num_workers,
+                          batch_size=self.batch_size,
+                          sampler=WeightedRandomSampler(weights, len(dataset)) if weights is not None else None)
 
     def train_dataloader(self):
-        train_loader = DataLoader(self.train_dataset,
-                                  num_workers=self.num_workers,
-                                  batch_size=self.batch_size)
+        train_loader = self._loader(self.train_dataset, shuffle=True, weights=self.sample_weights)
         return train_loader
 
     def val_dataloader(self):
-        val_loader = DataLoader(self.val_dataset,
-                                num_workers=self.num_workers,
-                                batch_size=self.batch_size)
+        val_loader = self._loader(self.val_dataset, shuffle=False)
         return val_loader
 
 
+class ReflowDataModule(RvSDataModule):
+    """Replaces the training designs by (noise, sample) pairs generated with a trained
+    flow-matching model, conditioned on the training labels, for a reflow stage."""
+
+    def __init__(self, teacher, num_steps, device, gamma=0., **kwargs):
+        super().__init__(device=device, **kwargs)
+        self.teacher = teacher
+        self.num_steps = num_steps
+        self.gamma = gamma
+
+    def setup(self, stage=None):
+        super().setup(stage)
+        ds = self.train_dataset
+        teacher = self.teacher.to(self.device).eval()
+        x0 = np.random.randn(*ds.x.shape).astype(np.float32)
+        x1 = []
+        for i in range(0, len(ds), self.batch_size):
+            x1.append(flow_ode_sampler(teacher,
+                                       torch.from_numpy(x0[i:i + self.batch_size]),
+                                       torch.tensor(ds.y[i:i + self.batch_size]).squeeze(-1),
+                                       self.num_steps,
+                                       gamma=self.gamma,
+                                       keep_all_samples=False)[-1].numpy())
+        self.train_dataset = RvSDataset(ds.task, np.concatenate(x1), ds.y, ds.w,
+                                        self.device, mode='train', x0=x0)
+
+
+def global_rank(args) -> int:
+    """Rank of this process before the Trainer exists, as set by torchrun (RANK) or by the
+    processes Lightning launches for --num_processes/--num_nodes (NODE_RANK, LOCAL_RANK)."""
+    if "RANK" in os.environ:
+        return int(os.environ["RANK"])
+    return int(os.environ.get("NODE_RANK", 0)) * args.num_processes + int(os.environ.get("LOCAL_RANK", 0))
+
+
+def distributed_kwargs(args) -> dict:
+    """pl.Trainer arguments for data-parallel training over --num_processes processes per node and
+    --num_nodes nodes. The data modules shard their own samplers, so Lightning must not replace them."""
+    if args.num_processes == 1 and args.num_nodes == 1:
+        return dict(devices=1)
+    return dict(accelerator="gpu" if args.use_gpu and torch.cuda.is_available() else "cpu",
+                devices=args.num_processes,
+                num_nodes=args.num_nodes,
+                strategy=DDPStrategy(process_group_backend=args.ddp_backend),
+                use_distributed_sampler=False)
+
+
+def scaled_schedule(args, learning_rate, warmup_steps, num_processes=1):
+    """Learning rate and warmup epochs for the effective batch of a run (--batch_size over gradient
+    accumulation and `num_processes` data-parallel processes), scaled by --lr_scaling."""
+    effective_batch_size = args.batch_size * args.accumulate_grad_batches * num_processes
+    learning_rate, warmup_steps = scale_for_batch_size(learning_rate, warmup_steps, effective_batch_size,
+                                                       args.lr_base_batch_size, rule=args.lr_scaling)
+    if args.lr_scaling != 'none':
+        print(f"Effective batch size {effective_batch_size}: learning rate {learning_rate:.3e}, "
+              f"warmup {warmup_steps} epochs")
+    return learning_rate, warmup_steps
+
+
 def log_args(
         args: configargparse.Namespace,
-        wandb_logger: pl.loggers.wandb.WandbLogger,
+        logger: pl.loggers.Logger,
 ) -> None:
-    """Log arguments to a file in the wandb directory."""
-    wandb_logger.log_hyperparams(args)
+    """Log arguments to a file in the run directory of the logger."""
+    logger.log_hyperparams(args)
 
-    args.wandb_entity = wandb_logger.experiment.entity
-    args.wandb_project = wandb_logger.experiment.project
-    args.wandb_run_id = wandb_logger.experiment.id
-    args.wandb_path = wandb_logger.experiment.path
+    args.wandb_entity = logger.experiment.entity
+    args.wandb_project = logger.experiment.project
+    args.wandb_run_id = logger.experiment.id
+    args.wandb_path = logger.experiment.path
 
-    out_directory = wandb_logger.experiment.dir
+    out_directory = logger.experiment.dir
     pprint(f"out_directory: {out_directory}")
     args_file = os.path.join(out_directory, args_filename)
     with open(args_file, "w") as f:
@@ -282,10 +374,89 @@ def log_args(
             json.dump(args, f)
 
 
+def make_logger(args, project, name, save_dir):
+    """WandbLogger, or with --logger local an offline LocalLogger with the same directory layout."""
+    if args.logger == "local":
+        return LocalLogger(project=project, name=name, save_dir=save_dir, flush_secs=args.log_flush_secs)
+    return pl.loggers.wandb.WandbLogger(project=project, name=name, save_dir=save_dir)
+
+
+def fit_lean(model, train_dataset, val_dataset, logger, args, device, epochs, checkpoint_dirpath, filename_prefix,
+             sample_weights=None):
+    """Train `model` with the minimal loop of engine.py, writing the same checkpoints as run_training:
+    the best validation ELBO, every --checkpoint_every_n_epochs epochs, and last.ckpt.
+    Validation honours --val_budget and --val_fixed_probes like the Lightning run.
+    With `sample_weights`, training rows are drawn proportionally to them (--weighting sample)."""
+    device = device if device is not None else torch.device("cpu")
+    model = model.to(device)
+    model.train()
+
+    def as_tensors(dataset):
+        # integer codes of --compact_x keep their dtype and are expanded per batch by the model
+        return tuple(torch.tensor(a, dtype=None if np.issubdtype(a.dtype, np.integer) else torch.float32,
+                                  device=device) for a in (dataset.x, dataset.y, dataset.w))
+
+    train_tensors = as_tensors(train_dataset)
+    val_tensors = as_tensors(val_dataset) if len(val_dataset) > 0 else None
+    optimizer = make_adam(model.gen_sde.parameters(), lr=model.learning_rate)
+    scheduler = get_cosine_schedule_with_warmup(optimizer,
+                                                num_warmup_steps=model.warmup_steps,
+                                                num_training_steps=model.num_training_steps)
+    engine = LeanTrainer(model.gen_sde.parameters(), model.loss, optimizer, scheduler, grad_clip=args.grad_clip,
+                         accumulate_grad_batches=args.accumulate_grad_batches)
+    best = [None, None]
+    val_batches = None
+    if val_tensors is not None:
+        val_batches = list(zip(*(t.split(args.batch_size) for t in val_tensors)))
+        # limit_val_batches of the Lightning run: a fraction (<= 1) or a number of batches
+        budget = int(args.val_budget) if args.val_budget > 1 else max(1, int(len(val_batches) * args.val_budget))
+        val_batches = val_batches[:budget]
+
+    def validation_elbo():
+        elbos = []
+        for batch_idx, (x, y, _) in enumerate(val_batches):
+            x = model.expand_x(x)
+            probes = model.validation_probes(x, batch_idx) if model.val_fixed_probes else {}
+            elbos.append(model.gen_sde.elbo_random_t_slice(x, y, div=model.val_div, **probes))
+        return torch.cat(elbos).mean().item()
+
+    def on_epoch_end(epoch, train_loss):
+        metrics = {"train_loss": train_loss, "epoch": epoch}
+        extra = dict(epoch=epoch, global_step=engine.global_step)
+        if val_batches is not None and (epoch + 1) % args.check_val_every_n_epoch == 0:
+            model.eval()
+            elbo = validation_elbo()
+            model.train()
+            metrics["elbo_estimator"] = elbo
+            # lowest value kept, as by the monitor of the Lightning run
+            if best[0] is None or elbo < best[0]:
+                filename = f"{filename_prefix}-epoch={epoch:03d}-elbo_estimator={elbo:.4e}.ckpt"
+                save_weights_checkpoint(model, os.path.join(checkpoint_dirpath, filename), **extra)
+                if best[1] is not None:
+                    os.remove(os.path.join(checkpoint_dirpath, best[1]))
+                best[:] = [elbo, filename]
+        every = args.checkpoint_every_n_epochs
+        if every and (epoch + 1) % every == 0:
+            save_weights_checkpoint(model, os.path.join(checkpoint_dirpath, f"{filename_prefix}-epoch={epoch:03d}.ckpt"),
+                                    **extra)
+        save_weights_checkpoint(model, os.path.join(checkpoint_dirpath, "last.ckpt"), **extra)
+        logger.log_metrics(metrics, step=engine.global_step)
+
+    max_time = None
+    if args.train_time is not None:
+        days, hours, minutes, seconds = map(int, args.train_time.split(":"))
+        max_time = ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+    if sample_weights is not None:
+        sample_weights = torch.tensor(sample_weights, dtype=torch.float32, device=device)
+    engine.fit(train_tensors, args.batch_size, epochs, on_epoch_end=on_epoch_end, max_time=max_time,
+               weights=sample_weights)
+    logger.finalize("success")
+
+
 def run_training(
         taskname: str,
         seed: int,
-        wandb_logger: pl.loggers.wandb.WandbLogger,
+        logger: pl.loggers.Logger,
         args,
         device=None,
 ):
@@ -295,6 +466,15 @@ def run_training(
     hidden_size = args.hidden_size
     depth = args.depth
     learning_rate = args.learning_rate
+    warmup_steps = args.warmup_epochs
+    if args.init_from is not None:
+        # fine-tuning from a trained model gets its own schedule and epoch budget
+        epochs = args.finetune_epochs if args.finetune_epochs is not None else epochs
+        learning_rate = args.finetune_learning_rate if args.finetune_learning_rate is not None else learning_rate
+        warmup_steps = args.finetune_warmup_steps
+    # samples per optimizer step, over gradient accumulation and all data-parallel processes
+    learning_rate, warmup_steps = scaled_schedule(args, learning_rate, warmup_steps,
+                                                  num_processes=args.num_processes * args.num_nodes)
     auto_tune_lr = args.auto_tune_lr
     dropout_p = args.dropout_p
     checkpoint_every_n_epochs = args.checkpoint_every_n_epochs
@@ -312,24 +492,42 @@ def run_training(
     debias = args.debias
     score_matching = args.score_matching
 
+    distributed = args.num_processes > 1 or args.num_nodes > 1
+    if distributed and not (use_gpu and torch.cuda.is_available()):
+        # the processes of a node share its cores
+        torch.set_num_threads(args.threads_per_process or max(1, os.cpu_count() // args.num_processes))
+
+    # the same seed on every rank, so that all ranks build the same model and data split
     set_seed(seed)
-    if taskname != 'tf-bind-10':
+    if taskname != 'tf-bind-10' or args.subsample_size is not None:
+        # with --subsample_size, the full dataset is subsampled by load_task_arrays
         task = design_bench.make(TASKNAME2TASK[taskname])
     else:
         task = design_bench.make(TASKNAME2TASK[taskname],
                                  dataset_kwargs={"max_samples": 30000})
 
-    if task.is_discrete:
-        task.map_to_logits()
-        # print("X shape:", task.x.shape)
-    if normalise_x:
-        task.map_normalize_x()
-    if normalise_y:
-        task.map_normalize_y()
+    compact_x = args.compact_x and task.is_discrete
+    if compact_x:
+        assert score_matching and args.objective != 'flow', "--compact_x is only supported by DiffusionScore"
+        assert not args.is_target and args.reflow_from is None, "--compact_x needs the task's own designs"
+    arrays = load_task_arrays(task, taskname, normalise_x, normalise_y,
+                              temp=args.temp, cache_dir=args.cache_dir, compact=compact_x,
+                              subsample_size=args.subsample_size, subsample_seed=args.subsample_seed)
+    x_expander = LogitExpander.from_task(task) if compact_x else None
 
     print("TASK NAME: ", taskname)
 
-    if not score_matching:
+    if args.objective == 'flow':
+        print("Flow matching loss")
+        model = FlowMatchingScore(taskname=taskname,
+                                  task=task,
+                                  learning_rate=learning_rate,
+                                  hidden_size=hidden_size,
+                                  T0=T0,
+                                  dropout_p=dropout_p,
+                                  score_arch=args.score_arch,
+                                  warmup_steps=warmup_steps)
+    elif not score_matching:
         model = DiffusionTest(taskname=taskname,
                               task=task,
                               learning_rate=learning_rate,
@@ -353,12 +551,28 @@ def run_training(
                                simple_clip=args.simple_clip,
                                T0=T0,
                                debias=debias,
-                               dropout_p=dropout_p)
+                               dropout_p=dropout_p,
+                               score_arch=args.score_arch,
+                               t_sampler=args.t_sampler,
+                               val_div=args.val_div,
+                               val_fixed_probes=args.val_fixed_probes,
+                               warmup_steps=warmup_steps,
+                               t_max=args.t_max,
+                               t_max_mix=args.t_max_mix,
+                               checkpoint_segments=args.activation_checkpointing,
+                               x_expander=x_expander)
+        if args.init_from is not None:
+            init_checkpoint = torch.load(args.init_from, map_location="cpu", weights_only=False)
+            model.load_state_dict(init_checkpoint["state_dict"])
+            print(f"Initialized from {args.init_from}")
 
     # monitor = "val_loss" if val_frac > 0 else "train_loss"
     monitor = "elbo_estimator" if val_frac > 0 else "train_loss"
-    checkpoint_dirpath = os.path.join(wandb_logger.experiment.dir,
-                                      checkpoint_dir)
+    if args.objective == 'flow' and val_frac > 0:
+        monitor = "val_loss"
+    # only rank 0 touches the run directory; ModelCheckpoint takes its directory from rank 0
+    run_dir = logger.experiment.dir if global_rank(args) == 0 else None
+    checkpoint_dirpath = os.path.join(run_dir, checkpoint_dir) if run_dir is not None else checkpoint_dir
     checkpoint_filename = f"{taskname}_{seed}-" + "-{epoch:03d}-{" + f"{monitor}" + ":.4e}"
     periodic_checkpoint_callback = pl.callbacks.ModelCheckpoint(
         dirpath=checkpoint_dirpath,
@@ -374,21 +588,37 @@ def run_training(
         dirpath=checkpoint_dirpath,
         monitor=monitor,
         filename=checkpoint_filename,
-        save_last=True,  # save latest model
+        save_last=not args.async_checkpoints,  # save latest model
         save_top_k=1,  # save top model based on monitored loss
     )
+    if args.async_checkpoints:
+        # periodic weights/state checkpoints and last.ckpt are written in a background thread
+        periodic_checkpoint_callback = AsyncCheckpointStore(dirpath=checkpoint_dirpath,
+                                                            every_n_epochs=checkpoint_every_n_epochs,
+                                                            keep_weights=args.keep_weights,
+                                                            keep_states=args.keep_states)
+    callbacks = [periodic_checkpoint_callback, val_checkpoint_callback]
+    if args.ema_decay is not None:
+        callbacks.append(EMACallback(decay=args.ema_decay))
+    if args.target_elbo is not None:
+        callbacks.append(ELBOTargetCallback(target_elbo=args.target_elbo,
+                                            output_file=os.path.join(run_dir, "elbo_target.json") if run_dir else None,
+                                            stop=args.stop_at_target_elbo))
     trainer = pl.Trainer(
-        devices=1,
+        **distributed_kwargs(args),
         # auto_lr_find=auto_tune_lr,
         max_epochs=epochs,
         # max_steps=max_steps,
         max_time=train_time,
-        logger=wandb_logger,
+        logger=logger,
         # progress_bar_refresh_rate=20,
-        callbacks=[periodic_checkpoint_callback, val_checkpoint_callback],
+        callbacks=callbacks,
         # track_grad_norm=2,  # logs the 2-norm of gradients
-        limit_val_batches=1.0 if val_frac > 0 else 0,
+        # a fraction of the validation batches, or a number of batches if above 1
+        limit_val_batches=(int(args.val_budget) if args.val_budget > 1 else args.val_budget) if val_frac > 0 else 0,
+        check_val_every_n_epoch=args.check_val_every_n_epoch,
         limit_test_batches=0,
+        accumulate_grad_batches=args.accumulate_grad_batches,
     )
 
     # train_dataset, val_dataset = split_dataset(task=task,
@@ -398,17 +628,221 @@ def run_training(
     # val_data_module = DataLoader(val_dataset)  #, num_workers=num_workers)
 
     # trainer.fit(model, train_data_module, val_data_module)
-    data_module = RvSDataModule(task=task,
-                                val_frac=val_frac,
-                                device=device,
-                                batch_size=batch_size,
-                                num_workers=num_workers,
-                                temp=args.temp,
-                                top_candidates_size=args.top_candidates_size,
-                                is_target=args.is_target)
+    data_kwargs = dict(task=task,
+                       val_frac=val_frac,
+                       device=device,
+                       batch_size=batch_size,
+                       num_workers=num_workers,
+                       temp=args.temp,
+                       top_candidates_size=args.top_candidates_size,
+                       is_target=args.is_target,
+                       tensor_dataset=args.tensor_dataset,
+                       arrays=arrays,
+                       weighting=args.weighting,
+                       seed=seed)
+    if args.reflow_from is not None:
+        teacher = FlowMatchingScore.load_from_checkpoint(
+            checkpoint_path=args.reflow_from,
+            taskname=taskname,
+            task=task,
+            hidden_size=hidden_size,
+            T0=T0,
+            score_arch=args.score_arch)
+        data_module = ReflowDataModule(teacher=teacher,
+                                       num_steps=args.reflow_num_steps,
+                                       gamma=args.gamma,
+                                       **data_kwargs)
+    else:
+        data_module = RvSDataModule(**data_kwargs)
+    if args.engine == 'lean':
+        assert isinstance(model, DiffusionScore) and args.reflow_from is None, "--engine lean trains DiffusionScore only"
+        assert not distributed, "--engine lean runs in a single process"
+        # callbacks of the Lightning run that the lean loop does not have
+        assert args.ema_decay is None and not args.async_checkpoints and args.target_elbo is None, \
+            "--engine lean does not support --ema_decay, --async_checkpoints or --target_elbo"
+        data_module.setup()
+        fit_lean(model, data_module.train_dataset, data_module.val_dataset, logger, args, device,
+                 epochs=epochs, checkpoint_dirpath=checkpoint_dirpath, filename_prefix=f"{taskname}_{seed}-",
+                 sample_weights=data_module.sample_weights)
+        return
     trainer.fit(model, data_module)
 
 
+def run_joint_training(
+        taskname: str,
+        seed: int,
+        logger: pl.loggers.Logger,
+        args,
+        device=None,
+):
+    """Train the source and the target DiffusionScore together, reading the task data once."""
+    set_seed(seed)
+    # each model steps on its own batch, with the schedule of a single-model run_training
+    learning_rate, warmup_steps = scaled_schedule(args, args.learning_rate, args.warmup_epochs)
+    if taskname != 'tf-bind-10' or args.subsample_size is not None:
+        # with --subsample_size, the full dataset is subsampled by load_task_arrays
+        task = design_bench.make(TASKNAME2TASK[taskname])
+    else:
+        task = design_bench.make(TASKNAME2TASK[taskname],
+                                 dataset_kwargs={"max_samples": 30000})
+
+    arrays = load_task_arrays(task, taskname, args.normalise_x, args.normalise_y,
+                              temp=args.temp, cache_dir=args.cache_dir,
+                              subsample_size=args.subsample_size, subsample_seed=args.subsample_seed)
+
+    print("TASK NAME: ", taskname, "(source and target)")
+
+    expt_save_path = f"./experiments/{taskname}/{args.name}/{seed}"
+    checkpoint_dirs = {
+        "source": os.path.join(expt_save_path, "wandb", "source", "files", checkpoint_dir),
+        "target": os.path.join(expt_save_path, "wandb", args.target_run_name, "files", checkpoint_dir),
+    }
+    model = JointDiffusionScore(checkpoint_dirs=checkpoint_dirs,
+                                filename_prefix=f"{taskname}_{seed}-",
+                                checkpoint_every_n_epochs=args.checkpoint_every_n_epochs,
+                                taskname=taskname,
+                                task=task,
+                                learning_rate=learning_rate,
+                                hidden_size=args.hidden_size,
+                                vtype=args.vtype,
+                                beta_min=args.beta_min,
+                                beta_max=args.beta_max,
+                                simple_clip=args.simple_clip,
+                                T0=args.T0,
+                                debias=args.debias,
+                                dropout_p=args.dropout_p,
+                                score_arch=args.score_arch,
+                                t_sampler=args.t_sampler,
+                                val_div=args.val_div,
+                                val_fixed_probes=args.val_fixed_probes,
+                                warmup_steps=warmup_steps,
+                                t_max=args.t_max,
+                                t_max_mix=args.t_max_mix,
+                                checkpoint_segments=args.activation_checkpointing)
+
+    data_modules = {}
+    for role, is_target in [("source", False), ("target", True)]:
+        data_modules[role] = RvSDataModule(task=task,
+                                           val_frac=args.val_frac,
+                                           device=device,
+                                           batch_size=args.batch_size,
+                                           num_workers=args.num_workers,
+                                           temp=args.temp,
+                                           top_candidates_size=args.top_candidates_size,
+                                           is_target=is_target,
+                                           tensor_dataset=args.tensor_dataset,
+                                           arrays=arrays,
+                                           weighting=args.weighting)
+        data_modules[role].setup()
+
+    trainer = pl.Trainer(
+        devices=1,
+        max_epochs=args.epochs,
+        max_time=args.train_time,
+        logger=logger,
+        enable_checkpointing=False,
+        limit_val_batches=(int(args.val_budget) if args.val_budget > 1 else args.val_budget) if args.val_frac > 0 else 0,
+        check_val_every_n_epoch=args.check_val_every_n_epoch,
+        limit_test_batches=0,
+        accumulate_grad_batches=args.accumulate_grad_batches,
+        # the checkpoints of both models carry their own EMA weights (see JointDiffusionScore)
+        callbacks=[EMACallback(decay=args.ema_decay)] if args.ema_decay is not None else None,
+    )
+    # the smaller training set is cycled, so every step has a batch for both models
+    trainer.fit(model,
+                train_dataloaders={role: dm.train_dataloader() for role, dm in data_modules.items()},
+                val_dataloaders=[data_modules[role].val_dataloader() for role in ROLES])
+
+
+def run_multiseed_training(
+        taskname: str,
+        seeds,
+        logger: pl.loggers.Logger,
+        args,
+        device=None,
+):
+    """Train one DiffusionScore per seed in a single process with stacked parameters."""
+    set_seed(seeds[0])
+    if taskname != 'tf-bind-10' or args.subsample_size is not None:
+        # with --subsample_size, the full dataset is subsampled by load_task_arrays
+        task = design_bench.make(TASKNAME2TASK[taskname])
+    else:
+        task = design_bench.make(TASKNAME2TASK[taskname],
+                                 dataset_kwargs={"max_samples": 30000})
+
+    arrays = load_task_arrays(task, taskname, args.normalise_x, args.normalise_y,
+                              temp=args.temp, cache_dir=args.cache_dir,
+                              subsample_size=args.subsample_size, subsample_seed=args.subsample_seed)
+
+    print("TASK NAME: ", taskname, "SEEDS: ", seeds)
+    assert args.weighting == 'loss', "--mode train_multiseed supports --weighting loss only"
+    # the reentrant checkpoint of torch 1.13 cannot run inside the vmapped forward of the stacked networks
+    assert not args.activation_checkpointing, "--mode train_multiseed does not support --activation_checkpointing"
+    assert args.ema_decay is None, "--mode train_multiseed does not support --ema_decay"
+    learning_rate, warmup_steps = scaled_schedule(args, args.learning_rate, args.warmup_epochs)
+
+    # every seed gets the same data split it would get in its own run
+    train_datasets, val_datasets = [], []
+    for seed in seeds:
+        set_seed(seed)
+        train_dataset, val_dataset = split_dataset_based_on_top_candidates(
+            task, size=args.top_candidates_size, val_frac=args.val_frac, device=device, temp=args.temp,
+            is_target=args.is_target, arrays=arrays)
+        train_datasets.append(train_dataset)
+        val_datasets.append(val_dataset)
+
+    # each seed gets the run directory of its own run_training: experiments/<task>/<name>/<seed>/wandb/latest-run
+    seed_loggers, checkpoint_dirs = [], []
+    for seed in seeds:
+        seed_logger = LocalLogger(project=logger.experiment.project, name=f"{args.name}_task={taskname}_{seed}",
+                                  save_dir=f"./experiments/{taskname}/{args.name}/{seed}")
+        seed_args = configargparse.Namespace(**vars(args))
+        seed_args.seed = seed
+        log_args(seed_args, seed_logger)
+        seed_loggers.append(seed_logger)
+        checkpoint_dirs.append(os.path.join(seed_logger.experiment.dir, checkpoint_dir))
+    model = MultiSeedDiffusionScore(seeds=seeds,
+                                    checkpoint_dirs=checkpoint_dirs,
+                                    filename_prefixes=[f"{taskname}_{seed}-" for seed in seeds],
+                                    checkpoint_every_n_epochs=args.checkpoint_every_n_epochs,
+                                    seed_loggers=seed_loggers,
+                                    taskname=taskname,
+                                    task=task,
+                                    learning_rate=learning_rate,
+                                    hidden_size=args.hidden_size,
+                                    vtype=args.vtype,
+                                    beta_min=args.beta_min,
+                                    beta_max=args.beta_max,
+                                    simple_clip=args.simple_clip,
+                                    T0=args.T0,
+                                    debias=args.debias,
+                                    dropout_p=args.dropout_p,
+                                    score_arch=args.score_arch,
+                                    t_sampler=args.t_sampler,
+                                    val_div=args.val_div,
+                                    val_fixed_probes=args.val_fixed_probes,
+                                    warmup_steps=warmup_steps,
+                                    t_max=args.t_max,
+                                    t_max_mix=args.t_max_mix)
+
+    trainer = pl.Trainer(
+        devices=1,
+        max_epochs=args.epochs,
+        max_time=args.train_time,
+        logger=logger,
+        enable_checkpointing=False,
+        limit_val_batches=(int(args.val_budget) if args.val_budget > 1 else args.val_budget) if args.val_frac > 0 else 0,
+        check_val_every_n_epoch=args.check_val_every_n_epoch,
+        limit_test_batches=0,
+        accumulate_grad_batches=args.accumulate_grad_batches,
+    )
+    val_dataloaders = [DataLoader(TensorRvSDataset.from_dataset(d), batch_size=None,
+                                  sampler=ContiguousBatchSampler(len(d), args.batch_size, shuffle=False))
+                       for d in val_datasets]
+    trainer.fit(model, train_dataloaders=StackedBatchLoader(train_datasets, args.batch_size, seeds),
+                val_dataloaders=val_dataloaders if args.val_frac > 0 else None)
+
+
 if __name__ == "__main__":
     parser = configargparse.ArgumentParser()
     # configuration
@@ -420,7 +854,7 @@ if __name__ == "__main__":
         help="path(s) to configuration file(s)",
     )
     parser.add_argument('--mode',
-                        choices=['train', 'eval'],
+                        choices=['train', 'train_joint', 'train_multiseed', 'eval'],
                         default='train',
                         )
     parser.add_argument('--task',
@@ -435,6 +869,57 @@ if __name__ == "__main__":
         help=
         "sets the random seed; if this is not specified, it is chosen randomly",
     )
+    parser.add_argument(
+        "--init_from",
+        type=str,
+        default=None,
+        help="initialize the score model from this checkpoint (e.g. the source model) and fine-tune it",
+    )
+    parser.add_argument(
+        "--finetune_epochs",
+        type=int,
+        default=None,
+        help="epoch budget with --init_from (defaults to --epochs)",
+    )
+    parser.add_argument(
+        "--finetune_learning_rate",
+        type=float,
+        default=None,
+        help="learning rate with --init_from (defaults to --learning_rate)",
+    )
+    parser.add_argument(
+        "--finetune_warmup_steps",
+        type=int,
+        default=0,
+        help="warmup of the cosine schedule with --init_from, in epochs like the default schedule",
+    )
+    parser.add_argument(
+        "--target_elbo",
+        type=float,
+        default=None,
+        help="record the first epoch at which the validation ELBO estimate falls to this value or below, "
+             "as minimised by the checkpoints, e.g. the final ELBO of a target model trained from scratch "
+             "(written to elbo_target.json in the run dir)",
+    )
+    parser.add_argument(
+        "--stop_at_target_elbo",
+        action="store_true",
+        default=False,
+        help="stop training once --target_elbo is reached",
+    )
+    parser.add_argument(
+        "--target_run_name",
+        type=str,
+        default="target_grad_pred",
+        help="run directory of the target model in --mode train_joint (the source goes to wandb/source)",
+    )
+    parser.add_argument(
+        "--seeds",
+        default=[0, 1, 2, 3, 4, 5, 6, 7],
+        type=int,
+        nargs="+",
+        help="seeds trained together with stacked parameters in --mode train_multiseed",
+    )
     parser.add_argument("--condition", default=0.0, type=float)
     parser.add_argument("--lamda", default=0.0, type=float)
     parser.add_argument("--temp", default='90', type=str)
@@ -442,6 +927,20 @@ if __name__ == "__main__":
     # experiment tracking
     parser.add_argument("--name", type=str, help="Experiment name")
     parser.add_argument("--score_matching", action='store_true', default=False)
+    parser.add_argument("--objective",
+                        choices=['score', 'flow'],
+                        default='score',
+                        help="'score' trains the diffusion model selected by --score_matching, "
+                             "'flow' trains a rectified-flow (flow matching) model")
+    parser.add_argument("--reflow_from",
+                        type=str,
+                        default=None,
+                        help="checkpoint of a trained flow-matching model; its (noise, sample) "
+                             "pairs replace the training designs for a reflow stage")
+    parser.add_argument("--reflow_num_steps",
+                        type=int,
+                        default=100,
+                        help="number of ODE steps used to generate the reflow pairs")
     # training
     train_time_group = parser.add_mutually_exclusive_group(required=False)
     train_time_group.add_argument(
@@ -468,6 +967,16 @@ if __name__ == "__main__":
                         default=1,
                         type=int,
                         help="Number of workers")
+    parser.add_argument("--tensor_dataset",
+                        action="store_true",
+                        default=False,
+                        help="keep the training arrays in one tensor and load shuffled batches by "
+                             "index slicing, without per-item collate or worker processes")
+    parser.add_argument("--weighting",
+                        choices=['loss', 'sample'],
+                        default='loss',
+                        help="loss: multiply the per-sample weights into the loss; sample: draw training rows "
+                             "proportionally to the weights and weight the loss by their mean instead")
     checkpoint_frequency_group = parser.add_mutually_exclusive_group(
         required=False)
     checkpoint_frequency_group.add_argument(
@@ -512,6 +1021,25 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="experiments/cache",
+        help="directory for cached preprocessed task arrays; pass an empty string to disable",
+    )
+    parser.add_argument(
+        "--subsample_size",
+        type=int,
+        default=None,
+        help="train on a score-stratified sample of this many rows of the full dataset, streamed in "
+             "chunks and cached with the arrays, instead of the 30000-row cap of tf-bind-10",
+    )
+    parser.add_argument(
+        "--subsample_seed",
+        type=int,
+        default=0,
+        help="seed of the --subsample_size sample, independent of --seed so that all runs share it",
+    )
 
     # i/o
     parser.add_argument('--dataset',
@@ -550,6 +1078,42 @@ if __name__ == "__main__":
         help=
         'transforming the data from [0,1] to the real space using the logit function'
     )
+    parser.add_argument(
+        '--t_sampler',
+        type=str,
+        choices=T_SAMPLERS,
+        default='uniform',
+        help='how the diffusion times of a minibatch are drawn in the denoising score matching loss'
+    )
+    parser.add_argument(
+        '--activation_checkpointing',
+        type=int,
+        default=0,
+        help='split the score network into this many segments and keep only their boundary activations '
+             'in training, recomputing the rest in the backward pass (0 disables it); trades compute for '
+             'memory, for wider networks or larger batches'
+    )
+    parser.add_argument(
+        '--compact_x',
+        action='store_true',
+        default=False,
+        help='keep the designs of a discrete task as uint8 codes and expand them to (normalized) logits '
+             'per batch, instead of holding the whole float32 logit dataset in memory'
+    )
+    parser.add_argument(
+        '--t_max',
+        type=float,
+        default=None,
+        help='train on diffusion times in [0, t_max] only, for target models that are only used to edit '
+             'from t_max (edit_new.py --t) down to 0; stored in the checkpoints, and the sampler refuses '
+             'to start above it'
+    )
+    parser.add_argument(
+        '--t_max_mix',
+        type=float,
+        default=0.,
+        help='with --t_max, fraction of the diffusion times still drawn from the whole [0, T]'
+    )
     parser.add_argument(
         '--debias',
         action="store_true",
@@ -572,6 +1136,33 @@ if __name__ == "__main__":
         help=
         "have PyTorch Lightning try to automatically find the best learning rate",
     )
+    parser.add_argument(
+        "--warmup_epochs",
+        type=int,
+        default=500,
+        help="linear warmup of the cosine learning rate schedule, in epochs",
+    )
+    parser.add_argument(
+        "--accumulate_grad_batches",
+        type=int,
+        default=1,
+        help="average the gradients of this many batches into one optimizer step (--mode train)",
+    )
+    parser.add_argument(
+        "--lr_scaling",
+        type=str,
+        default="none",
+        choices=LR_SCALING_RULES,
+        help="scale --learning_rate (and lengthen --warmup_epochs by the same factor) from "
+             "--lr_base_batch_size to the effective batch size: batch_size * accumulate_grad_batches "
+             "* processes; 'sqrt' is the safer rule with Adam",
+    )
+    parser.add_argument(
+        "--lr_base_batch_size",
+        type=int,
+        default=256,
+        help="batch size that --learning_rate and --warmup_epochs were tuned for",
+    )
     parser.add_argument(
         "--hidden_size",
         type=int,
@@ -591,6 +1182,116 @@ if __name__ == "__main__":
         help="dropout probability",
         default=0,
     )
+    parser.add_argument(
+        "--score_arch",
+        type=str,
+        choices=["mlp", "film"],
+        default="mlp",
+        help="score network: 'mlp' concatenates y to the input, 'film' injects y late so "
+             "guided sampling shares one trunk evaluation",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["lightning", "lean"],
+        default="lightning",
+        help="'lean' trains DiffusionScore with the minimal loop of engine.py instead of pl.Trainer",
+    )
+    parser.add_argument(
+        "--grad_clip",
+        type=float,
+        default=None,
+        help="clip the gradient norm to this value with --engine lean",
+    )
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        default=1,
+        help="data-parallel training processes per node (--mode train), e.g. one per CPU socket or group of cores",
+    )
+    parser.add_argument(
+        "--num_nodes",
+        type=int,
+        default=1,
+        help="number of nodes for data-parallel training; start the same command on every node with "
+             "MASTER_ADDR, MASTER_PORT and NODE_RANK set",
+    )
+    parser.add_argument(
+        "--ddp_backend",
+        type=str,
+        default="gloo",
+        help="torch.distributed backend of data-parallel training",
+    )
+    parser.add_argument(
+        "--threads_per_process",
+        type=int,
+        default=None,
+        help="torch threads of each data-parallel CPU process, by default the cores divided by --num_processes",
+    )
+    parser.add_argument(
+        "--logger",
+        type=str,
+        choices=["wandb", "local"],
+        default="wandb",
+        help="'local' writes metrics to a CSV file in the run directory instead of syncing to wandb",
+    )
+    parser.add_argument(
+        "--log_flush_secs",
+        type=int,
+        default=30,
+        help="how often the local logger appends buffered metrics to disk",
+    )
+    parser.add_argument(
+        "--async_checkpoints",
+        action="store_true",
+        default=False,
+        help="write the periodic checkpoints and last.ckpt from a background thread, as weights-only "
+             "files in checkpoints/weights and resumable states in checkpoints/state "
+             "(--checkpoint_every_n_steps and --checkpoint_time_interval are then ignored)",
+    )
+    parser.add_argument(
+        "--keep_weights",
+        type=int,
+        default=-1,
+        help="number of periodic weights-only checkpoints kept with --async_checkpoints (-1 keeps all)",
+    )
+    parser.add_argument(
+        "--keep_states",
+        type=int,
+        default=1,
+        help="number of periodic resumable checkpoints kept with --async_checkpoints (-1 keeps all)",
+    )
+    parser.add_argument(
+        "--check_val_every_n_epoch",
+        type=int,
+        default=1,
+        help="run the validation ELBO every this many epochs",
+    )
+    parser.add_argument(
+        "--val_budget",
+        type=float,
+        default=1.0,
+        help="fraction of the validation batches (<= 1) or number of batches (> 1) used per validation",
+    )
+    parser.add_argument(
+        "--val_fixed_probes",
+        action="store_true",
+        default=False,
+        help="reuse the same (t, v, noise) draws for the validation ELBO every epoch",
+    )
+    parser.add_argument(
+        "--val_div",
+        type=str,
+        choices=["hutchinson", "jvp"],
+        default="hutchinson",
+        help="divergence estimator of the validation ELBO: backward pass or forward-mode jvp",
+    )
+    parser.add_argument(
+        "--ema_decay",
+        type=float,
+        default=None,
+        help="keep an EMA of the weights with this decay, validate with it and store it in checkpoints",
+    )
     parser.add_argument(
         "--beta_min",
         type=float,
@@ -625,18 +1326,50 @@ if __name__ == "__main__":
 
     expt_save_path = f"./experiments/{args.task}/{args.name}/{args.seed}"
 
+    if args.mode != 'train':
+        assert args.num_processes == 1 and args.num_nodes == 1, "data-parallel training is supported by --mode train"
+
     if args.mode == 'train':
         if not os.path.exists(expt_save_path):
             os.makedirs(expt_save_path)
-        wandb_logger = pl.loggers.wandb.WandbLogger(
-            project=wandb_project,
-            name=f"{args.name}_task={args.task}_{args.seed}",
-            save_dir=expt_save_path)
-        log_args(args, wandb_logger)
+        logger = make_logger(args, wandb_project,
+                             name=f"{args.name}_task={args.task}_{args.seed}",
+                             save_dir=expt_save_path)
+        if global_rank(args) == 0:
+            log_args(args, logger)
         run_training(
             taskname=args.task,
             seed=args.seed,
-            wandb_logger=wandb_logger,
+            logger=logger,
+            args=args,
+            device=device,
+        )
+    elif args.mode == 'train_joint':
+        if not os.path.exists(expt_save_path):
+            os.makedirs(expt_save_path)
+        logger = make_logger(args, wandb_project,
+                             name=f"{args.name}_task={args.task}_{args.seed}_joint",
+                             save_dir=expt_save_path)
+        log_args(args, logger)
+        run_joint_training(
+            taskname=args.task,
+            seed=args.seed,
+            logger=logger,
+            args=args,
+            device=device,
+        )
+    elif args.mode == 'train_multiseed':
+        expt_save_path = f"./experiments/{args.task}/{args.name}/multiseed"
+        if not os.path.exists(expt_save_path):
+            os.makedirs(expt_save_path)
+        logger = make_logger(args, wandb_project,
+                             name=f"{args.name}_task={args.task}_seeds={'-'.join(map(str, args.seeds))}",
+                             save_dir=expt_save_path)
+        log_args(args, logger)
+        run_multiseed_training(
+            taskname=args.task,
+            seeds=args.seeds,
+            logger=logger,
             args=args,
             device=device,
         )
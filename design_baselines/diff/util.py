@@ -3,9 +3,11 @@
 from __future__ import annotations
 
 import glob
+import hashlib
 import json
 import os
 import random
+import shutil
 from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -13,6 +15,9 @@ import torch
 # import wandb
 # from wandb.sdk.wandb_run import Run
 
+from streaming import CHUNK_SIZE, array_chunks, stratified_subsample, stream_counts, stream_order_statistics, \
+    stream_range, task_chunks
+
 TASKNAME2TASK = {
     'dkitty': 'DKittyMorphology-Exact-v0',
     'ant': 'AntMorphology-Exact-v0',
@@ -63,6 +68,32 @@ def sorted_glob(*args, **kwargs) -> List[str]:
     return sorted(glob.glob(*args, **kwargs))
 
 
+def save_weights_checkpoint(model: torch.nn.Module, path: str, **extra) -> None:
+    """Save a weights-only checkpoint that `LightningModule.load_from_checkpoint` accepts."""
+    import pytorch_lightning as pl
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    checkpoint = {
+        "state_dict": {k: v.detach().cpu() for k, v in model.state_dict().items()},
+        "pytorch-lightning_version": pl.__version__,
+    }
+    checkpoint.update(extra)
+    if isinstance(model, pl.LightningModule):
+        model.on_save_checkpoint(checkpoint)
+    torch.save(checkpoint, path)
+
+
+def load_ema_weights(model: torch.nn.Module, path: str) -> torch.nn.Module:
+    """Replace the weights of `model` by the EMA weights stored in the checkpoint at `path`."""
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if "ema_state_dict" not in checkpoint:
+        raise ValueError(f"{path} has no EMA weights, train with --ema_decay to store them")
+    missing, unexpected = model.load_state_dict(checkpoint["ema_state_dict"], strict=False)
+    assert len(unexpected) == 0, f"unexpected EMA weights in {path}: {unexpected}"
+    print(f"Loaded EMA weights (decay={checkpoint.get('ema_decay')}) from {path}")
+    return model
+
+
 def parse_val_loss(filename: str) -> float:
     """Parse val_loss from the checkpoint filename."""
     start = filename.index("val_loss=") + len("val_loss=")
@@ -100,6 +131,30 @@ def adaptive_temp_v2(scores_np, q=None):
     return np.maximum(np.abs(quantile_ninety), 0.001)
 
 
+LR_SCALING_RULES = ['none', 'linear', 'sqrt']
+
+
+def scale_for_batch_size(learning_rate, warmup, batch_size, base_batch_size, rule='none'):
+    """Learning rate and warmup length for an effective batch of ``batch_size``, from values tuned at
+    ``base_batch_size``.
+
+    'linear' scales the learning rate with the batch size (Goyal et al., 2017) and 'sqrt' with its
+    square root (Hoffer et al., 2017), usually the safer rule with Adam. When the learning rate grows,
+    the warmup (in epochs, or whatever unit the schedule counts) is lengthened by the same factor, so
+    that the learning rate rises no faster per training sample than at the base batch size.
+    """
+    if rule == 'none':
+        return learning_rate, warmup
+    ratio = batch_size / base_batch_size
+    if rule == 'linear':
+        factor = ratio
+    elif rule == 'sqrt':
+        factor = ratio ** 0.5
+    else:
+        raise ValueError(f"unknown learning rate scaling rule {rule}")
+    return learning_rate * factor, int(round(warmup * max(factor, 1.)))
+
+
 def softmax(arr, temp=1.0):
     """Calculate the softmax using numpy by normalizing a vector
     to have entries that sum to one
@@ -151,15 +206,263 @@ def get_weights(scores, base_temp=None, temp=None):
         base_temp = adaptive_temp_v2(scores_np, q=0.5)
     else:
         raise RuntimeError("Invalid temperature")
+    provable_dist = _provable_dist(hist, bin_edges, base_temp)
+    return _assign_weights(scores_np, bin_edges, hist, provable_dist)
+
+
+def _provable_dist(hist, bin_edges, base_temp):
     softmin_prob = softmax(bin_edges[1:], temp=base_temp)
 
     provable_dist = softmin_prob * (hist / (hist + 1e-3))
     provable_dist = provable_dist / (np.sum(provable_dist) + 1e-7)
     print(provable_dist)
+    return provable_dist
 
+
+def _assign_weights(scores_np, bin_edges, hist, provable_dist):
     bin_indices = np.digitize(scores_np, bin_edges[1:])
     hist_prob = hist[np.minimum(bin_indices, 19)]
 
     weights = provable_dist[np.minimum(bin_indices, 19)] / (hist_prob + 1e-7)
     weights = np.clip(weights, a_min=0.0, a_max=5.0)
     return weights.astype(np.float32)[:, np.newaxis]
+
+
+def get_weights_streaming(chunks, temp=None, fine_bins=2 ** 16):
+    """`get_weights` for scores that do not fit in memory, read from the (x, y) chunks of
+    `streaming.task_chunks` or `streaming.array_chunks`.
+
+    One pass finds the range of the scores, a second builds the 20-bin histogram together with
+    a fine histogram that locates the order statistics of the temperature quantile, a third
+    keeps the distinct scores of those fine bins to read the quantile off exactly, and the
+    returned generator yields the weights of every chunk in a last pass. Its output equals
+    `get_weights` on the concatenated scores.
+    """
+    quantiles = {'90': 0.9, '75': 0.75, '50': 0.5}
+    if temp not in quantiles:
+        raise RuntimeError("Invalid temperature")
+    lo, hi, n = stream_range(chunks)
+    dtype = np.asarray(next(iter(chunks(return_x=False)))[1]).dtype
+    # the edges np.histogram(scores, bins=20) would use, in the dtype of the scores
+    bin_edges = np.histogram_bin_edges(np.array([lo, hi], dtype=dtype), bins=20)
+    fine_edges = np.linspace(lo, hi, fine_bins + 1) if lo < hi else np.array([lo, hi + 1.])
+    hist, fine_counts = stream_counts(chunks, bin_edges, fine_edges)
+    hist = hist / np.sum(hist)
+
+    # np.quantile(scores - max, q) with linear interpolation between two order statistics;
+    # subtracting the maximum preserves the order, so they are taken on the raw scores
+    index = (n - 1) * quantiles[temp]
+    lower = int(np.floor(index))
+    ranks = [lower, min(lower + 1, n - 1)]
+    order_statistics = np.array(stream_order_statistics(chunks, ranks, fine_edges, fine_counts), dtype=dtype)
+    shifted = order_statistics - np.array(hi, dtype=dtype)
+    base_temp = np.maximum(np.abs(np.quantile(shifted, q=index - lower)), 0.001)
+    provable_dist = _provable_dist(hist, bin_edges, base_temp)
+
+    def weights():
+        for _, y in chunks(return_x=False):
+            yield _assign_weights(np.reshape(y, (len(y), -1))[:, 0], bin_edges, hist, provable_dist)
+
+    return weights()
+
+
+## PREPROCESSING CACHE
+def _design_samples(task, rows: int = 1024):
+    """A few designs of the task for its fingerprint: the first and last raw shards of a
+    design-bench dataset, or a strided subset of ``rows`` rows of task.x for other tasks."""
+    dataset = getattr(task, "dataset", None)
+    if hasattr(dataset, "get_shard_x"):
+        return [dataset.get_shard_x(i) for i in sorted({0, dataset.get_num_shards() - 1})]
+    x = task.x
+    return [x[::max(1, len(x) // rows)]]
+
+
+def _task_fingerprint(task) -> str:
+    """Content hash of the task labels, design shape and a sample of the designs.
+
+    All labels are read, but only the first and last shards of the designs (see `_design_samples`),
+    so fingerprinting stays cheap for large tasks.
+    """
+    y = np.ascontiguousarray(task.y)
+    h = hashlib.sha1()
+    h.update(repr((getattr(task, "input_shape", None), y.shape, y.dtype.str)).encode())
+    h.update(y.tobytes())
+    for x in _design_samples(task):
+        x = np.ascontiguousarray(x)
+        h.update(repr((x.shape, x.dtype.str)).encode())
+        h.update(x.tobytes())
+    return h.hexdigest()
+
+
+def _map_normalize_cached(task, name: str, stats):
+    """`task.map_normalize_x` (name "x") or `task.map_normalize_y` (name "y") with the statistics
+    stored in the cache, instead of recomputing them in passes over the whole dataset."""
+    dataset = getattr(task, "dataset", None)
+    keys = [f"{name}_mean", f"{name}_standard_dev"]
+    if dataset is None or getattr(dataset, "freeze_statistics", False) or not all(k in stats for k in keys):
+        getattr(task, f"map_normalize_{name}")()
+        return
+    for k in keys:
+        setattr(dataset, k, stats[k])
+    setattr(dataset, f"is_normalized_{name}", True)
+
+
+class LogitExpander(torch.nn.Module):
+    """Maps integer codes of a discrete task, shape (n, length), to the flattened (and optionally
+    normalized) logits that `task.map_to_logits` and `task.map_normalize_x` would give them, shape
+    (n, length * (num_classes - 1)), with one lookup in a (length, num_classes, num_classes - 1) table.
+
+    The table is a non-persistent buffer, so models that hold an expander keep the state_dict of
+    models trained on the logits directly.
+    """
+
+    def __init__(self, table):
+        super().__init__()
+        self.length, self.num_classes, self.logit_dim = table.shape
+        self.dim_x = self.length * self.logit_dim
+        self.register_buffer("table", torch.as_tensor(table, dtype=torch.float32).reshape(-1, self.logit_dim),
+                             persistent=False)
+        self.register_buffer("offsets", torch.arange(self.length) * self.num_classes, persistent=False)
+
+    @classmethod
+    def from_task(cls, task):
+        """Builds the table with the task's own to_logits and normalize_x, so that it matches its
+        current (logits, optionally normalized) state."""
+        num_classes = task.dataset.num_classes
+        length = task.input_shape[0]
+        codes = np.repeat(np.arange(num_classes, dtype=np.int32)[:, np.newaxis], length, axis=1)
+        logits = task.to_logits(codes)
+        if task.is_normalized_x:
+            logits = task.normalize_x(logits)
+        # (num_classes, length, num_classes - 1) -> (length, num_classes, num_classes - 1)
+        return cls(np.ascontiguousarray(np.swapaxes(logits, 0, 1)))
+
+    def bounds(self):
+        """Elementwise min and max of the flattened logits over all codes."""
+        table = self.table.view(self.length, self.num_classes, self.logit_dim)
+        return table.min(dim=1)[0].reshape(-1), table.max(dim=1)[0].reshape(-1)
+
+    def forward(self, codes):
+        if codes.is_floating_point():
+            # already expanded
+            return codes
+        index = codes.long() + self.offsets.to(codes.device)
+        return self.table[index].reshape(codes.size(0), -1)
+
+
+def load_task_arrays(task, taskname: str, normalise_x: bool = False, normalise_y: bool = False,
+                     temp: Optional[str] = None, cache_dir: Optional[str] = None, compact: bool = False,
+                     subsample_size: Optional[int] = None, subsample_seed: int = 0):
+    """Apply the standard preprocessing to a design-bench task and return flattened
+    (x, y, w) arrays.
+
+    Discrete tasks are mapped to logits, x and y are optionally normalized, and w comes from
+    `get_weights` (None if ``temp`` is None). The task object itself is left in the same
+    mapped state as before. With ``cache_dir``, the arrays and the normalization statistics
+    are written as .npy files under a key built from the task name, the preprocessing
+    options, the temperature and a content hash of the raw task; later calls return
+    copy-on-write memory maps instead of recomputing them. A cache hit also restores the
+    normalization statistics of the task from the cache rather than recomputing them.
+
+    With ``compact``, x of a discrete task is returned as its uint8 codes, shape (n, length),
+    instead of the float32 logits; `LogitExpander.from_task(task)` expands batches of them.
+
+    With ``subsample_size``, the arrays hold a score-stratified sample of that many rows, drawn
+    by `streaming.stratified_subsample` from the chunks of the (unmapped) task without building
+    task.x; the normalization statistics remain those of the whole dataset.
+    """
+    compact = compact and task.is_discrete
+    path = None
+    if cache_dir:
+        spec = dict(task=taskname,
+                    logits=bool(task.is_discrete),
+                    normalise_x=bool(normalise_x),
+                    normalise_y=bool(normalise_y),
+                    temp=temp,
+                    data=_task_fingerprint(task))
+        if compact:
+            spec["compact"] = True
+        if subsample_size is not None:
+            spec["subsample"] = [subsample_size, subsample_seed]
+        spec = json.dumps(spec, sort_keys=True)
+        path = os.path.join(cache_dir, taskname, hashlib.sha1(spec.encode()).hexdigest()[:16])
+
+    cached = path is not None and os.path.exists(os.path.join(path, "spec.json"))
+    sample = None
+    if subsample_size is not None and not cached:
+        assert not getattr(task.dataset, "is_logits", False) and not getattr(task, "is_normalized_x", False), \
+            "subsampling reads the raw designs of an unmapped task"
+        sample = stratified_subsample(task_chunks(task), subsample_size, seed=subsample_seed)
+        print(f"Subsampled {len(sample[0])} rows")
+    codes = None
+    if compact and not cached:
+        assert task.dataset.num_classes <= 256, "uint8 codes need at most 256 classes"
+        raw_x = sample[1] if sample is not None else task.x
+        codes = raw_x.reshape(raw_x.shape[0], -1).astype(np.uint8)
+
+    if task.is_discrete:
+        task.map_to_logits()
+
+    if cached:
+        print(f"Loading preprocessed arrays from {path}")
+        # the task is left in the same mapped state as on a miss, without a pass over its designs
+        with np.load(os.path.join(path, "stats.npz")) as stats:
+            if normalise_x:
+                _map_normalize_cached(task, "x", stats)
+            if normalise_y:
+                _map_normalize_cached(task, "y", stats)
+        x = np.load(os.path.join(path, "x.npy"), mmap_mode="c")
+        y = np.load(os.path.join(path, "y.npy"), mmap_mode="c")
+        w = np.load(os.path.join(path, "w.npy"), mmap_mode="c") if temp is not None else None
+        return x, y, w
+
+    if normalise_x:
+        task.map_normalize_x()
+    if normalise_y:
+        task.map_normalize_y()
+
+    # the mapped task.x is never built for compact codes or a subsample
+    if compact:
+        x = codes
+    elif sample is not None:
+        x = task.to_logits(sample[1]) if task.is_discrete else sample[1]
+        x = task.normalize_x(x) if normalise_x else x
+    else:
+        x = task.x
+    x = x.reshape(x.shape[0], -1)
+    if sample is not None:
+        y = task.normalize_y(sample[2]) if normalise_y else sample[2]
+        y = y.reshape(-1, 1)
+    else:
+        y = task.y.reshape(-1, 1)
+    w = None
+    if temp is not None and len(y) > CHUNK_SIZE:
+        # same weights without the dataset-sized temporaries of np.quantile/np.digitize
+        w = np.concatenate(list(get_weights_streaming(array_chunks(y), temp=temp)))
+    elif temp is not None:
+        w = get_weights(y, temp=temp)
+
+    if path is not None:
+        # write into a temporary directory first so that concurrent runs never see partial files
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, "x.npy"), x)
+        np.save(os.path.join(tmp_path, "y.npy"), y)
+        if sample is not None:
+            np.save(os.path.join(tmp_path, "index.npy"), sample[0])
+        if w is not None:
+            np.save(os.path.join(tmp_path, "w.npy"), w)
+        dataset = getattr(task, "dataset", None)
+        stats = {name: getattr(dataset, name) for name in
+                 ["x_mean", "x_standard_dev", "y_mean", "y_standard_dev"]
+                 if getattr(dataset, name, None) is not None}
+        np.savez(os.path.join(tmp_path, "stats.npz"), **stats)
+        with open(os.path.join(tmp_path, "spec.json"), "w") as f:
+            f.write(spec)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process populated the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return x, y, w
+
@@ -126,8 +126,11 @@ def evaluate_sample(task, x_init, task_name, shape0):
     # return np.max(Y1), np.median(Y1)
 
 
-def adjust_learning_rate(optimizer, lr0, epoch, T):
+def adjust_learning_rate(optimizer, lr0, epoch, T, warmup=0):
     lr = lr0 * (1 + np.cos((np.pi * epoch * 1.0) / (T * 1.0))) / 2.0
+    if warmup > 0:
+        # linear warmup over the first `warmup` epochs
+        lr = lr * min(1.0, (epoch + 1.0) / warmup)
     print("epoch {} lr {}".format(epoch, lr))
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
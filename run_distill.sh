@@ -0,0 +1,7 @@
+python design_baselines/diff/distill.py --config configs/score_diffusion.cfg --seed 123 --use_gpu \
+    --task superconductor \
+    --teacher_checkpoint_path experiments/superconductor/score_diffusion/123/wandb/target_grad_pred/files/checkpoints/last.ckpt \
+    --student_checkpoint_path experiments/superconductor/score_diffusion/123/distilled_256/last.ckpt \
+    --student_hidden_size 256 \
+    --report_path results/superconductor/distill_256.json \
+    --evaluate
@@ -0,0 +1,8 @@
+python design_baselines/diff/edit_new.py --config configs/score_diffusion.cfg --seed 1234 --use_gpu --mode 'eval' \
+  --task superconductor \
+  --save_prefix edit_ensemble \
+  --edit True \
+  --ensemble_checkpoint_paths \
+    experiments/superconductor/score_diffusion/0/wandb/target_grad_pred/files/checkpoints/last.ckpt \
+    experiments/superconductor/score_diffusion/1/wandb/target_grad_pred/files/checkpoints/last.ckpt \
+    experiments/superconductor/score_diffusion/2/wandb/target_grad_pred/files/checkpoints/last.ckpt
@@ -0,0 +1,7 @@
+python design_baselines/diff/trainer.py --config configs/score_diffusion.cfg --seed 123 --use_gpu --mode 'train'\
+    --task superconductor \
+    --is_target True \
+    --init_from experiments/superconductor/score_diffusion/123/wandb/source/files/checkpoints/last.ckpt \
+    --finetune_epochs 200 \
+    --finetune_learning_rate 2e-4 \
+    --finetune_warmup_steps 0
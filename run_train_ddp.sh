@@ -0,0 +1,9 @@
+# data-parallel training on one CPU node: 4 processes with the gloo backend, sharing the cores
+python design_baselines/diff/trainer.py --config configs/score_diffusion.cfg --seed 123 --mode 'train'\
+    --task superconductor \
+    --is_target False --num_processes 4 --tensor_dataset
+
+# on several nodes, run the same command on every node with its NODE_RANK:
+# MASTER_ADDR=<node 0> MASTER_PORT=29500 NODE_RANK=<i> python design_baselines/diff/trainer.py \
+#     --config configs/score_diffusion.cfg --seed 123 --mode 'train' --task superconductor \
+#     --num_processes 4 --num_nodes 2 --tensor_dataset
@@ -0,0 +1,4 @@
+python design_baselines/diff/trainer.py --config configs/score_diffusion.cfg --seed 123 --use_gpu --mode 'train'\
+    --task superconductor \
+    --objective flow \
+    --is_target True
@@ -0,0 +1,3 @@
+python design_baselines/diff/trainer.py --config configs/score_diffusion.cfg --seed 123 --use_gpu --mode 'train_joint'\
+    --task superconductor \
+    --target_run_name target_grad_pred
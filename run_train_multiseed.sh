@@ -0,0 +1,4 @@
+python design_baselines/diff/trainer.py --config configs/score_diffusion.cfg --use_gpu --mode 'train_multiseed'\
+    --task superconductor \
+    --seeds 0 1 2 3 4 5 6 7 \
+    --is_target False